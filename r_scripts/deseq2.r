@@ -1,41 +1,19 @@
 #!/usr/bin/env Rscript
 
 source("util.r")
+source("latch.r")
 
 p("Loading Libraries")
-tryCatch(
-  {
-    suppressMessages(suppressWarnings(library(vctrs)))
-    suppressMessages(suppressWarnings(library(dplyr)))
-    suppressMessages(suppressWarnings(library(tibble)))
-    suppressMessages(suppressWarnings(library(stringr)))
-
-    suppressMessages(suppressWarnings(library(DEGreport)))
-    suppressMessages(suppressWarnings(library(DESeq2)))
-
-    suppressMessages(suppressWarnings(library(ggplot2)))
-    suppressMessages(suppressWarnings(library(EnhancedVolcano)))
-    suppressMessages(suppressWarnings(library(heatmaply)))
-    suppressMessages(suppressWarnings(library(plotly)))
-
-    suppressMessages(suppressWarnings(library(purrr)))
-    suppressMessages(suppressWarnings(
-      library(data.table)
-    ))
-  },
-  error = function(err) {
-    p("  Failed")
-    p("%s", err)
-    latch_error(list(source = "imports", error = as.character(err)))
-    stop()
-  }
-)
+latch_stage_start("load libraries")
+source("libraries.r")
 
-source("latch.r")
+source("parallel.r")
+source("qc_stats.r")
 source("plotly_util.r")
 
 source("maplot.r")
 source("volcanoplot.r")
+latch_stage_end("load libraries")
 
 get_plot_dims <- function(heat_map) {
   plot_height <- sum(sapply(heat_map$gtable$heights, grid::convertHeight, "in"))
@@ -60,6 +38,15 @@ arg_counts_table <- args[6]
 arg_gene_id_column <- args[7]
 arg_num_sig_genes <- args[9]
 arg_out_path <- args[10]
+arg_contrast_workers <- args[11]
+arg_contrast_mode <- args[12]
+arg_cpu_cores <- args[13]
+arg_reuse_fit <- args[14]
+arg_incremental <- args[15]
+arg_plot_format <- args[16]
+arg_max_points <- args[17]
+arg_widget_deps <- args[18]
+arg_fit_engine <- args[19]
 
 op <- function(x) {
   file.path(arg_out_path, x)
@@ -74,6 +61,15 @@ p("  Design matrix confounding columns: '%s'", arg_confounding_columns)
 p("  Counts table: %s", arg_counts_table)
 p("  Counts table gene ID column: '%s'", arg_gene_id_column)
 p("  Number of significant genes: %s", arg_num_sig_genes)
+p("  Contrast workers: %s", arg_contrast_workers)
+p("  Contrast mode: %s", arg_contrast_mode)
+p("  CPU cores: %s", arg_cpu_cores)
+p("  Reuse fit: %s", arg_reuse_fit)
+p("  Incremental: %s", arg_incremental)
+p("  Plot format: %s", arg_plot_format)
+p("  Max plot points: %s", arg_max_points)
+p("  Widget libraries: %s", arg_widget_deps)
+p("  Fit engine: %s", arg_fit_engine)
 p("")
 
 if (arg_sample_id_column == "") {
@@ -90,6 +86,7 @@ p("Unique sample_id_column = %s", sample_id_column)
 p("Unique gene_id_column = %s", gene_id_column)
 
 p("Reading the design matrix")
+latch_stage_start("read inputs")
 tryCatch(
   {
     coldata <- read_tabular(arg_design_matrix) %>%
@@ -117,14 +114,12 @@ p("")
 
 tryCatch(
   {
-    cts <- read_tabular(arg_counts_table) %>%
-      select(all_of(gene_id_column) | any_of(samples)) %>%
-      mutate(
-        across(
-          !all_of(gene_id_column),
-          floor
-        )
-      )
+    if (dir.exists(arg_counts_table)) {
+      # already reduced to the design matrix samples and floored
+      cts <- read_ingested_counts(arg_counts_table)
+    } else {
+      cts <- read_counts_matrix(arg_counts_table, gene_id_column, samples)
+    }
   },
   error = function(err) {
     p("  Failed")
@@ -134,6 +129,8 @@ tryCatch(
   }
 )
 
+latch_stage_end("read inputs")
+
 p("Reading the counts table")
 dims <- dim(cts)
 p("Counts Table %s x %s: [head]", dims[1], dims[2])
@@ -161,24 +158,114 @@ tryCatch(
   }
 )
 
+cpuCores <- 1
+contrastWorkers <- 1
+tryCatch(
+  {
+    p("Reading compute resources")
+    if (!is.na(arg_cpu_cores) && arg_cpu_cores != "") {
+      cpuCores <- max(1L, as.integer(arg_cpu_cores))
+    } else {
+      cpuCores <- max(1L, get_num_cores())
+    }
+
+    if (!is.na(arg_contrast_workers) && arg_contrast_workers != "") {
+      contrastWorkers <- max(1L, as.integer(arg_contrast_workers))
+    }
+    contrastWorkers <- min(contrastWorkers, cpuCores)
+  },
+  error = function(err) {
+    p("  Failed")
+    p("%s", err)
+    latch_error(list(source = "compute resources", error = as.character(err)))
+    stop()
+  }
+)
+
+# the fit gets the whole machine, contrasts split it between their workers
+fit_bpparam <- make_bpparam(cpuCores)
+register(fit_bpparam)
+
+contrast_bpparam <- make_bpparam(contrastWorkers)
+results_workers <- max(1L, cpuCores %/% contrastWorkers)
+
+p("Compute resources:")
+p("  CPU cores: %s", cpuCores)
+p("  Fit worker pool: %s x %s", class(fit_bpparam)[[1]], bpnworkers(fit_bpparam))
+p("  Contrast worker pool: %s x %s", class(contrast_bpparam)[[1]], bpnworkers(contrast_bpparam))
+p("  Results workers per contrast: %s", results_workers)
+p("")
+
+contrastMode <- "symmetric"
+if (!is.na(arg_contrast_mode) && arg_contrast_mode != "") {
+  contrastMode <- arg_contrast_mode
+}
+if (!(contrastMode %in% c("symmetric", "full"))) {
+  p("Unknown contrast mode '%s'", contrastMode)
+  latch_error(list(source = "contrastMode", error = sprintf("Unknown contrast mode '%s'", contrastMode)))
+  stop()
+}
+
+plotFormat <- "both"
+if (!is.na(arg_plot_format) && arg_plot_format != "") {
+  plotFormat <- arg_plot_format
+}
+if (!(plotFormat %in% c("png", "html", "both", "none"))) {
+  p("Unknown plot format '%s'", plotFormat)
+  latch_error(list(source = "plotFormat", error = sprintf("Unknown plot format '%s'", plotFormat)))
+  stop()
+}
+renderPng <- plotFormat %in% c("png", "both")
+renderHtml <- plotFormat %in% c("html", "both")
+
+if (!is.na(arg_widget_deps) && arg_widget_deps != "") {
+  widget_deps_mode <- arg_widget_deps
+}
+if (!(widget_deps_mode %in% c("cdn", "offline"))) {
+  p("Unknown widget library mode '%s'", widget_deps_mode)
+  latch_error(list(source = "widget_deps_mode", error = sprintf("Unknown widget library mode '%s'", widget_deps_mode)))
+  stop()
+}
+widget_lib_dir <- op("Plots/lib")
+
+fitEngineMode <- "auto"
+if (!is.na(arg_fit_engine) && arg_fit_engine != "") {
+  fitEngineMode <- arg_fit_engine
+}
+if (!(fitEngineMode %in% c("auto", "standard", "glmGamPoi"))) {
+  p("Unknown fit engine '%s'", fitEngineMode)
+  latch_error(list(source = "fitEngine", error = sprintf("Unknown fit engine '%s'", fitEngineMode)))
+  stop()
+}
+
+# 0 draws every gene in the interactive MA and volcano plots
+maxPlotPoints <- 20000L
+if (!is.na(arg_max_points) && arg_max_points != "") {
+  maxPlotPoints <- max(0L, as.integer(arg_max_points))
+}
+
+latch_stage_start("size factor qc")
 tryCatch(
   {
     p("Plotting size factor QC")
-    plot <- degCheckFactors(cts %>% select(!all_of(gene_id_column))) +
+    plot <- degCheckFactors(cts) +
       labs(x = "Density", y = "Size Factor") +
       ggtitle("Gene Size Factor Distribution") +
       theme_minimal()
 
-    png(file = op("Plots/QC/Size Factor QC.png"), width = 960, height = 540)
-    print(plot)
-    dev.off()
+    if (renderPng) {
+      png(file = op("Plots/QC/Size Factor QC.png"), width = 960, height = 540)
+      print(plot)
+      dev.off()
+    }
 
-    plot$mapping$text <- plot$data$sample
-    plot$layers[[1]]$aes_params$size <- 0.1
-    plot %>%
-      ggplotly(tooltip = c("text")) %>%
-      partial_bundle(local = F) %>%
-      saveWidgetCDN(op("Plots/QC/Size Factor QC.html"))
+    if (renderHtml) {
+      plot$mapping$text <- plot$data$sample
+      plot$layers[[1]]$aes_params$size <- 0.1
+      plot %>%
+        ggplotly(tooltip = c("text")) %>%
+        saveWidgetShared(op("Plots/QC/Size Factor QC.html"))
+    }
     p("")
     p("")
   },
@@ -190,6 +277,7 @@ tryCatch(
     latch_warning(list(source = "size factor qc", error = as.character(err)))
   }
 )
+latch_stage_end("size factor qc")
 
 
 if (arg_explanatory_columns != "") {
@@ -280,10 +368,12 @@ tryCatch(
     print(coldata[[design_column]])
     p("")
 
+    if (!identical(colnames(cts), coldata[[sample_id_column]])) {
+      cts <- cts[, coldata[[sample_id_column]], drop = FALSE]
+    }
+
     ddsMat <- DESeqDataSetFromMatrix(
-      cts %>%
-        select(all_of(gene_id_column) | any_of(samples)) %>%
-        column_to_rownames(gene_id_column),
+      cts,
       coldata %>%
         column_to_rownames(sample_id_column),
       as.formula(design_formula)
@@ -299,41 +389,189 @@ tryCatch(
   }
 )
 
+# DESeq's own dispersion and GLM fits grow quickly with the number of samples,
+# glmGamPoi fits large cohorts in a fraction of the time and memory
+glmGamPoiMinSamples <- 100L
+
+fitEngine <- fitEngineMode
+if (fitEngineMode == "auto") {
+  fitEngine <- if (ncol(ddsMat) >= glmGamPoiMinSamples) "glmGamPoi" else "standard"
+}
+if (fitEngine == "glmGamPoi" && !requireNamespace("glmGamPoi", quietly = TRUE)) {
+  p("glmGamPoi is not installed, using the standard DESeq2 fit")
+  latch_warning(list(source = "fitEngine", error = "glmGamPoi is not installed, using the standard DESeq2 fit"))
+  fitEngine <- "standard"
+}
+p(
+  "Fit engine: %s (%s, %s genes x %s samples)",
+  fitEngine, fitEngineMode, nrow(ddsMat), ncol(ddsMat)
+)
+
+# the task places a previous fit in the output, either from the cache (same
+# inputs) or from the previous run of an incremental one (checked below)
+reuseFit <- !is.na(arg_reuse_fit) && arg_reuse_fit == "true"
+incremental <- !is.na(arg_incremental) && arg_incremental == "true"
+
+# a previous fit can be reused when it was made from the same counts, samples,
+# design formula variables, and fit engine
+fitCompatible <- function(dds, ddsMat) {
+  vars <- all.vars(design(ddsMat))
+  # fits from before the engine was recorded used the standard one
+  prevEngine <- S4Vectors::metadata(dds)$fit_engine
+  if (is.null(prevEngine)) {
+    prevEngine <- "standard"
+  }
+
+  identical(prevEngine, fitEngine) &&
+    identical(sort(all.vars(design(dds))), sort(vars)) &&
+    identical(dimnames(dds), dimnames(ddsMat)) &&
+    all(vars %in% colnames(colData(dds))) &&
+    identical(
+      as.data.frame(colData(dds))[, vars, drop = FALSE],
+      as.data.frame(colData(ddsMat))[, vars, drop = FALSE]
+    ) &&
+    identical(counts(dds), counts(ddsMat))
+}
+
+# Both transformations below fit the dispersion trend on a subsample of `nsub`
+# genes and then transform every gene with that trend, the way `vst` does.
+# `nsub` shrinks as the number of samples grows so the fit stays about
+# `vstCellBudget` counts. Both are blind to the design, so the QC plots do not
+# depend on which one ran
+vstMinGenes <- 50L
+vstMaxGenes <- 1000L
+vstCellBudget <- 200000L
+vstSubsampleSize <- function(candidates, samples) {
+  min(candidates, vstMaxGenes, max(vstMinGenes, vstCellBudget %/% samples))
+}
+
+# `vst` only samples genes with a mean normalized count over 5 and fails when
+# there are fewer than `nsub` of them. Without enough such genes this samples
+# every gene with a count and fits a single mean dispersion, which does not
+# need a trend across expression levels
+blindSubsampleTransform <- function(dds) {
+  blindDds <- dds
+  design(blindDds) <- ~1
+
+  baseMean <- rowMeans2(counts(blindDds, normalized = TRUE))
+  candidates <- which(baseMean > 0)
+  nsub <- vstSubsampleSize(length(candidates), ncol(blindDds))
+  if (nsub < 2) {
+    stop("fewer than 2 genes with a nonzero count")
+  }
+  p("  Fitting a mean dispersion on %s of %s genes", nsub, nrow(blindDds))
+
+  o <- candidates[order(baseMean[candidates])]
+  idx <- o[round(seq(from = 1, to = length(o), length.out = nsub))]
+  sub <- estimateDispersionsGeneEst(blindDds[idx, ], quiet = TRUE)
+  sub <- estimateDispersionsFit(sub, fitType = "mean", quiet = TRUE)
+  suppressMessages({
+    dispersionFunction(blindDds) <- dispersionFunction(sub)
+  })
+
+  varianceStabilizingTransformation(blindDds, blind = FALSE)
+}
+
+stabilizeVariance <- function(dds) {
+  expressed <- sum(rowMeans2(counts(dds, normalized = TRUE)) > 5)
+  nsub <- vstSubsampleSize(expressed, ncol(dds))
+  if (nsub >= vstMinGenes) {
+    p("  vst on %s of %s genes and %s samples", nsub, nrow(dds), ncol(dds))
+    res <- tryCatch(vst(dds, blind = TRUE, nsub = nsub), error = function(err) {
+      p("  vst failed: %s", conditionMessage(err))
+      NULL
+    })
+    if (!is.null(res)) {
+      return(res)
+    }
+  } else {
+    p("  Only %s genes with a mean normalized count over 5, skipping vst", expressed)
+  }
+
+  tryCatch(
+    {
+      p("  Variance stabilizing with a subsampled mean dispersion")
+      blindSubsampleTransform(dds)
+    },
+    error = function(err) {
+      p("  Failed: %s", conditionMessage(err))
+      p("  Falling back to log2(normalized counts + 1)")
+      latch_warning(list(source = "vst", error = "Variance stabilization failed, QC plots use log2 normalized counts"))
+      normTransform(dds)
+    }
+  )
+}
+
 p(">>><<<")
 p("Running DESeq2")
 tryCatch(
   {
-    dds <- DESeq(ddsMat)
-    # load("/Users/maximsmol/projects/latchbio/wf-core-deseq2/katja_dds.RData")
-    p("")
-    p("")
+    fitReused <- FALSE
+    if (reuseFit && file.exists(op("Data/dds.rds"))) {
+      dds <- readRDS(op("Data/dds.rds"))
+      fitReused <- fitCompatible(dds, ddsMat)
+
+      if (fitReused) {
+        p("Reusing the previous DDS")
+      } else {
+        p("Previous DDS does not match the design formula or the data, refitting")
+        latch_warning(list(source = "dds reuse", error = "Previous fit is not compatible, refitting"))
+
+        # results of the old fit must not end up next to the new ones
+        unlink(list.files(op("Data/Contrast"), full.names = TRUE))
+        unlink(list.files(op("Plots/Contrast"), full.names = TRUE), recursive = TRUE)
+        unlink(list.files(op("Plots/QC/Variance P-Value"), full.names = TRUE))
+        unlink(op("Data/vsd.rds"))
+      }
+    }
 
-    print("DDS")
-    print(dds)
-    p("")
-    p("")
-    p("Writing DDS")
-    saveRDS(dds, file = op("Data/dds.rds"))
-    p("")
+    if (!fitReused) {
+      latch_stage_start("fit")
+      if (fitEngine == "glmGamPoi") {
+        # glmGamPoi fits every gene in one process, BLAS gets all the cores
+        p("  BLAS threads: %s", set_blas_threads(cpuCores))
+        dds <- DESeq(ddsMat, fitType = "glmGamPoi")
+      } else {
+        p("  BLAS threads: %s", set_blas_threads(cpuCores, bpnworkers(fit_bpparam)))
+        dds <- DESeq(
+          ddsMat,
+          parallel = bpnworkers(fit_bpparam) > 1,
+          BPPARAM = fit_bpparam
+        )
+      }
+      S4Vectors::metadata(dds)$fit_engine <- fitEngine
+      latch_stage_end("fit")
+      # load("/Users/maximsmol/projects/latchbio/wf-core-deseq2/katja_dds.RData")
+      p("")
+      p("")
 
-    p("Variance Stabilization Transform DDS")
-    vsd <- tryCatch(
-             {
-              vst(dds)
-             },
-             error = function(err) {
-               p(" Failed naive vsd transform")
-               p(" Attempting raw varianceStabilizingTransformation")
-               return(varianceStabilizingTransformation(dds))
-             }
-           )
+      print("DDS")
+      print(dds)
+      p("")
+      p("")
+      p("Writing DDS")
+      save_rds_atomic(dds, file = op("Data/dds.rds"))
+      p("")
+    }
+
+    if (fitReused && file.exists(op("Data/vsd.rds"))) {
+      p("Reusing the previous vsd")
+      vsd <- readRDS(op("Data/vsd.rds"))
+    } else {
+      p("Variance Stabilization Transform DDS")
+      # vst has no BiocParallel hook, its matrix work goes through BLAS instead
+      p("  BLAS threads: %s", set_blas_threads(cpuCores))
+      latch_stage_start("vst")
+      vsd <- stabilizeVariance(dds)
+      latch_stage_end("vst")
+      print(vsd)
+      p("")
+      p("")
+      p("Writing vsd")
+      save_rds_atomic(vsd, file = op("Data/vsd.rds"))
+      p("")
+    }
     vsd_assay <- assay(vsd)
-    print(vsd)
-    p("")
-    p("")
-    p("Writing vsd")
-    saveRDS(vsd, file = op("Data/vsd.rds"))
-    p("")
   },
   error = function(err) {
     p("  Failed")
@@ -343,6 +581,13 @@ tryCatch(
   }
 )
 
+# incremental runs only produce outputs missing from the previous run
+skipExisting <- incremental && fitReused
+haveOutput <- function(x) {
+  skipExisting && file.exists(op(x))
+}
+
+latch_stage_start("pca")
 tryCatch(
   {
     p("Plotting Sample Level PCA")
@@ -354,6 +599,11 @@ tryCatch(
       design_column
     )
     for (name in names) {
+      if (haveOutput(sprintf("Plots/QC/PCA/%s.html", name))) {
+        p("  %s: already plotted", name)
+        next
+      }
+
       tryCatch(
         {
           pca_plot <- plotPCA(vsd, intgroup = name) +
@@ -364,19 +614,22 @@ tryCatch(
           pca_plot$layers[[1]]$aes_params$size <- 1.5
           pca_plot$labels$colour <- name
 
-          png(
-            file = op(sprintf("Plots/QC/PCA/%s.png", name)),
-            width = 960,
-            height = 540
-          )
-          print(pca_plot)
-          dev.off()
+          if (renderPng) {
+            png(
+              file = op(sprintf("Plots/QC/PCA/%s.png", name)),
+              width = 960,
+              height = 540
+            )
+            print(pca_plot)
+            dev.off()
+          }
 
-          pca_plot %>%
-            ggplotly(tooltip = c("text")) %>%
-            plotly_style() %>%
-            partial_bundle(local = F) %>%
-            saveWidgetCDN(op(sprintf("Plots/QC/PCA/%s.html", name)))
+          if (renderHtml) {
+            pca_plot %>%
+              ggplotly(tooltip = c("text")) %>%
+              plotly_style() %>%
+              saveWidgetShared(op(sprintf("Plots/QC/PCA/%s.html", name)))
+          }
         },
         error = function(err) {
           p("  %s: failed", name)
@@ -396,143 +649,331 @@ tryCatch(
     latch_warning(list(source = "pca plot outer loop", error = as.character(err)))
   }
 )
+latch_stage_end("pca")
 
 
-tryCatch(
-  {
-    p("Plotting sample correlation QC")
-
-    vsd_cor <- cor(vsd_assay)
-    write.csv(vsd_cor, file = op("Data/Sample Correlation.csv"))
-
-    min_cor <- min(vsd_cor)
-    max_cor <- max(vsd_cor)
-
-    heatmaply(
-      vsd_cor,
-      fontsize_row = 7,
-      fontsize_col = 7,
-      column_text_angle = 60,
-      scale_fill_gradient_fun = scale_fill_gradient2(
-        low = "#20B0E8",
-        mid = "#FAFBFC",
-        high = "#E84520",
-        midpoint = min_cor + (max_cor - min_cor) / 2
-      ),
-      label_names = c("Sample 1", "Sample 2", "Correlation"),
-      # dendrogram = "none", # todo(maximsmol): allow switching this
-    ) %>%
-      plotly_style() %>%
-      partial_bundle(local = F) %>%
-      saveWidgetCDN(op("Plots/Sample Correlation.html"))
-  },
-  error = function(err) {
-    p("  Failed")
-    p("%s", err)
-    p("")
-    p("")
-    latch_warning(list(source = "sample correlation qc", error = as.character(err)))
-  }
-)
-
-tryCatch(
-  {
-    p("Plotting heat map of the count matrix")
-
-    p("  Finding the top 100 most expressed genes")
-    sorted_vsd_assay <- vsd_assay %>%
-      as_tibble(rownames = "gene_id") %>%
-      rowwise() %>%
-      mutate(
-        max = max(across(!all_of("gene_id")))
-      ) %>%
-      ungroup() %>%
-      slice_max(max, n = 100, with_ties = FALSE)
-
-    p("  Computing Z scores")
-    sorted_vsd_assay <- sorted_vsd_assay %>%
-      select(!max) %>%
-      rowwise() %>%
-      mutate(
-        mean = rowMeans(across(!all_of("gene_id"))),
-        sd = sd(across(!all_of("gene_id")))
-      ) %>%
-      mutate(
-        across(!all_of(c("gene_id", "mean", "sd")), ~ (.x - mean) / sd)
-      ) %>%
-      ungroup() %>%
-      select(!all_of(c("mean", "sd"))) %>%
-      na.omit() %>%
-      column_to_rownames("gene_id")
-
-    p("  Saving results")
-    write.csv(sorted_vsd_assay, file = op("Data/Counts Heatmap.csv"))
-
-    p("  Saving plot")
-    plot <- heatmaply(
-      sorted_vsd_assay,
-      fontsize_row = 7,
-      fontsize_col = 7,
-      column_text_angle = 60,
-      scale_fill_gradient_fun = heatmap_colorscheme_around0,
-      label_names = c("Gene", "Sample", "Count Z-Score"),
-      # dendrogram = "none", # todo(maximsmol): allow switching this
-    ) %>%
-      plotly_style() %>%
-      partial_bundle(local = F) %>%
-      saveWidgetCDN(op("Plots/QC/Counts Heatmap.html"))
-
-    p("  Repeating for genes of interest")
-    if (length(genesOfInterest) > 0) {
-      sorted_vsd_assay <- vsd_assay[rownames(vsd_assay) %in% genesOfInterest] %>%
-        as_tibble(rownames = "gene_id")
-
-      sorted_vsd_assay <- sorted_vsd_assay %>%
-        slice(1:100) %>%
-        rowwise() %>%
-        mutate(
-          mean = rowMeans(across(!all_of("gene_id"))),
-          sd = sd(across(!all_of("gene_id")))
+latch_stage_start("sample correlation")
+if (haveOutput("Plots/Sample Correlation.html")) {
+  p("Sample correlation QC already plotted")
+} else {
+  tryCatch(
+    {
+      p("Plotting sample correlation QC")
+
+      vsd_cor <- cor(vsd_assay)
+      write.csv(vsd_cor, file = op("Data/Sample Correlation.csv"))
+
+      min_cor <- min(vsd_cor)
+      max_cor <- max(vsd_cor)
+
+      if (renderHtml) {
+        heatmaply(
+          vsd_cor,
+          fontsize_row = 7,
+          fontsize_col = 7,
+          column_text_angle = 60,
+          scale_fill_gradient_fun = scale_fill_gradient2(
+            low = "#20B0E8",
+            mid = "#FAFBFC",
+            high = "#E84520",
+            midpoint = min_cor + (max_cor - min_cor) / 2
+          ),
+          label_names = c("Sample 1", "Sample 2", "Correlation"),
+          # dendrogram = "none", # todo(maximsmol): allow switching this
         ) %>%
-        mutate(
-          across(!all_of(c("gene_id", "mean", "sd")), ~ (.x - mean) / sd)
+          plotly_style() %>%
+          saveWidgetShared(op("Plots/Sample Correlation.html"))
+      }
+    },
+    error = function(err) {
+      p("  Failed")
+      p("%s", err)
+      p("")
+      p("")
+      latch_warning(list(source = "sample correlation qc", error = as.character(err)))
+    }
+  )
+}
+latch_stage_end("sample correlation")
+
+latch_stage_start("counts heatmap")
+if (haveOutput("Plots/QC/Counts Heatmap.html")) {
+  p("Count matrix heat map already plotted")
+} else {
+  tryCatch(
+    {
+      p("Plotting heat map of the count matrix")
+
+      p("  Computing row statistics")
+      vsd_stats <- qc_row_stats(vsd_assay)
+
+      p("  Finding the top 100 most expressed genes")
+      top_idx <- top_n_idx(vsd_stats$max, 100)
+
+      p("  Computing Z scores")
+      sorted_vsd_assay <- qc_row_z_scores(vsd_assay, vsd_stats, top_idx)
+
+      p("  Saving results")
+      write.csv(sorted_vsd_assay, file = op("Data/Counts Heatmap.csv"))
+
+      p("  Saving plot")
+      if (renderHtml) {
+        plot <- heatmaply(
+          sorted_vsd_assay,
+          fontsize_row = 7,
+          fontsize_col = 7,
+          column_text_angle = 60,
+          scale_fill_gradient_fun = heatmap_colorscheme_around0,
+          label_names = c("Gene", "Sample", "Count Z-Score"),
+          # dendrogram = "none", # todo(maximsmol): allow switching this
         ) %>%
-        ungroup() %>%
-        select(!all_of(c("mean", "sd"))) %>%
-        na.omit() %>%
-        column_to_rownames("gene_id")
-
-      plot <- heatmaply(
-        sorted_vsd_assay,
-        fontsize_row = 7,
-        fontsize_col = 7,
-        column_text_angle = 60,
-        scale_fill_gradient_fun = heatmap_colorscheme_around0,
-        label_names = c("Sample", "Gene", "Count Z-Score"),
-        # todo(maximsmol): style these, and change colors
-        # dendrogram = "none", # todo(maximsmol): allow switching this
-      ) %>%
-        plotly_style() %>%
-        partial_bundle(local = F) %>%
-        saveWidgetCDN(op("Plots/Counts Heatmap (Genes of Interest).html"))
-
-      write.csv(sorted_vsd_assay, file = op("Data/Counts Heatmap (Genes of Interest).csv"))
+          plotly_style() %>%
+          saveWidgetShared(op("Plots/QC/Counts Heatmap.html"))
+      }
+
+      p("  Repeating for genes of interest")
+      if (length(genesOfInterest) > 0) {
+        goi_idx <- head(which(rownames(vsd_assay) %in% genesOfInterest), 100)
+        sorted_vsd_assay <- qc_row_z_scores(vsd_assay, vsd_stats, goi_idx)
+
+        if (renderHtml) {
+          plot <- heatmaply(
+            sorted_vsd_assay,
+            fontsize_row = 7,
+            fontsize_col = 7,
+            column_text_angle = 60,
+            scale_fill_gradient_fun = heatmap_colorscheme_around0,
+            label_names = c("Sample", "Gene", "Count Z-Score"),
+            # todo(maximsmol): style these, and change colors
+            # dendrogram = "none", # todo(maximsmol): allow switching this
+          ) %>%
+            plotly_style() %>%
+            saveWidgetShared(op("Plots/Counts Heatmap (Genes of Interest).html"))
+        }
+
+        write.csv(sorted_vsd_assay, file = op("Data/Counts Heatmap (Genes of Interest).csv"))
+      }
+    },
+    error = function(err) {
+      p("  Failed")
+      p("%s", err)
+      p("")
+      p("")
+      latch_warning(list(source = "count matrix heatmap", error = as.character(err)))
     }
-  },
-  error = function(err) {
-    p("  Failed")
-    p("%s", err)
-    p("")
-    p("")
-    latch_warning(list(source = "count matrix heatmap", error = as.character(err)))
+  )
+}
+latch_stage_end("counts heatmap")
+
+# "B vs A" is the same Wald test as "A vs B" with the sign of the fold change
+# (and of the test statistic) flipped; the ashr prior is symmetric around zero
+# so the same holds for the shrunken estimates
+mirrorResults <- function(res) {
+  res$log2FoldChange <- -res$log2FoldChange
+  if (!is.null(res$stat)) {
+    res$stat <- -res$stat
   }
-)
+  res
+}
+
+contrastName <- function(column_name, l1, l2) {
+  sprintf(
+    "%s vs %s (%s)",
+    str_replace_all(l1, "/", "_"),
+    str_replace_all(l2, "/", "_"),
+    column_name
+  )
+}
+
+# Plots are rendered in a separate stage after all statistics are done. Each
+# contrast leaves its plot-ready results here
+render_dir <- tempfile("render_")
+dir.create(render_dir, showWarnings = FALSE)
+
+renderContrastPlots <- function(column_name, l1, l2, res, lfc, qc_source = NULL) {
+  g1 <- str_replace_all(l1, "/", "_")
+  g2 <- str_replace_all(l2, "/", "_")
+  full <- contrastName(column_name, l1, l2)
+  qc_path <- op(sprintf("Plots/QC/Variance P-Value/%s.png", full))
+
+  latch_stage_start("render contrast", full)
+  tryCatch(
+    {
+      p("Generating QC, MA, and Volcano Plot for %s vs %s", g1, g2)
+
+      dir.create(op(sprintf("Plots/Contrast/%s/", full)), showWarnings = FALSE)
+
+      if (renderPng) {
+        tryCatch(
+          {
+            p("Plotting Sample Variance and P Value Distribution")
+            if (!is.null(qc_source) && file.exists(qc_source)) {
+              # the p-values do not depend on the direction of the contrast
+              file.copy(qc_source, qc_path, overwrite = TRUE)
+            } else {
+              res_df <- as.data.frame(res)
+              pvalue <- res_df[["pvalue"]]
+              png(file = qc_path, width = 960, height = 540)
+              print(degQC(counts(dds, normalized = TRUE), names(colData(dds)), pvalue = pvalue))
+              dev.off()
+            }
+            p("")
+            p("")
+          },
+          error = function(err) {
+            p("  Failed")
+            p("%s", err)
+            p("")
+            p("")
+            latch_warning(list(source = "variance pvalue qc", error = as.character(err)))
+          }
+        )
+
+        png(file = op(sprintf("Plots/Contrast/%s/MA.png", full)), width = 960, height = 540)
+        ma_plot <- plotMA(lfc, ylim = c(-2, 2), main = paste(g1, g2, sep = " vs "))
+        print(ma_plot)
+        dev.off()
+
+        if (length(genesOfInterest) > 0) {
+          whichLabels <- genesOfInterest
+          voc1 <- EnhancedVolcano(
+            lfc,
+            lab = rownames(lfc),
+            selectLab = whichLabels,
+            drawConnectors = TRUE,
+            x = "log2FoldChange",
+            y = "padj",
+            title = sprintf("%s Target Genes", full),
+            subtitle = "",
+            legendPosition = "none",
+            widthConnectors = 0.5,
+          )
+          png(file = op(sprintf("Plots/Contrast/%s/Volcano (Genes of Interest).png", full)), width = 960, height = 540)
+          print(voc1)
+          dev.off()
+        }
+
+        voc2 <- EnhancedVolcano(
+          lfc,
+          lab = rownames(lfc),
+          drawConnectors = TRUE,
+          x = "log2FoldChange",
+          y = "padj",
+          title = sprintf("%s vs %s", g1, g2),
+          subtitle = "",
+          legendPosition = "none",
+          widthConnectors = 0.5,
+        )
+        png(file = op(sprintf("Plots/Contrast/%s/Volcano.png", full)), width = 960, height = 540)
+        print(voc2)
+        dev.off()
+      }
+
+      if (renderHtml) {
+        plotMAPlotly(lfc, full, max_points = maxPlotPoints) %>%
+          saveWidgetShared(op(sprintf("Plots/Contrast/%s/MA.html", full)))
+
+        plotVolcanoPlotly(lfc, sprintf("%s vs %s", g1, g2), max_points = maxPlotPoints) %>%
+          saveWidgetShared(op(sprintf("Plots/Contrast/%s/Volcano.html", full)))
+      }
+    },
+    error = function(err) {
+      p("  %s Failed", full)
+      p("%s", err)
+      p("")
+      p("")
+      latch_warning(list(source = "volcano plot", error = as.character(err)))
+    }
+  )
+  latch_stage_end("render contrast", full)
+
+  qc_path
+}
+
+renderContrast <- function(job_path) {
+  tryCatch(
+    {
+      job <- readRDS(job_path)
+      qc_path <- renderContrastPlots(job$column_name, job$l1, job$l2, job$res, job$lfc)
+      if (job$mirror) {
+        renderContrastPlots(
+          job$column_name, job$l2, job$l1,
+          mirrorResults(job$res), mirrorResults(job$lfc),
+          qc_source = qc_path
+        )
+      }
+      unlink(job_path)
+    },
+    error = function(err) {
+      p("  %s Failed", job_path)
+      p("%s", err)
+      p("")
+      p("")
+      latch_warning(list(source = "contrast plot rendering", error = as.character(err)))
+    }
+  )
+
+  invisible(NULL)
+}
+
+computeContrast <- function(column_name, l1, l2, mirror = FALSE) {
+  full <- contrastName(column_name, l1, l2)
+
+  tryCatch(
+    {
+      p("Computing %s", full)
+      latch_stage_start("results", full)
+      res <- results(
+        dds,
+        contrast = c(column_name, l1, l2),
+        parallel = results_workers > 1,
+        BPPARAM = make_bpparam(results_workers)
+      )
+      latch_stage_end("results", full)
+
+      latch_stage_start("lfcShrink", full)
+      lfc <- lfcShrink(dds, res = res, type = "ashr")
+      latch_stage_end("lfcShrink", full)
+
+      write.csv(as.data.frame(res), file = op(sprintf("Data/Contrast/%s.csv", full)))
+      if (mirror) {
+        write.csv(
+          as.data.frame(mirrorResults(res)),
+          file = op(sprintf("Data/Contrast/%s.csv", contrastName(column_name, l2, l1)))
+        )
+      }
+
+      if (plotFormat == "none") {
+        return(NULL)
+      }
+
+      job_path <- tempfile(pattern = "contrast_", tmpdir = render_dir, fileext = ".rds")
+      saveRDS(
+        list(column_name = column_name, l1 = l1, l2 = l2, res = res, lfc = lfc, mirror = mirror),
+        file = job_path,
+        compress = FALSE
+      )
+      job_path
+    },
+    error = function(err) {
+      p("  %s Failed", full)
+      p("%s", err)
+      p("")
+      p("")
+      latch_warning(list(source = "contrast", error = as.character(err)))
+      NULL
+    }
+  )
+}
 
 plotVolcano <- function(column_name) {
   tryCatch(
     {
       ls <- levels(coldata[[column_name]])
 
+      mirror <- contrastMode == "symmetric"
+
+      contrasts <- list()
       for (i in 1:length(ls)) {
         l1 <- ls[[i]]
         for (j in 1:length(ls)) {
@@ -540,6 +981,10 @@ plotVolcano <- function(column_name) {
           if (l1 == l2) {
             next
           }
+          # the mirrored contrast is derived from this one
+          if (mirror && j < i) {
+            next
+          }
 
           cluster1 <- str_split(l1, "__")[[1]]
           cluster2 <- str_split(l2, "__")[[1]]
@@ -556,96 +1001,26 @@ plotVolcano <- function(column_name) {
             next
           }
 
-          tryCatch(
-            {
-              full <- sprintf("%s vs %s (%s)", g1, g2, column_name)
-              p("Generating QC, MA, and Volcano Plot for %s vs %s", g1, g2)
-
-              res <- results(dds, contrast = c(column_name, l1, l2))
-
-              write.csv(as.data.frame(res), file = op(sprintf("Data/Contrast/%s.csv", full)))
-
-              dir.create(op(sprintf("Plots/Contrast/%s/", full)))
-
-              lfc <- lfcShrink(dds, res = res, type = "ashr")
-
-              tryCatch(
-                {
-                  p("Plotting Sample Variance and P Value Distribution")
-                  res_df <- as.data.frame(res)
-                  pvalue <- res_df[["pvalue"]]
-                  png(file = op(sprintf("Plots/QC/Variance P-Value/%s.png", full)), width = 960, height = 540)
-                  print(degQC(counts(dds, normalized = TRUE), names(colData(dds)), pvalue = pvalue))
-                  dev.off()
-                  p("")
-                  p("")
-                },
-                error = function(err) {
-                  p("  Failed")
-                  p("%s", err)
-                  p("")
-                  p("")
-                  latch_warning(list(source = "variance pvalue qc", error = as.character(err)))
-                }
-              )
-
-              png(file = op(sprintf("Plots/Contrast/%s/MA.png", full)), width = 960, height = 540)
-              ma_plot <- plotMA(lfc, ylim = c(-2, 2), main = paste(g1, g2, sep = " vs "))
-              print(ma_plot)
-              dev.off()
-
-              plotMAPlotly(lfc, full) %>%
-                partial_bundle(local = F) %>%
-                saveWidgetCDN(op(sprintf("Plots/Contrast/%s/MA.html", full)))
-
-              if (length(genesOfInterest) > 0) {
-                whichLabels <- genesOfInterest
-                voc1 <- EnhancedVolcano(
-                  lfc,
-                  lab = rownames(lfc),
-                  selectLab = whichLabels,
-                  drawConnectors = TRUE,
-                  x = "log2FoldChange",
-                  y = "padj",
-                  title = sprintf("%s Target Genes", full),
-                  subtitle = "",
-                  legendPosition = "none",
-                  widthConnectors = 0.5,
-                )
-                png(file = op(sprintf("Plots/Contrast/%s/Volcano (Genes of Interest).png", full)), width = 960, height = 540)
-                print(voc1)
-                dev.off()
-              }
-
-              voc2 <- EnhancedVolcano(
-                lfc,
-                lab = rownames(lfc),
-                drawConnectors = TRUE,
-                x = "log2FoldChange",
-                y = "padj",
-                title = sprintf("%s vs %s", g1, g2),
-                subtitle = "",
-                legendPosition = "none",
-                widthConnectors = 0.5,
-              )
-              png(file = op(sprintf("Plots/Contrast/%s/Volcano.png", full)), width = 960, height = 540)
-              print(voc2)
-              dev.off()
+          full1 <- sprintf("Data/Contrast/%s vs %s (%s).csv", g1, g2, column_name)
+          full2 <- sprintf("Data/Contrast/%s vs %s (%s).csv", g2, g1, column_name)
+          if (haveOutput(full1) && (!mirror || haveOutput(full2))) {
+            next
+          }
 
-              plotVolcanoPlotly(lfc, sprintf("%s vs %s", g1, g2)) %>%
-                partial_bundle(local = F) %>%
-                saveWidgetCDN(op(sprintf("Plots/Contrast/%s/Volcano.html", full)))
-            },
-            error = function(err) {
-              p("  %s Failed", full)
-              p("%s", err)
-              p("")
-              p("")
-              latch_warning(list(source = "volcano plot", error = as.character(err)))
-            }
-          )
+          contrasts[[length(contrasts) + 1]] <- c(l1, l2)
         }
       }
+
+      p("Running %s contrasts for %s", length(contrasts), column_name)
+      set_blas_threads(cpuCores, bpnworkers(contrast_bpparam) * results_workers)
+      # each contrast catches its own errors so a failing pair does not take
+      # down the rest of the pool
+      jobs <- bplapply(
+        contrasts,
+        function(x) computeContrast(column_name, x[[1]], x[[2]], mirror = mirror),
+        BPPARAM = contrast_bpparam
+      )
+      unlist(jobs)
     },
     error = function(err) {
       p("  Failed")
@@ -653,14 +1028,28 @@ plotVolcano <- function(column_name) {
       p("")
       p("")
       latch_warning(list(source = "volcano and ma plot generation", error = as.character(err)))
+      character(0)
     }
   )
 }
 
-plotVolcano(design_column)
-
+latch_stage_start("contrasts")
+render_jobs <- plotVolcano(design_column)
 for (x in confounding_columns) {
-  plotVolcano(x)
+  render_jobs <- c(render_jobs, plotVolcano(x))
+}
+latch_stage_end("contrasts")
+
+if (length(render_jobs) > 0) {
+  # rendering is single threaded, so every core gets its own worker
+  render_bpparam <- make_bpparam(min(cpuCores, length(render_jobs)))
+  p("Rendering %s contrast plots (%s)", length(render_jobs), plotFormat)
+  p("  Render worker pool: %s x %s", class(render_bpparam)[[1]], bpnworkers(render_bpparam))
+  set_blas_threads(cpuCores, bpnworkers(render_bpparam))
+  latch_stage_start("render")
+  bplapply(render_jobs, renderContrast, BPPARAM = render_bpparam)
+  latch_stage_end("render")
 }
+unlink(render_dir, recursive = TRUE)
 
 quit(status = 0)
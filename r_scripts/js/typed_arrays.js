@@ -0,0 +1,53 @@
+// Decodes `{dtype: "f4", bdata: <base64>}` arrays written by
+// `typed_array_widget` in plotly_util.r into Float32Arrays before the plotly
+// binding renders the widget
+(function () {
+  function decode(v) {
+    var bin = window.atob(v.bdata);
+    var bytes = new Uint8Array(bin.length);
+    for (var i = 0; i < bin.length; ++i) {
+      bytes[i] = bin.charCodeAt(i);
+    }
+    return new Float32Array(bytes.buffer);
+  }
+
+  function isEncoded(v) {
+    return (
+      v !== null &&
+      typeof v === "object" &&
+      v.dtype === "f4" &&
+      typeof v.bdata === "string"
+    );
+  }
+
+  function decodeAll(obj) {
+    if (obj === null || typeof obj !== "object") {
+      return;
+    }
+    for (var k in obj) {
+      if (!Object.prototype.hasOwnProperty.call(obj, k)) {
+        continue;
+      }
+      if (isEncoded(obj[k])) {
+        obj[k] = decode(obj[k]);
+      } else {
+        decodeAll(obj[k]);
+      }
+    }
+  }
+
+  var bindings = (window.HTMLWidgets && window.HTMLWidgets.widgets) || [];
+  for (var i = 0; i < bindings.length; ++i) {
+    var binding = bindings[i];
+    if (binding.name !== "plotly" || binding._typedArraysPatched) {
+      continue;
+    }
+
+    var renderValue = binding.renderValue;
+    binding.renderValue = function (el, x, instance) {
+      decodeAll(x.data);
+      return renderValue.call(this, el, x, instance);
+    };
+    binding._typedArraysPatched = true;
+  }
+})();
@@ -1,13 +1,35 @@
 library(rjson)
 
+# Forked contrast workers share stdout, so every message goes out as a single
+# write with its newline. `p` writes the newline separately, which lets two
+# workers' messages run together on one line
 latch_message <- function(type, data) {
-  p("__LATCH_MESSAGE_DATA %s %s", type, toJSON(data))
+  cat(paste0("__LATCH_MESSAGE_DATA ", type, " ", toJSON(data), "\n"))
+  flush(stdout())
 }
 
 latch_warning <- function(data) {
-  p("__LATCH_MESSAGE_DATA error %s", toJSON(data))
+  latch_message("error", data)
 }
 
 latch_error <- function(data) {
-  p("__LATCH_MESSAGE_DATA error %s", toJSON(data))
+  latch_message("error", data)
+}
+
+# Start/end events of a stage, collected by the task into Data/QC/timings.json.
+# `id` tells apart stages of the same name that run at the same time
+latch_stage <- function(stage, event, id = NULL) {
+  data <- list(stage = stage, event = event, time = as.numeric(Sys.time()))
+  if (!is.null(id)) {
+    data$id <- id
+  }
+  latch_message("stage", data)
+}
+
+latch_stage_start <- function(stage, id = NULL) {
+  latch_stage(stage, "start", id)
+}
+
+latch_stage_end <- function(stage, id = NULL) {
+  latch_stage(stage, "end", id)
 }
@@ -0,0 +1,31 @@
+# Packages used by deseq2.r. The R worker (worker.r) loads them once up front,
+# after which loading them again for every job is a no-op
+tryCatch(
+  {
+    suppressMessages(suppressWarnings(library(vctrs)))
+    suppressMessages(suppressWarnings(library(dplyr)))
+    suppressMessages(suppressWarnings(library(tibble)))
+    suppressMessages(suppressWarnings(library(stringr)))
+
+    suppressMessages(suppressWarnings(library(DEGreport)))
+    suppressMessages(suppressWarnings(library(DESeq2)))
+    suppressMessages(suppressWarnings(library(BiocParallel)))
+    suppressMessages(suppressWarnings(library(RhpcBLASctl)))
+
+    suppressMessages(suppressWarnings(library(ggplot2)))
+    suppressMessages(suppressWarnings(library(EnhancedVolcano)))
+    suppressMessages(suppressWarnings(library(heatmaply)))
+    suppressMessages(suppressWarnings(library(plotly)))
+
+    suppressMessages(suppressWarnings(library(purrr)))
+    suppressMessages(suppressWarnings(
+      library(data.table)
+    ))
+  },
+  error = function(err) {
+    p("  Failed")
+    p("%s", err)
+    latch_error(list(source = "imports", error = as.character(err)))
+    stop()
+  }
+)
@@ -1,10 +1,18 @@
-plotMAPlotly <- function(lfc, title) {
+plotMAPlotly <- function(lfc, title, max_points = NA) {
   no_na <- na.omit(lfc$padj)
   maxpadj <- max(-log10(no_na))
   minpadj <- min(-log10(no_na))
 
   col_tres <- (-log10(0.1) - minpadj) / (maxpadj - minpadj)
 
+  # significant genes are always drawn
+  lfc <- lfc[decimate_idx(
+    log10(lfc$baseMean),
+    lfc$log2FoldChange,
+    !is.na(lfc$padj) & lfc$padj <= 0.1,
+    max_points
+  ), ]
+
   p <- ggplot(as.data.frame(lfc), aes(
     x = log10(baseMean),
     y = log2FoldChange,
@@ -53,5 +61,6 @@ plotMAPlotly <- function(lfc, title) {
         range = c(-2, 2)
       )
     ) %>%
-    toWebGL()
+    toWebGL() %>%
+    typed_array_widget()
 }
@@ -0,0 +1,19 @@
+library(BiocParallel)
+library(RhpcBLASctl)
+
+make_bpparam <- function(workers) {
+  if (workers > 1) {
+    MulticoreParam(workers = workers)
+  } else {
+    SerialParam()
+  }
+}
+
+# BLAS and OpenMP threads are per process, so when `workers` forked processes
+# run at once each of them only gets its share of the cores
+set_blas_threads <- function(cores, workers = 1) {
+  threads <- max(1L, as.integer(cores %/% workers))
+  blas_set_num_threads(threads)
+  omp_set_num_threads(threads)
+  threads
+}
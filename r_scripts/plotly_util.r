@@ -12,43 +12,104 @@ cdn_packages <- list(
   htmlwidgets = "htmlwidgets-1.5.4/"
 ) %>% map(~ paste0(cdn_base_url, .x))
 
-# >>> Monkey-patch htmlwidgets
-htmlwidgets <- getNamespace("htmlwidgets")
-old_html_widgets_getDependency <- htmlwidgets::getDependency
+# "cdn" loads the common widget libraries from `cdn_base_url` and the plotly
+# bundle from the plotly CDN. "offline" serves every library from
+# `widget_lib_dir` so the plots open without network access
+widget_deps_mode <- "cdn"
+# every widget shares this one copy of its libraries
+widget_lib_dir <- NULL
+# directory of the widget being saved, for relative library links
+widget_html_dir <- NULL
 
-unlockBinding("getDependency", htmlwidgets)
-htmlwidgets$getDependency <- function(name, package = name) {
-  map(old_html_widgets_getDependency(name, package), function(x) {
-    h <- cdn_packages[[x$name]]
-    if (is.null(h)) {
-      return(x)
-    }
+relative_path <- function(target, from) {
+  t <- strsplit(normalizePath(target, "/"), "/", fixed = TRUE)[[1]]
+  f <- strsplit(normalizePath(from, "/"), "/", fixed = TRUE)[[1]]
 
-    x$src$href <- h
-    x$src$file <- NULL
+  n <- 0
+  while (n < min(length(t), length(f)) && t[[n + 1]] == f[[n + 1]]) {
+    n <- n + 1
+  }
 
-    x
-  })
+  paste(c(rep("..", length(f) - n), t[-seq_len(n)]), collapse = "/")
 }
-lockBinding("getDependency", htmlwidgets)
-# >>>
 
-saveWidgetCDN <- function(plot, file) {
-  plot$dependencies <- map(plot$dependencies, function(x) {
-    if (is.null(x$src$file)) {
-      return(x)
-    }
+# Copies a library into `lib_dir` unless it is already there. The copy goes to
+# a private directory first and is renamed into place, so widgets saved in
+# parallel never see a partial library or delete one another's
+share_dependency <- function(x, lib_dir) {
+  target <- file.path(lib_dir, paste(x$name, x$version, sep = "-"))
+
+  if (!dir.exists(target)) {
+    dir.create(lib_dir, showWarnings = FALSE, recursive = TRUE)
+    tmp <- tempfile(".tmp", tmpdir = lib_dir)
+    dir.create(tmp)
+    copied <- htmltools::copyDependencyToDir(x, tmp, FALSE)
+    # fails if another process got there first, its copy is just as good
+    suppressWarnings(file.rename(copied$src$file, target))
+    unlink(tmp, recursive = TRUE)
+  }
+
+  x
+}
 
+widget_dependency <- function(x) {
+  if (is.null(x$src$file)) {
+    return(x)
+  }
+
+  if (widget_deps_mode != "offline") {
     h <- cdn_packages[[x$name]]
-    if (is.null(h)) {
+    if (!is.null(h)) {
+      x$src$href <- h
+      x$src$file <- NULL
       return(x)
     }
+  }
 
-    x$src$href <- h
-    x$src$file <- NULL
+  if (is.null(widget_lib_dir) || is.null(widget_html_dir)) {
+    return(x)
+  }
 
-    x
-  })
+  share_dependency(x, widget_lib_dir)
+  x$src <- list(href = relative_path(
+    file.path(widget_lib_dir, paste(x$name, x$version, sep = "-")),
+    widget_html_dir
+  ))
+  x$package <- NULL
+  x
+}
+
+# >>> Monkey-patch htmlwidgets
+# The R worker sources this file once per job while the namespace keeps the
+# patch, so the original function is kept on the patched one and the patch
+# never wraps itself
+local({
+  htmlwidgets <- getNamespace("htmlwidgets")
+  original <- attr(htmlwidgets$getDependency, "original")
+  if (is.null(original)) {
+    original <- htmlwidgets$getDependency
+  }
+
+  patched <- function(name, package = name) {
+    map(original(name, package), widget_dependency)
+  }
+  attr(patched, "original") <- original
+
+  unlockBinding("getDependency", htmlwidgets)
+  htmlwidgets$getDependency <- patched
+  lockBinding("getDependency", htmlwidgets)
+})
+# >>>
+
+saveWidgetShared <- function(plot, file) {
+  if (widget_deps_mode != "offline") {
+    plot <- partial_bundle(plot, local = F)
+  }
+
+  widget_html_dir <<- normalizePath(dirname(file), "/")
+  on.exit(widget_html_dir <<- NULL, add = TRUE)
+
+  plot$dependencies <- map(plot$dependencies, widget_dependency)
 
   saveWidget(plot, file, selfcontained = FALSE)
 }
@@ -64,3 +125,106 @@ plotly_style <- function(p) {
     )
   ))
 }
+
+# Indices of the points to draw when a scatter plot has more than `max_points`
+# points. Points in `keep` (e.g. significant genes) are always drawn, the rest
+# are thinned to one point per cell of the finest grid that fits the budget,
+# so dense regions lose points while outliers survive
+decimate_idx <- function(x, y, keep, max_points) {
+  n <- length(x)
+  if (is.na(max_points) || max_points <= 0 || n <= max_points) {
+    return(seq_len(n))
+  }
+
+  keep <- !is.na(keep) & keep
+  kept <- which(keep)
+  rest <- which(!keep & is.finite(x) & is.finite(y))
+  budget <- max_points - length(kept)
+  if (budget <= 0 || length(rest) == 0) {
+    return(kept)
+  }
+  if (length(rest) <= budget) {
+    return(sort(c(kept, rest)))
+  }
+
+  rx <- x[rest]
+  ry <- y[rest]
+  cell_of <- function(v, bins) {
+    lo <- min(v)
+    span <- max(v) - lo
+    if (span == 0) {
+      return(integer(length(v)))
+    }
+    pmin(as.integer((v - lo) / span * bins), bins - 1L)
+  }
+  representatives <- function(bins) {
+    rest[!duplicated(cell_of(rx, bins) * bins + cell_of(ry, bins))]
+  }
+
+  # more bins keep more points, find the most that still fit the budget
+  lo <- 1L
+  hi <- as.integer(ceiling(sqrt(length(rest))))
+  best <- representatives(lo)
+  while (lo < hi) {
+    mid <- (lo + hi + 1L) %/% 2L
+    candidate <- representatives(mid)
+    if (length(candidate) <= budget) {
+      lo <- mid
+      best <- candidate
+    } else {
+      hi <- mid - 1L
+    }
+  }
+
+  sort(c(kept, best))
+}
+
+# inlined so that widgets embedded in the report on their own still decode
+typed_array_dependency <- htmltools::htmlDependency(
+  name = "plotly-typed-arrays",
+  version = "1.0.0",
+  src = c(href = ""),
+  head = paste0(
+    "<script>",
+    paste(readLines("js/typed_arrays.js"), collapse = "\n"),
+    "</script>"
+  )
+)
+
+encode_f4 <- function(v) {
+  list(
+    dtype = "f4",
+    bdata = jsonlite::base64_enc(writeBin(as.numeric(v), raw(), size = 4, endian = "little"))
+  )
+}
+
+encode_typed_arrays <- function(w, min_length) {
+  w$x$data <- map(w$x$data, function(trace) {
+    for (attr in c("x", "y")) {
+      v <- trace[[attr]]
+      if (is.numeric(v) && length(v) >= min_length) {
+        trace[[attr]] <- encode_f4(v)
+      }
+    }
+    if (is.numeric(trace$marker$color) && length(trace$marker$color) >= min_length) {
+      trace$marker$color <- encode_f4(trace$marker$color)
+    }
+    trace
+  })
+  w
+}
+
+# Sends the numeric columns of large traces as base64 Float32 arrays instead
+# of JSON number lists. The arrays are encoded after plotly builds the widget
+# and decoded in the browser by js/typed_arrays.js
+typed_array_widget <- function(p, min_length = 1000) {
+  build <- p$preRenderHook
+  p$preRenderHook <- function(w) {
+    if (!is.null(build)) {
+      w <- build(w)
+    }
+    encode_typed_arrays(w, min_length)
+  }
+  p$dependencies <- c(p$dependencies, list(typed_array_dependency))
+  p
+}
@@ -0,0 +1,33 @@
+library(matrixStats)
+
+# Row statistics of a (genes x samples) matrix, computed once and shared by
+# every QC output that needs them
+qc_row_stats <- function(m) {
+  list(
+    max = rowMaxs(m),
+    mean = rowMeans2(m),
+    sd = rowSds(m)
+  )
+}
+
+# Indices of the `n` largest values of `x` in decreasing order. A partial sort
+# finds the cutoff so only the candidates above it are fully ordered
+top_n_idx <- function(x, n) {
+  x[is.na(x)] <- -Inf
+  n <- min(n, length(x))
+  if (n == 0) {
+    return(integer(0))
+  }
+
+  k <- length(x) - n + 1
+  cutoff <- sort(x, partial = k)[[k]]
+  candidates <- which(x >= cutoff)
+  candidates <- candidates[order(x[candidates], decreasing = TRUE)]
+  candidates[seq_len(n)]
+}
+
+# Per-gene z-scores of the rows `idx` of `m`, dropping genes with no variance
+qc_row_z_scores <- function(m, stats, idx) {
+  z <- (m[idx, , drop = FALSE] - stats$mean[idx]) / stats$sd[idx]
+  z[rowAlls(is.finite(z)), , drop = FALSE]
+}
@@ -5,14 +5,98 @@ p <- function(msg, ...) {
   cat(sprintf(as.character(msg), ...), sep = "\n")
 }
 
+# "xlsx", "xls", or "text", from the first bytes of the file
+tabular_format <- function(path) {
+  magic <- readBin(path, "raw", n = 8)
+  if (length(magic) >= 4 && identical(magic[1:4], as.raw(c(0x50, 0x4b, 0x03, 0x04)))) {
+    return("xlsx")
+  }
+  if (length(magic) == 8 && identical(magic, as.raw(c(0xd0, 0xcf, 0x11, 0xe0, 0xa1, 0xb1, 0x1a, 0xe1)))) {
+    return("xls")
+  }
+  "text"
+}
+
+# Writes through a temporary file in the same directory, so a run killed
+# mid-write never leaves a truncated object behind
+save_rds_atomic <- function(object, file) {
+  tmp <- tempfile(".tmp_", tmpdir = dirname(file), fileext = ".rds")
+  on.exit(unlink(tmp), add = TRUE)
+  saveRDS(object, file = tmp)
+  if (!file.rename(tmp, file)) {
+    stop(sprintf("Could not move %s to %s", tmp, file))
+  }
+}
+
 read_tabular <- function(path) {
-  tryCatch(
-    {
-      read_excel(path)
-    },
-    error = function(cond) {
-      fread(path, check.names = TRUE) %>%
-        as_tibble()
-    }
+  if (tabular_format(path) == "text") {
+    return(fread(path, check.names = TRUE) %>% as_tibble())
+  }
+  read_excel(path)
+}
+
+# Counts table as an integer (genes x samples) matrix of the gene ID column and
+# the `samples` columns, with floored counts. Text tables are read with only
+# those columns and as integers where possible, and every column is dropped
+# from the table as soon as it is copied into the matrix, so at most about one
+# copy of the counts is alive at a time
+read_counts_matrix <- function(path, gene_id_column, samples) {
+  if (tabular_format(path) == "text") {
+    header <- make.names(names(fread(path, nrows = 0)), unique = TRUE)
+    is_gene <- header == gene_id_column
+    keep <- which(is_gene | header %in% samples)
+
+    # columns with fractional counts are bumped to doubles, with a warning
+    dt <- suppressWarnings(fread(
+      path,
+      select = keep,
+      colClasses = list(
+        character = which(is_gene),
+        integer = setdiff(keep, which(is_gene))
+      )
+    ))
+    setnames(dt, header[keep])
+  } else {
+    dt <- as.data.table(read_excel(path))
+    setnames(dt, make.names(names(dt), unique = TRUE))
+    dt <- dt[, intersect(names(dt), c(gene_id_column, samples)), with = FALSE]
+  }
+
+  sample_columns <- setdiff(names(dt), gene_id_column)
+  res <- matrix(
+    NA_integer_,
+    nrow = nrow(dt),
+    ncol = length(sample_columns),
+    dimnames = list(as.character(dt[[gene_id_column]]), sample_columns)
+  )
+  for (j in seq_along(sample_columns)) {
+    x <- dt[[sample_columns[[j]]]]
+    res[, j] <- if (is.integer(x)) x else as.integer(floor(as.numeric(x)))
+    set(dt, j = sample_columns[[j]], value = NULL)
+  }
+  res
+}
+
+# Counts matrix written by the ingestion stage of the workflow (wf/ingest.py)
+read_ingested_counts <- function(path) {
+  header <- rjson::fromJSON(file = file.path(path, "header.json"))
+  if (header$format != "int32-column-major") {
+    stop(sprintf("Unsupported ingested counts format: %s", header$format))
+  }
+
+  n <- header$rows * header$columns
+  con <- file(file.path(path, "counts.bin"), "rb")
+  res <- readBin(con, "integer", n = n, size = 4, endian = "little")
+  close(con)
+  if (length(res) != n) {
+    stop(sprintf("Expected %s counts, read %s", n, length(res)))
+  }
+
+  # setting attributes in place does not copy the vector
+  dim(res) <- c(header$rows, header$columns)
+  dimnames(res) <- list(
+    readLines(file.path(path, "genes.txt"), encoding = "UTF-8"),
+    unlist(header$samples)
   )
+  res
 }
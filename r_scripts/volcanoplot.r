@@ -1,10 +1,18 @@
-plotVolcanoPlotly <- function(lfc, title) {
+plotVolcanoPlotly <- function(lfc, title, max_points = NA) {
   maxl2fc <- max(lfc$log2FoldChange)
   minl2fc <- min(lfc$log2FoldChange)
 
   col_tres_low <- (-2 - minl2fc) / (maxl2fc - minl2fc)
   col_tres_high <- (2 - minl2fc) / (maxl2fc - minl2fc)
 
+  # significant genes and genes past the fold change cutoffs are always drawn
+  lfc <- lfc[decimate_idx(
+    lfc$log2FoldChange,
+    -log10(lfc$padj),
+    (!is.na(lfc$padj) & lfc$padj <= 0.1) | abs(lfc$log2FoldChange) >= 2,
+    max_points
+  ), ]
+
   vol <- ggplot(
     data = as.data.frame(lfc),
     aes(
@@ -50,5 +58,6 @@ plotVolcanoPlotly <- function(lfc, title) {
         tickmode = "linear"
       )
     ) %>%
-    toWebGL()
+    toWebGL() %>%
+    typed_array_widget()
 }
@@ -0,0 +1,121 @@
+#!/usr/bin/env Rscript
+
+# Long-lived R session that runs deseq2.r once per job, so the packages are
+# loaded once instead of on every run. Started and fed by wf/r_worker.py.
+#
+# Jobs arrive on stdin as JSON lines:
+#   {"id": "...", "args": [<deseq2.r arguments>], "env": {"NAME": "value"}}
+# A job writes to stdout exactly like a standalone `Rscript deseq2.r` run,
+# including the `__LATCH_MESSAGE_DATA` lines, and is followed by
+#   __LATCH_WORKER_DONE {"id": "...", "status": <exit status>}
+
+source("util.r")
+source("latch.r")
+
+p("Loading Libraries")
+source("libraries.r")
+suppressMessages(suppressWarnings({
+  library(htmlwidgets)
+  library(matrixStats)
+}))
+
+# deseq2.r reads its arguments with `commandArgs` and ends with `quit`. Both
+# are shadowed in the global environment, where the jobs run
+job_args <- character(0)
+
+commandArgs <- function(trailingOnly = FALSE) {
+  if (trailingOnly) {
+    return(job_args)
+  }
+  c(base::commandArgs(trailingOnly = FALSE), "--args", job_args)
+}
+
+quit <- function(save = "default", status = 0, runLast = TRUE) {
+  stop(structure(
+    class = c("worker_quit", "condition"),
+    list(message = "quit", call = NULL, status = status)
+  ))
+}
+
+worker_done <- function(id, status) {
+  p("__LATCH_WORKER_DONE %s", toJSON(list(id = id, status = status)))
+  flush(stdout())
+}
+
+set_job_env <- function(env) {
+  if (length(env) == 0) {
+    return(list())
+  }
+
+  old <- as.list(Sys.getenv(names(env), unset = NA, names = TRUE))
+  do.call(Sys.setenv, lapply(env, as.character))
+  old
+}
+
+restore_env <- function(old) {
+  for (name in names(old)) {
+    if (is.na(old[[name]])) {
+      Sys.unsetenv(name)
+    } else {
+      do.call(Sys.setenv, setNames(list(old[[name]]), name))
+    }
+  }
+}
+
+run_job <- function(job) {
+  job_args <<- as.character(unlist(job$args))
+  old_env <- set_job_env(job$env)
+
+  status <- tryCatch(
+    {
+      source("deseq2.r")
+      0L
+    },
+    worker_quit = function(cond) {
+      as.integer(cond$status)
+    },
+    error = function(err) {
+      p("Error: %s", conditionMessage(err))
+      1L
+    }
+  )
+
+  # leave nothing from the job behind for the next one
+  graphics.off()
+  setwd(worker_wd)
+  options(worker_options)
+  restore_env(old_env)
+  rm(
+    list = setdiff(ls(globalenv(), all.names = TRUE), worker_names),
+    envir = globalenv()
+  )
+  invisible(gc())
+
+  status
+}
+
+serve <- function(con) {
+  repeat {
+    line <- readLines(con, n = 1, warn = FALSE)
+    if (length(line) == 0) {
+      break
+    }
+    if (line == "") {
+      next
+    }
+
+    job <- fromJSON(line)
+    worker_done(job$id, run_job(job))
+  }
+}
+
+worker_wd <- getwd()
+worker_options <- options()
+stdin_con <- file("stdin", open = "r")
+worker_names <- c(ls(globalenv(), all.names = TRUE), "worker_names")
+
+p("R worker ready")
+flush(stdout())
+
+serve(stdin_con)
+close(stdin_con)
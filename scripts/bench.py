@@ -0,0 +1,309 @@
+"""Local benchmark of the `deseq2` task stages.
+
+Builds reports with `deseq2_report`, the same code the task runs, on the
+bundled datasets and on synthetic data, and collects the stage timings each
+report writes to `Data/QC/timings.json` into a JSON file.
+
+Usage (from the repository root, in the workflow image):
+    python scripts/bench.py --datasets ibd synthetic --genes 60000 --samples 24
+    python scripts/bench.py --compare bench/results-<earlier run>.json
+"""
+
+import argparse
+import contextlib
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import traceback
+import urllib.request
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+repo = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repo))
+
+from latch.types import LatchFile
+from synthetic import add_shape_args, generate, shape_from_args
+
+from wf import deseq2_report
+from wf.deseqreport import ReportReader
+from wf.r_worker import shared_worker
+from wf.tabular import open_table
+from wf.util import available_cpu_count
+
+results_version = 3
+
+galaxy_counts_url = (
+    "https://latch-public.s3.us-west-2.amazonaws.com"
+    "/welcome/deseq2/galaxy/galaxy_counts.tsv"
+)
+
+
+@dataclass
+class Dataset:
+    name: str
+    counts: Path
+    design: Path
+    sample_id_column: str
+    explanatory: List[str]
+    confounding: List[str] = field(default_factory=list)
+    cluster: List[str] = field(default_factory=list)
+    gene_id_column: str = "gene_id"
+
+
+def bundled_dataset(name: str) -> Dataset:
+    if name == "ibd":
+        return Dataset(
+            name="ibd",
+            counts=repo / "data/ibd/ibd_counts.csv",
+            design=repo / "data/ibd/ibd_design.csv",
+            sample_id_column="Sample",
+            explanatory=["Condition"],
+        )
+
+    if name == "galaxy":
+        # only the design matrix is checked in
+        counts = repo / "data/galaxy/galaxy_counts.tsv"
+        if not counts.exists():
+            print(f"Downloading {galaxy_counts_url}")
+            urllib.request.urlretrieve(galaxy_counts_url, counts)
+
+        return Dataset(
+            name="galaxy",
+            counts=counts,
+            design=repo / "data/galaxy/galaxy_design.csv",
+            sample_id_column="Sample",
+            explanatory=["Condition"],
+        )
+
+    raise ValueError(f"Unknown dataset: '{name}'")
+
+
+def synthetic_dataset(args: argparse.Namespace, work: Path) -> Dataset:
+    shape = shape_from_args(args)
+    out = work / "inputs" / shape.name()
+    if not (out / "counts.csv").exists():
+        print(f"Generating {shape.name()}")
+        generate(shape, out)
+
+    return Dataset(
+        name=shape.name(),
+        counts=out / "counts.csv",
+        design=out / "design.csv",
+        sample_id_column="sample_id",
+        explanatory=["condition"],
+        confounding=[f"confounder_{i + 1}" for i in range(shape.confounders)],
+        cluster=[f"cluster_{i + 1}" for i in range(shape.clusters)],
+    )
+
+
+def design_formula(ds: Dataset) -> List[List[str]]:
+    return [
+        *([x, "explanatory"] for x in ds.explanatory),
+        *([x, "confounding"] for x in ds.confounding),
+        *([x, "cluster"] for x in ds.cluster),
+    ]
+
+
+def run_dataset(ds: Dataset, work: Path, args: argparse.Namespace) -> Dict[str, Any]:
+    run_dir = work / "runs" / ds.name
+    shutil.rmtree(run_dir, ignore_errors=True)
+    run_dir.mkdir(parents=True)
+
+    worker = None
+    if args.r_worker:
+        worker = shared_worker(
+            {
+                "OMP_NUM_THREADS": str(args.cores),
+                "OPENBLAS_NUM_THREADS": str(args.cores),
+            }
+        )
+
+    log_p = run_dir / "report.log"
+    failed = False
+    with log_p.open("w") as log, contextlib.redirect_stdout(log):
+        with contextlib.redirect_stderr(log):
+            try:
+                res = deseq2_report(
+                    ds.name,
+                    str(run_dir / "res"),
+                    run_dir,
+                    number_of_cpu_cores=args.cores,
+                    raw_count_table=LatchFile(str(ds.counts.resolve())),
+                    count_table_gene_id_column=ds.gene_id_column,
+                    conditions_source="table",
+                    conditions_table=LatchFile(str(ds.design.resolve())),
+                    design_matrix_sample_id_column=ds.sample_id_column,
+                    design_formula=design_formula(ds),
+                    number_of_contrast_workers=args.contrast_workers,
+                    contrast_mode=args.contrast_mode,
+                    fit_engine=args.fit_engine,
+                    plot_output_format=args.plot_format,
+                    plot_max_points=args.plot_max_points,
+                    plot_widget_libraries=args.widget_libraries,
+                    r_worker=worker,
+                )
+            except Exception:
+                traceback.print_exc()
+                failed = True
+
+    if failed:
+        print(f"  Report failed, see {log_p}")
+        return {"dataset": ds.name, "failed": True}
+
+    with (res / "Data/QC/timings.json").open() as f:
+        timings = json.load(f)
+    with ReportReader(res / "Report.deseqreport") as report:
+        genes = len(report.header["genes"])
+    with open_table(ds.design) as (_, rows):
+        samples = sum(1 for _ in rows)
+
+    return {
+        "dataset": ds.name,
+        "failed": False,
+        "genes": genes,
+        "samples": samples,
+        "total": timings["total_seconds"],
+        # seconds summed over every occurrence of a stage, per-contrast
+        # stages run in parallel so they can add up to more than wall time
+        "stages": {k: v["total_seconds"] for k, v in timings["summary"].items()},
+        "r_peak_rss_bytes": timings["r_peak_rss_bytes"],
+        "report_bytes": (res / "Report.deseqreport").stat().st_size,
+        "timings": timings,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=repo,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def medians(runs: List[Dict[str, Any]]) -> Dict[Tuple[str, str], float]:
+    values: Dict[Tuple[str, str], List[float]] = {}
+    for run in runs:
+        if run.get("failed", False):
+            continue
+        for stage, seconds in [*run["stages"].items(), ("total", run["total"])]:
+            values.setdefault((run["dataset"], stage), []).append(seconds)
+    return {k: statistics.median(v) for k, v in values.items()}
+
+
+def print_comparison(baseline: Dict[str, Any], current: Dict[str, Any]) -> None:
+    old = medians(baseline["runs"])
+    new = medians(current["runs"])
+
+    print(f"{'dataset':<40} {'stage':<24} {'before':>10} {'after':>10} {'ratio':>7}")
+    for k in sorted(new.keys()):
+        if k not in old:
+            continue
+        ratio = new[k] / old[k] if old[k] > 0 else float("inf")
+        print(f"{k[0]:<40} {k[1]:<24} {old[k]:>9.2f}s {new[k]:>9.2f}s {ratio:>6.2f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the deseq2 task stages")
+    parser.add_argument(
+        "--datasets",
+        nargs="+",
+        default=["ibd", "galaxy", "synthetic"],
+        choices=["ibd", "galaxy", "synthetic"],
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--work", type=Path, default=repo / "bench" / "work")
+    parser.add_argument("-o", "--output", type=Path, default=None)
+    parser.add_argument(
+        "--compare", type=Path, default=None, help="earlier results to compare with"
+    )
+    parser.add_argument("--cores", type=int, default=available_cpu_count())
+    parser.add_argument("--contrast-workers", type=int, default=4)
+    parser.add_argument(
+        "--contrast-mode", default="symmetric", choices=["symmetric", "full"]
+    )
+    parser.add_argument(
+        "--fit-engine", default="auto", choices=["auto", "standard", "glmGamPoi"]
+    )
+    parser.add_argument(
+        "--plot-format", default="both", choices=["png", "html", "both", "none"]
+    )
+    parser.add_argument("--plot-max-points", type=int, default=20000)
+    parser.add_argument("--widget-libraries", default="cdn", choices=["cdn", "offline"])
+    parser.add_argument(
+        "--r-worker",
+        action="store_true",
+        help="run every repeat in one persistent R worker",
+    )
+    add_shape_args(parser)
+    args = parser.parse_args()
+
+    started = datetime.now(timezone.utc)
+    output = args.output
+    if output is None:
+        output = repo / "bench" / f"results-{started.strftime('%Y%m%d-%H%M%S')}.json"
+
+    args.work.mkdir(parents=True, exist_ok=True)
+    datasets = [
+        synthetic_dataset(args, args.work) if x == "synthetic" else bundled_dataset(x)
+        for x in args.datasets
+    ]
+
+    runs = []
+    for ds in datasets:
+        for i in range(args.repeat):
+            print(f">>> {ds.name} ({i + 1}/{args.repeat})")
+            run = run_dataset(ds, args.work, args)
+            run["repeat"] = i
+            runs.append(run)
+            if run["failed"]:
+                continue
+
+            for stage, seconds in run["stages"].items():
+                print(f"  {stage:<24} {seconds:>9.2f}s")
+            print(f"  {'total':<24} {run['total']:>9.2f}s")
+
+    results = {
+        "version": results_version,
+        "started": started.isoformat(),
+        "git_commit": git_commit(),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": available_cpu_count(),
+        },
+        "settings": {
+            "cores": args.cores,
+            "contrast_workers": args.contrast_workers,
+            "contrast_mode": args.contrast_mode,
+            "fit_engine": args.fit_engine,
+            "plot_format": args.plot_format,
+            "plot_max_points": args.plot_max_points,
+            "widget_libraries": args.widget_libraries,
+            "r_worker": args.r_worker,
+        },
+        "runs": runs,
+    }
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open("w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare is not None:
+        with args.compare.open() as f:
+            print_comparison(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env Rscript
+
+# Compares the counts heatmap statistics of `r_scripts/qc_stats.r` against the
+# previous rowwise dplyr implementation.
+#
+# Usage (from the repository root):
+#   Rscript scripts/bench_qc.r [counts.csv] [repetitions]
+
+suppressMessages(suppressWarnings({
+  library(dplyr)
+  library(tibble)
+  library(DESeq2)
+}))
+
+source("r_scripts/qc_stats.r")
+
+args <- commandArgs(trailingOnly = TRUE)
+counts_path <- if (length(args) >= 1) args[[1]] else "data/ibd/ibd_counts.csv"
+reps <- if (length(args) >= 2) as.integer(args[[2]]) else 5L
+
+cts <- read.csv(counts_path, row.names = 1, check.names = FALSE)
+cts <- as.matrix(cts)
+storage.mode(cts) <- "integer"
+cts <- cts[rowSums(is.na(cts)) == 0, , drop = FALSE]
+
+cat(sprintf("Counts: %d genes x %d samples\n", nrow(cts), ncol(cts)))
+
+vsd_assay <- assay(varianceStabilizingTransformation(cts, blind = TRUE, fitType = "mean"))
+
+rowwise_heatmap <- function(vsd_assay) {
+  vsd_assay %>%
+    as_tibble(rownames = "gene_id") %>%
+    rowwise() %>%
+    mutate(
+      max = max(across(!all_of("gene_id")))
+    ) %>%
+    ungroup() %>%
+    slice_max(max, n = 100, with_ties = FALSE) %>%
+    select(!max) %>%
+    rowwise() %>%
+    mutate(
+      mean = rowMeans(across(!all_of("gene_id"))),
+      sd = sd(across(!all_of("gene_id")))
+    ) %>%
+    mutate(
+      across(!all_of(c("gene_id", "mean", "sd")), ~ (.x - mean) / sd)
+    ) %>%
+    ungroup() %>%
+    select(!all_of(c("mean", "sd"))) %>%
+    na.omit() %>%
+    column_to_rownames("gene_id") %>%
+    as.matrix()
+}
+
+vectorized_heatmap <- function(vsd_assay) {
+  stats <- qc_row_stats(vsd_assay)
+  qc_row_z_scores(vsd_assay, stats, top_n_idx(stats$max, 100))
+}
+
+time_it <- function(f) {
+  res <- numeric(reps)
+  for (i in seq_len(reps)) {
+    res[[i]] <- system.time(f(vsd_assay))[["elapsed"]]
+  }
+  median(res)
+}
+
+old <- rowwise_heatmap(vsd_assay)
+new <- vectorized_heatmap(vsd_assay)
+stopifnot(identical(rownames(old), rownames(new)))
+stopifnot(isTRUE(all.equal(old, new, check.attributes = FALSE)))
+
+old_time <- time_it(rowwise_heatmap)
+new_time <- time_it(vectorized_heatmap)
+
+cat(sprintf("rowwise:    %8.3fs (median of %d)\n", old_time, reps))
+cat(sprintf("vectorized: %8.3fs (median of %d)\n", new_time, reps))
+cat(sprintf("speedup:    %8.1fx\n", old_time / max(new_time, 1e-6)))
@@ -0,0 +1,137 @@
+"""Synthetic negative binomial counts and design matrices for benchmarks.
+
+Usage:
+    python scripts/synthetic.py out_dir --genes 60000 --samples 24 --conditions 3
+"""
+
+import argparse
+import csv
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+
+@dataclass
+class SyntheticShape:
+    genes: int = 20_000
+    samples: int = 12
+    conditions: int = 2
+    confounders: int = 0
+    clusters: int = 0
+    # share of genes with a condition effect
+    de_fraction: float = 0.1
+    seed: int = 0
+
+    def name(self) -> str:
+        return (
+            f"synthetic_g{self.genes}_s{self.samples}_c{self.conditions}"
+            f"_f{self.confounders}_k{self.clusters}"
+        )
+
+
+def _balanced_levels(rng: np.random.Generator, n: int, levels: List[str]) -> List[str]:
+    xs = [levels[i % len(levels)] for i in range(n)]
+    rng.shuffle(xs)
+    return xs
+
+
+def generate(shape: SyntheticShape, out: Path) -> None:
+    """Write `counts.csv` and `design.csv` for `shape` into `out`.
+
+    Counts follow a negative binomial with a log-normal base mean and the
+    usual DESeq2 dispersion trend `0.05 + 2 / mean`. A `de_fraction` of the
+    genes get a normally distributed log2 fold change for every condition
+    level after the first. Confounder columns add smaller effects to every
+    gene. Cluster columns are split into two groups and do not affect counts.
+    """
+    if shape.samples < 2 * shape.conditions:
+        raise ValueError("Need at least two samples per condition")
+
+    rng = np.random.default_rng(shape.seed)
+    out.mkdir(parents=True, exist_ok=True)
+
+    samples = [f"sample_{i + 1:04}" for i in range(shape.samples)]
+    genes = [f"gene_{i + 1:06}" for i in range(shape.genes)]
+
+    condition_levels = [f"cond_{i + 1}" for i in range(shape.conditions)]
+    design = {
+        "condition": [
+            condition_levels[i % shape.conditions] for i in range(shape.samples)
+        ]
+    }
+    for i in range(shape.confounders):
+        design[f"confounder_{i + 1}"] = _balanced_levels(
+            rng, shape.samples, [f"batch_{j + 1}" for j in range(2)]
+        )
+    for i in range(shape.clusters):
+        design[f"cluster_{i + 1}"] = _balanced_levels(
+            rng, shape.samples, [f"group_{j + 1}" for j in range(2)]
+        )
+
+    log_mu = np.tile(
+        rng.normal(np.log(200), 2, size=(shape.genes, 1)), (1, shape.samples)
+    )
+
+    de = rng.random(shape.genes) < shape.de_fraction
+    for level in condition_levels[1:]:
+        lfc = np.where(de, rng.normal(0, 1.5, size=shape.genes), 0)
+        cols = np.array([x == level for x in design["condition"]])
+        log_mu[:, cols] += (lfc * np.log(2))[:, None]
+
+    for i in range(shape.confounders):
+        effect = rng.normal(0, 0.3, size=shape.genes)
+        cols = np.array([x == "batch_2" for x in design[f"confounder_{i + 1}"]])
+        log_mu[:, cols] += effect[:, None]
+
+    mu = np.exp(np.clip(log_mu, -5, 15))
+    dispersion = 0.05 + 2 / mu
+    n = 1 / dispersion
+    counts = rng.negative_binomial(n, n / (n + mu))
+
+    with (out / "counts.csv").open("w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["gene_id", *samples])
+        for gene, row in zip(genes, counts):
+            w.writerow([gene, *row.tolist()])
+
+    with (out / "design.csv").open("w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["sample_id", *design.keys()])
+        for idx, sample in enumerate(samples):
+            w.writerow([sample, *(x[idx] for x in design.values())])
+
+
+def add_shape_args(parser: argparse.ArgumentParser) -> None:
+    defaults = SyntheticShape()
+    parser.add_argument("--genes", type=int, default=defaults.genes)
+    parser.add_argument("--samples", type=int, default=defaults.samples)
+    parser.add_argument("--conditions", type=int, default=defaults.conditions)
+    parser.add_argument("--confounders", type=int, default=defaults.confounders)
+    parser.add_argument("--clusters", type=int, default=defaults.clusters)
+    parser.add_argument("--de-fraction", type=float, default=defaults.de_fraction)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def shape_from_args(args: argparse.Namespace) -> SyntheticShape:
+    return SyntheticShape(
+        genes=args.genes,
+        samples=args.samples,
+        conditions=args.conditions,
+        confounders=args.confounders,
+        clusters=args.clusters,
+        de_fraction=args.de_fraction,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic counts table and design matrix"
+    )
+    parser.add_argument("out", type=Path)
+    add_shape_args(parser)
+    args = parser.parse_args()
+
+    generate(shape_from_args(args), args.out)
@@ -0,0 +1,221 @@
+import json
+import os
+import random
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+import pytest
+
+from wf.deseqreport import (
+    ReportFormatError,
+    ReportReader,
+    compress_text,
+    write_report,
+)
+
+# `wf.deseqreport` calls `os.sendfile`, which the tests wrap
+real_sendfile = os.sendfile
+
+
+def read_framing(p: Path) -> Tuple[Dict[str, Any], bytes]:
+    data = p.read_bytes()
+    header_len = int.from_bytes(data[:4], "little", signed=False)
+    return json.loads(data[4 : 4 + header_len]), data[4 + header_len :]
+
+
+@pytest.fixture
+def files(tmp_path: Path) -> Dict[str, Path]:
+    rng = random.Random(0)
+    res = {
+        # compressible, over one read chunk
+        "widget": tmp_path / "Volcano.html",
+        # gzip would only grow it, stored raw
+        "_dds": tmp_path / "dds.rds",
+        "empty": tmp_path / "empty.csv",
+        "table": tmp_path / "table.csv",
+    }
+    res["widget"].write_bytes(b"<div class='point'></div>\n" * 100_000)
+    res["_dds"].write_bytes(rng.randbytes(3 * 1024 * 1024 + 17))
+    res["empty"].write_bytes(b"")
+    res["table"].write_bytes(b"gene,log2FoldChange\nA,1.5\nB,-0.25\n")
+    return res
+
+
+def write_v1(out: Path, header: Dict[str, Any], blobs: Dict[str, bytes]) -> None:
+    json_blob = json.dumps(
+        {
+            **header,
+            "embedded_data_order": list(blobs.keys()),
+            "embedded_data_sizes": {k: len(v) for k, v in blobs.items()},
+        }
+    ).encode("utf-8")
+    with out.open("wb") as f:
+        f.write(len(json_blob).to_bytes(4, "little", signed=False))
+        f.write(json_blob)
+        for v in blobs.values():
+            f.write(v)
+
+
+def test_v2_framing(tmp_path: Path, files: Dict[str, Path]):
+    out = tmp_path / "r.deseqreport"
+    index = write_report(out, {"report_name": "x", "genes": ["A"]}, files)
+
+    header, data = read_framing(out)
+    assert header["version"] == 2
+    assert header["report_name"] == "x"
+    assert header["genes"] == ["A"]
+    assert header["embedded_data_order"] == sorted(files)
+    assert header["embedded_data"] == {k: v.dict() for k, v in index.items()}
+
+    # uncompressed reports can still be framed the version 1 way
+    offset = 0
+    for k in header["embedded_data_order"]:
+        size = header["embedded_data_sizes"][k]
+        blob = data[offset : offset + size]
+        assert blob == files[k].read_bytes()
+
+        e = header["embedded_data"][k]
+        assert e["offset"] == offset
+        assert e["length"] == e["size"] == size
+        assert e["crc32"] == zlib.crc32(blob)
+        assert e["compression"] is None
+        offset += size
+    assert offset == len(data)
+
+
+def test_round_trips_gzip_and_raw_entries(tmp_path: Path, files: Dict[str, Path]):
+    out = tmp_path / "r.deseqreport"
+    index = write_report(out, {}, files, compress_text)
+
+    assert {k: v.compression for k, v in index.items()} == {
+        "widget": "gzip",
+        "_dds": None,
+        # nothing to gain from compressing these
+        "empty": None,
+        "table": None,
+    }
+    assert index["widget"].length < index["widget"].size
+
+    _, data = read_framing(out)
+    e = index["widget"]
+    assert zlib.crc32(data[e.offset : e.offset + e.length]) == e.crc32
+
+    with ReportReader(out) as r:
+        assert r.version == 2
+        assert sorted(r.keys()) == sorted(files)
+        for k, p in files.items():
+            expected = p.read_bytes()
+            assert r.verify(k)
+            assert r.read(k) == expected
+            with r.open(k) as f:
+                assert f.read() == expected
+
+            r.extract(k, tmp_path / f"{k}.out")
+            assert (tmp_path / f"{k}.out").read_bytes() == expected
+
+
+def test_leaves_out_missing_files(tmp_path: Path, files: Dict[str, Path]):
+    out = tmp_path / "r.deseqreport"
+    index = write_report(out, {}, {**files, "gone": tmp_path / "gone.html"})
+
+    assert "gone" not in index
+    with ReportReader(out) as r:
+        assert "gone" not in r
+        assert sorted(r.keys()) == sorted(files)
+
+
+def test_detects_checksum_mismatches(tmp_path: Path, files: Dict[str, Path]):
+    out = tmp_path / "r.deseqreport"
+    index = write_report(out, {}, files, compress_text)
+
+    header_len = int.from_bytes(out.read_bytes()[:4], "little", signed=False)
+    data = bytearray(out.read_bytes())
+    pos = 4 + header_len + index["table"].offset + 3
+    data[pos] ^= 0xFF
+    out.write_bytes(bytes(data))
+
+    with ReportReader(out) as r:
+        assert not r.verify("table")
+        assert r.verify("widget")
+
+        with pytest.raises(ReportFormatError):
+            r.extract("table", tmp_path / "table.out")
+
+        r.extract("table", tmp_path / "table.out", verify=False)
+        assert (tmp_path / "table.out").read_bytes() != files["table"].read_bytes()
+
+
+def test_extracts_raw_entries_with_sendfile(
+    tmp_path: Path, files: Dict[str, Path], monkeypatch
+):
+    out = tmp_path / "r.deseqreport"
+    write_report(out, {}, files)
+
+    calls = []
+
+    def sendfile(out_fd: int, in_fd: int, offset: int, count: int) -> int:
+        calls.append(count)
+        # short writes, like the kernel may do
+        return real_sendfile(out_fd, in_fd, offset, min(count, 1024 * 1024))
+
+    monkeypatch.setattr(os, "sendfile", sendfile)
+    with ReportReader(out) as r:
+        r.extract("_dds", tmp_path / "dds.out")
+    assert len(calls) == 4
+    assert (tmp_path / "dds.out").read_bytes() == files["_dds"].read_bytes()
+
+
+def test_extract_falls_back_without_sendfile(
+    tmp_path: Path, files: Dict[str, Path], monkeypatch
+):
+    out = tmp_path / "r.deseqreport"
+    write_report(out, {}, files)
+
+    sent = []
+
+    def sendfile(out_fd: int, in_fd: int, offset: int, count: int) -> int:
+        if len(sent) > 0:
+            raise OSError("sendfile not supported")
+        sent.append(real_sendfile(out_fd, in_fd, offset, 1000))
+        return sent[-1]
+
+    monkeypatch.setattr(os, "sendfile", sendfile)
+    with ReportReader(out) as r:
+        r.extract("_dds", tmp_path / "dds.out")
+    assert (tmp_path / "dds.out").read_bytes() == files["_dds"].read_bytes()
+
+
+def test_reads_v1_reports(tmp_path: Path):
+    blobs = {"sample_corr": b"<div>corr</div>", "_dds": b"\x1f\x8b rds", "e": b""}
+    out = tmp_path / "v1.deseqreport"
+    write_v1(out, {"report_name": "old"}, blobs)
+
+    with ReportReader(out) as r:
+        assert r.version == 1
+        assert r.header["report_name"] == "old"
+        assert r.keys() == list(blobs.keys())
+        for k, v in blobs.items():
+            assert r.index[k].crc32 == -1
+            # nothing to check against
+            assert r.verify(k)
+            assert r.read(k) == v
+            with r.open(k) as f:
+                assert f.read() == v
+
+            r.extract(k, tmp_path / f"{k}.out")
+            assert (tmp_path / f"{k}.out").read_bytes() == v
+
+
+def test_rejects_truncated_reports(tmp_path: Path, files: Dict[str, Path]):
+    out = tmp_path / "r.deseqreport"
+    write_report(out, {}, files)
+
+    data = out.read_bytes()
+    header_len = int.from_bytes(data[:4], "little", signed=False)
+
+    cut = tmp_path / "cut.deseqreport"
+    for n in [0, 2, 4 + header_len // 2, len(data) - 1]:
+        cut.write_bytes(data[:n])
+        with pytest.raises(ReportFormatError):
+            ReportReader(cut)
@@ -0,0 +1,239 @@
+import csv
+from pathlib import Path
+from typing import Any, List
+
+import numpy as np
+import pytest
+from openpyxl import Workbook
+
+from wf.ingest import LowCountFilter, ingest_counts, na_count
+from wf.tabular import is_xlsx, open_table
+from wf.validate import load_counts_matrix, validate_counts
+
+fixtures = Path(__file__).resolve().parent / "data/test"
+
+design_samples = ["s1", "s2", "s3", "s4"]
+
+
+def write_xlsx(p: Path, rows: List[List[Any]]) -> None:
+    wb = Workbook()
+    for row in rows:
+        wb.active.append(row)
+    wb.save(p)
+
+
+def xlsx_counts(p: Path) -> Path:
+    with (fixtures / "counts.csv").open(newline="") as f:
+        rows = list(csv.reader(f))
+    write_xlsx(p, [rows[0], *([r[0], *(int(x) for x in r[1:])] for r in rows[1:])])
+    return p
+
+
+def reported(out: str) -> List[str]:
+    return [
+        l.split("'title': '", 1)[1].split("'", 1)[0]
+        for l in out.splitlines()
+        if l.startswith("[error]: ")
+    ]
+
+
+@pytest.mark.parametrize("name", ["counts.csv", "counts.tsv", "counts.xlsx"])
+def test_reads_every_table_format(tmp_path: Path, name: str):
+    p = fixtures / name
+    if name == "counts.xlsx":
+        p = xlsx_counts(tmp_path / name)
+
+    assert is_xlsx(p) == (name == "counts.xlsx")
+    with open_table(p) as (header, rows):
+        assert header == ["gene_id", "s1", "s2", "s3", "extra"]
+        assert [[str(x) for x in row] for row in rows] == [
+            ["g1", "10", "20", "30", "1"],
+            ["g2", "0", "5", "0", "1"],
+            ["g3", "100", "200", "300", "1"],
+            ["g4", "1", "0", "2", "1"],
+        ]
+
+
+@pytest.mark.parametrize("name", ["counts.csv", "counts.tsv", "counts.xlsx"])
+def test_ingests_the_design_samples(tmp_path: Path, name: str):
+    p = fixtures / name
+    if name == "counts.xlsx":
+        p = xlsx_counts(tmp_path / name)
+
+    with open_table(p) as (header, rows):
+        ingested = ingest_counts(
+            header, rows, "gene_id", design_samples, tmp_path / "ingested"
+        )
+
+    assert ingested.samples == ["s1", "s2", "s3"]
+    assert ingested.missing_samples == ["s4"]
+    assert ingested.ignored_columns == ["extra"]
+    assert ingested.num_genes == 4
+    assert ingested.genes == {"g1", "g2", "g3", "g4"}
+    assert (tmp_path / "ingested/genes.txt").read_text() == "g1\ng2\ng3\ng4\n"
+    assert load_counts_matrix(ingested).tolist() == [
+        [10, 20, 30],
+        [0, 5, 0],
+        [100, 200, 300],
+        [1, 0, 2],
+    ]
+
+    validate_counts(ingested)
+
+
+def test_falls_back_to_the_first_column_for_gene_ids(tmp_path: Path):
+    with open_table(fixtures / "counts.csv") as (header, rows):
+        ingested = ingest_counts(header, rows, "Gene", ["s1"], tmp_path / "ingested")
+
+    assert ingested.gene_id_column == "gene_id"
+    assert ingested.num_genes == 4
+
+
+def test_skips_rows_without_a_gene_id(tmp_path: Path):
+    p = tmp_path / "counts.xlsx"
+    write_xlsx(
+        p,
+        [
+            ["gene_id", "s1", "s2"],
+            ["g1", 1, 2],
+            # an empty cell, e.g. a totals row
+            [None, 10, 20],
+            ["g2", 3, 4],
+        ],
+    )
+
+    with open_table(p) as (header, rows):
+        ingested = ingest_counts(header, rows, "gene_id", ["s1", "s2"], tmp_path / "i")
+
+    assert ingested.genes == {"g1", "g2"}
+    assert load_counts_matrix(ingested).tolist() == [[1, 2], [3, 4]]
+
+
+def test_rejects_duplicate_gene_ids(tmp_path: Path, capsys):
+    ingested = ingest_counts(
+        ["gene_id", "s1", "s2"],
+        [["g1", "1", "2"], ["g2", "3", "4"], ["g1", "5", "6"]],
+        "gene_id",
+        ["s1", "s2"],
+        tmp_path / "ingested",
+    )
+
+    with pytest.raises(RuntimeError):
+        validate_counts(ingested)
+    assert reported(capsys.readouterr().out) == ["Duplicate gene IDs"]
+
+
+def test_floors_fractional_counts(tmp_path: Path):
+    ingested = ingest_counts(
+        ["gene_id", "s1", "s2"],
+        [["g1", "1.7", "2.0"], ["g2", 3.2, "4e1"]],
+        "gene_id",
+        ["s1", "s2"],
+        tmp_path / "ingested",
+    )
+
+    assert ingested.non_numeric_cells == 0
+    assert load_counts_matrix(ingested).tolist() == [[1, 2], [3, 40]]
+
+
+def test_rejects_non_numeric_counts(tmp_path: Path, capsys):
+    ingested = ingest_counts(
+        ["gene_id", "s1", "s2"],
+        [["g1", "1", "n/a"], ["g2", "", "4"], ["g3", "5", "6"]],
+        "gene_id",
+        ["s1", "s2"],
+        tmp_path / "ingested",
+    )
+
+    assert ingested.non_numeric_cells == 2
+    assert ingested.non_numeric_examples == ["g1 / s2: 'n/a'", "g2 / s1: ''"]
+    assert load_counts_matrix(ingested)[:2].tolist() == [
+        [1, na_count],
+        [na_count, 4],
+    ]
+
+    with pytest.raises(RuntimeError):
+        validate_counts(ingested)
+    assert reported(capsys.readouterr().out) == ["Missing or non-numeric counts"]
+
+
+def test_rejects_negative_counts(tmp_path: Path, capsys):
+    ingested = ingest_counts(
+        ["gene_id", "s1", "s2"],
+        [["g1", "1", "-2"], ["g2", "3", "4"]],
+        "gene_id",
+        ["s1", "s2"],
+        tmp_path / "ingested",
+    )
+
+    with pytest.raises(RuntimeError):
+        validate_counts(ingested)
+    assert reported(capsys.readouterr().out) == ["Negative counts"]
+
+
+def test_rejects_tables_without_enough_samples(tmp_path: Path, capsys):
+    with open_table(fixtures / "counts.csv") as (header, rows):
+        ingested = ingest_counts(
+            header, rows, "gene_id", ["s1", "s9"], tmp_path / "ingested"
+        )
+
+    with pytest.raises(RuntimeError):
+        validate_counts(ingested)
+    assert reported(capsys.readouterr().out) == [
+        "Not enough samples in the counts table"
+    ]
+
+
+def test_prefilters_low_counts(tmp_path: Path):
+    out = tmp_path / "ingested"
+    prefilter = LowCountFilter(min_count=5, min_samples=2)
+    with open_table(fixtures / "counts.csv") as (header, rows):
+        ingested = ingest_counts(
+            header, rows, "gene_id", design_samples, out, prefilter
+        )
+
+    assert ingested.num_prefiltered == 2
+    assert ingested.num_genes == 2
+    # every gene of the table, for the report's gene list
+    assert ingested.genes == {"g1", "g2", "g3", "g4"}
+    assert (out / "genes.txt").read_text() == "g1\ng3\n"
+    assert load_counts_matrix(ingested).tolist() == [[10, 20, 30], [100, 200, 300]]
+
+    with (out / "prefiltered.csv").open(newline="") as f:
+        assert list(csv.reader(f)) == [
+            ["gene_id", "total_count", "samples_passing"],
+            ["g2", "5", "1"],
+            ["g4", "3", "0"],
+        ]
+
+
+def test_prefilters_by_cpm(tmp_path: Path):
+    out = tmp_path / "ingested"
+    # library sizes are 111, 225 and 332, so 10000 CPM is 1.11, 2.25 and 3.32:
+    # g4 has 1, 0 and 2 reads and fails everywhere
+    prefilter = LowCountFilter(min_cpm=10000)
+    with open_table(fixtures / "counts.csv") as (header, rows):
+        ingested = ingest_counts(
+            header, rows, "gene_id", design_samples, out, prefilter
+        )
+
+    assert (out / "genes.txt").read_text() == "g1\ng2\ng3\n"
+    assert ingested.num_prefiltered == 1
+
+
+def test_removes_a_stale_prefilter_table(tmp_path: Path):
+    out = tmp_path / "ingested"
+    with open_table(fixtures / "counts.csv") as (header, rows):
+        ingest_counts(
+            header, rows, "gene_id", design_samples, out, LowCountFilter(min_count=5)
+        )
+    assert (out / "prefiltered.csv").exists()
+
+    with open_table(fixtures / "counts.csv") as (header, rows):
+        ingested = ingest_counts(header, rows, "gene_id", design_samples, out)
+
+    assert not (out / "prefiltered.csv").exists()
+    assert ingested.num_genes == 4
+    assert np.array_equal(
+        load_counts_matrix(ingested)[:, 0], np.array([10, 0, 100, 1], dtype="<i4")
+    )
@@ -0,0 +1,63 @@
+from pathlib import Path
+
+import pytest
+
+from wf.merge import CountTableMerge
+
+fixtures = Path(__file__).resolve().parent / "data/test"
+
+tables = [fixtures / "counts_a.csv", fixtures / "counts_b.tsv"]
+
+
+@pytest.mark.parametrize("run_rows", [100, 1])
+def test_fills_missing_genes_with_zeros(run_rows: int):
+    with CountTableMerge(tables, missing_genes="fill", run_rows=run_rows) as merge:
+        rows = list(merge.rows())
+
+        assert merge.header == ["gene_id", "a1", "a2", "b1"]
+        assert rows == [
+            # the first occurrence of a duplicated gene is kept
+            ["g1", "10", "11", "0"],
+            ["g2", "20", "21", "22"],
+            ["g3", "30", "31", "33"],
+            ["g4", "0", "0", "40"],
+        ]
+
+    report = merge.report.dict()
+    assert report["genes_total"] == 4
+    assert report["genes_in_all_tables"] == 2
+    assert report["genes_written"] == 4
+    assert [
+        (x["path"], x["samples"], x["genes"], x["duplicate_genes"], x["missing_genes"])
+        for x in report["tables"]
+    ] == [
+        ("counts_a.csv", 2, 3, 1, 1),
+        ("counts_b.tsv", 1, 3, 0, 1),
+    ]
+
+
+def test_drops_missing_genes():
+    with CountTableMerge(tables, missing_genes="drop") as merge:
+        rows = list(merge.rows())
+
+    assert rows == [
+        ["g2", "20", "21", "22"],
+        ["g3", "30", "31", "33"],
+    ]
+    assert merge.report.missing_genes == "drop"
+    assert merge.report.genes_total == 4
+    assert merge.report.genes_written == 2
+
+
+def test_rejects_unknown_policies():
+    with pytest.raises(ValueError):
+        CountTableMerge(tables, missing_genes="zero")
+
+
+def test_rejects_samples_in_several_tables(tmp_path: Path):
+    other = tmp_path / "counts_c.csv"
+    other.write_text("gene_id,b1\ng1,1\n")
+
+    with pytest.raises(RuntimeError):
+        with CountTableMerge([*tables, other]):
+            pass
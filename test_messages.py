@@ -0,0 +1,121 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List
+
+import pytest
+
+from wf.util import MessageSender, message, set_message_sender
+
+
+class NucleusStandIn(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), NucleusHandler)
+        self.received: List[Dict[str, Any]] = []
+        # status codes to answer with before accepting messages
+        self.failures: List[int] = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return (
+            f"http://127.0.0.1:{self.server_address[1]}/sdk/add-task-execution-message"
+        )
+
+
+class NucleusHandler(BaseHTTPRequestHandler):
+    server: NucleusStandIn
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server.lock:
+            status = self.server.failures.pop(0) if self.server.failures else 200
+            if status == 200:
+                self.server.received.append(json.loads(body))
+
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def nucleus() -> Iterator[NucleusStandIn]:
+    server = NucleusStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_delivers_in_order(nucleus: NucleusStandIn):
+    sender = MessageSender(nucleus.url, batch_size=4, backoff=0.01)
+    for i in range(25):
+        sender.send({"type": "info", "data": {"i": i}})
+
+    assert sender.close(timeout=10)
+    assert [x["data"]["i"] for x in nucleus.received] == list(range(25))
+    assert sender.delivered == 25
+
+
+def test_retries_server_errors(nucleus: NucleusStandIn):
+    nucleus.failures = [503, 500, 429]
+    sender = MessageSender(nucleus.url, backoff=0.01)
+    sender.send({"type": "warning", "data": {"title": "x"}})
+
+    assert sender.flush(timeout=10)
+    assert len(nucleus.received) == 1
+    assert sender.dropped == 0
+    sender.close()
+
+
+def test_drops_after_retries(nucleus: NucleusStandIn):
+    nucleus.failures = [400, 500, 500, 500]
+    sender = MessageSender(nucleus.url, max_retries=2, backoff=0.01)
+    sender.send({"type": "error", "data": {"title": "rejected"}})
+    sender.send({"type": "error", "data": {"title": "gave up"}})
+    sender.send({"type": "error", "data": {"title": "delivered"}})
+
+    assert sender.close(timeout=10)
+    assert [x["data"]["title"] for x in nucleus.received] == ["delivered"]
+    assert sender.dropped == 2
+
+
+def test_message_payload(nucleus: NucleusStandIn, monkeypatch: pytest.MonkeyPatch):
+    env = {
+        "FLYTE_INTERNAL_TASK_PROJECT": "project",
+        "FLYTE_INTERNAL_TASK_DOMAIN": "development",
+        "FLYTE_INTERNAL_TASK_NAME": "wf.deseq2",
+        "FLYTE_INTERNAL_TASK_VERSION": "1.0.0",
+        "FLYTE_ATTEMPT_NUMBER": "0",
+        "FLYTE_INTERNAL_EXECUTION_ID": "token",
+    }
+    for k, v in env.items():
+        monkeypatch.setenv(k, v)
+
+    sender = MessageSender(nucleus.url)
+    previous = set_message_sender(sender)
+    try:
+        message("info", {"body": "hello"})
+        assert sender.flush(timeout=10)
+    finally:
+        set_message_sender(previous)
+        sender.close()
+
+    assert nucleus.received == [
+        {
+            "execution_token": "token",
+            "task": {
+                "project": "project",
+                "domain": "development",
+                "name": "wf.deseq2",
+                "version": "1.0.0",
+            },
+            "task_attempt_number": "0",
+            "type": "info",
+            "data": {"body": "hello"},
+        }
+    ]
@@ -0,0 +1,103 @@
+import shutil
+import subprocess
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from wf.r_worker import RWorker
+
+repo = Path(__file__).resolve().parent
+
+output_dirs = [
+    "Data",
+    "Data/QC",
+    "Data/Contrast",
+    "Plots",
+    "Plots/QC",
+    "Plots/QC/Variance P-Value",
+    "Plots/QC/PCA",
+    "Plots/Contrast",
+]
+
+
+def has_r_packages() -> bool:
+    if shutil.which("Rscript") is None:
+        return False
+    res = subprocess.run(
+        ["Rscript", "-e", "library(DESeq2); library(plotly)"],
+        capture_output=True,
+    )
+    return res.returncode == 0
+
+
+pytestmark = pytest.mark.skipif(
+    not has_r_packages(), reason="needs R with the workflow's packages"
+)
+
+
+def ibd_args(res: Path) -> List[str]:
+    return [
+        str(repo / "data/ibd/ibd_design.csv"),
+        "Sample",
+        "Condition",
+        "",
+        "",
+        str(repo / "data/ibd/ibd_counts.csv"),
+        "gene_id",
+        "",
+        "30",
+        str(res),
+        "2",
+        "symmetric",
+        "2",
+        "false",
+        "false",
+        "html",
+        "20000",
+        "cdn",
+        "auto",
+    ]
+
+
+def test_second_job_still_saves_widgets(tmp_path):
+    worker = RWorker({"OMP_NUM_THREADS": "2", "OPENBLAS_NUM_THREADS": "2"})
+    try:
+        for i in range(2):
+            res = tmp_path / str(i) / "res"
+            for x in output_dirs:
+                (res / x).mkdir(parents=True, exist_ok=True)
+
+            job = worker.run(ibd_args(res))
+            out = b"".join(job).decode("utf-8")
+
+            assert job.status == 0, out
+            # plot failures are caught and logged, not fatal
+            assert "infinite recursion" not in out
+            assert "nested too deeply" not in out
+            assert (res / "Plots/Sample Correlation.html").exists()
+            assert (res / "Plots/QC/Counts Heatmap.html").exists()
+    finally:
+        worker.close()
+
+
+def test_unfinished_job_does_not_block_the_next(tmp_path):
+    worker = RWorker({"OMP_NUM_THREADS": "2", "OPENBLAS_NUM_THREADS": "2"})
+    try:
+        for i in range(2):
+            res = tmp_path / str(i) / "res"
+            for x in output_dirs:
+                (res / x).mkdir(parents=True, exist_ok=True)
+
+        job = worker.run(ibd_args(tmp_path / "0" / "res"))
+        with pytest.raises(ValueError):
+            for _ in job:
+                raise ValueError("caller failed while streaming")
+        assert job.status is not None
+        assert not worker.alive
+
+        job = worker.run(ibd_args(tmp_path / "1" / "res"))
+        out = b"".join(job).decode("utf-8")
+        assert job.status == 0, out
+    finally:
+        worker.close()
@@ -0,0 +1,229 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import pytest
+from latch.registry.types import Column, InvalidValue
+
+from wf.registry import RegistryFetcher, gql_executor
+
+
+def db_value(x: Any) -> Dict[str, Any]:
+    return {"valid": True, "value": x}
+
+
+def column(key: str, primitive: str, allow_empty: bool = False) -> Column:
+    return Column(
+        key=key,
+        type=object,
+        upstream_type={"type": {"primitive": primitive}, "allowEmpty": allow_empty},
+    )
+
+
+table_columns = {
+    x.key: x
+    for x in [
+        column("Condition", "string"),
+        column("Dose", "number"),
+        column("Batch", "integer", allow_empty=True),
+        column("Notes", "string", allow_empty=True),
+    ]
+}
+
+
+class RegistryStandIn(ThreadingHTTPServer):
+    """Answers the registry queries of `wf.registry` for one table."""
+
+    def __init__(self, table_id: str, records: Dict[str, Tuple[str, Dict[str, Any]]]):
+        super().__init__(("127.0.0.1", 0), RegistryHandler)
+        self.table_id = table_id
+        self.records = records
+        self.paging_supported = True
+        self.column_filter_supported = True
+        # operation names of the queries received
+        self.queries: List[str] = []
+        # keys of the values sent in pages
+        self.values_sent: Set[Optional[str]] = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/graphql"
+
+    def nodes(self) -> List[Dict[str, Any]]:
+        res = []
+        for id, (name, values) in self.records.items():
+            # records without values still have a row
+            cells: List[Tuple[Optional[str], Any]] = list(values.items())
+            for k, v in cells if len(cells) > 0 else [(None, None)]:
+                res.append(
+                    {
+                        "sampleId": id,
+                        "sampleName": name,
+                        "sampleDataKey": k,
+                        "sampleDataValue": v,
+                    }
+                )
+        # the pages are requested sorted by record and key
+        res.sort(key=lambda x: (int(x["sampleId"]), x["sampleDataKey"] or ""))
+        return res
+
+    def page(self, nodes: List[Dict[str, Any]], variables: Dict[str, Any]):
+        page = nodes[variables["offset"] : variables["offset"] + variables["first"]]
+        return {
+            "data": {
+                "catalogExperiment": {
+                    "allSamples": {"totalCount": len(nodes), "nodes": page}
+                }
+            }
+        }
+
+    def answer(self, op: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+        if variables["id"] != self.table_id:
+            return {"data": {"catalogExperiment": None}}
+
+        if op in {"DesignMatrixNames", "DesignMatrixColumn"}:
+            if not self.column_filter_supported:
+                return {"errors": [{"message": 'Unknown argument "condition"'}]}
+
+            if op == "DesignMatrixNames":
+                nodes = [
+                    {"sampleId": x["sampleId"], "sampleName": x["sampleName"]}
+                    for x in self.nodes()
+                ]
+                return self.page(nodes, variables)
+
+            nodes = [x for x in self.nodes() if x["sampleDataKey"] == variables["key"]]
+            self.values_sent.update(x["sampleDataKey"] for x in nodes)
+            return self.page(nodes, variables)
+
+        if op == "DesignMatrixPage":
+            if not self.paging_supported:
+                return {"errors": [{"message": 'Unknown argument "offset"'}]}
+
+            nodes = self.nodes()
+            self.values_sent.update(x["sampleDataKey"] for x in nodes)
+            return self.page(nodes, variables)
+
+        assert op == "DesignMatrixAll"
+        return {"data": {"catalogExperiment": {"allSamples": {"nodes": self.nodes()}}}}
+
+
+class RegistryHandler(BaseHTTPRequestHandler):
+    server: RegistryStandIn
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        op = req["query"].split("query ", 1)[1].split("(", 1)[0].strip()
+        with self.server.lock:
+            self.server.queries.append(op)
+
+        body = json.dumps(self.server.answer(op, req["variables"])).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def registry() -> Iterator[RegistryStandIn]:
+    records = {
+        str(i): (
+            f"sample_{i}",
+            {
+                "Condition": db_value("treated" if i % 2 == 0 else "control"),
+                "Dose": db_value(i % 3),
+                "Batch": db_value(i % 2),
+                "Notes": db_value("x" * 100),
+            },
+        )
+        for i in range(1, 26)
+    }
+    # no values at all
+    records["26"] = ("sample_26", {})
+
+    server = RegistryStandIn("42", records)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def fetcher(registry: RegistryStandIn) -> RegistryFetcher:
+    return RegistryFetcher(
+        gql_executor(registry.url, {}),
+        columns=lambda _: table_columns,
+        page_size=7,
+        max_workers=4,
+    )
+
+
+def test_fetches_every_record_in_pages(registry: RegistryStandIn):
+    snapshot = fetcher(registry).fetch("42", ["Condition", "Dose", "Batch"])
+
+    assert [x.name for x in snapshot.records] == [f"sample_{i}" for i in range(1, 27)]
+    # values are converted like `Table.list_records` converts them
+    assert snapshot.records[0].values == {
+        "Condition": "control",
+        "Dose": 1.0,
+        "Batch": 1,
+    }
+    assert snapshot.records[2].values == {
+        "Condition": "control",
+        "Dose": 0.0,
+        "Batch": 1,
+    }
+    # required columns without a value are invalid, as in `Table.list_records`
+    assert snapshot.records[25].values == {
+        "Condition": InvalidValue(""),
+        "Dose": InvalidValue(""),
+    }
+
+    # only the requested columns are sent: 101 name rows and 26 values of
+    # each column, in pages of 7
+    assert registry.values_sent == {"Condition", "Dose", "Batch"}
+    assert registry.queries.count("DesignMatrixNames") == 15
+    assert registry.queries.count("DesignMatrixColumn") == 3 * 4
+    assert "DesignMatrixPage" not in registry.queries
+    assert "DesignMatrixAll" not in registry.queries
+
+
+def test_batch_reports_share_the_table(registry: RegistryStandIn):
+    f = fetcher(registry)
+    f.fetch("42", ["Condition"])
+    registry.queries.clear()
+
+    snapshot = f.fetch("42", ["Condition", "Dose"])
+    # only the column not fetched yet is requested
+    assert set(registry.queries) == {"DesignMatrixColumn"}
+    assert snapshot.records[1].values == {"Condition": "treated", "Dose": 2.0}
+
+    registry.queries.clear()
+    f.fetch("42", ["Dose"])
+    assert registry.queries == []
+
+
+def test_falls_back_to_paging_the_whole_table(registry: RegistryStandIn):
+    registry.column_filter_supported = False
+    snapshot = fetcher(registry).fetch("42", ["Condition"])
+
+    assert registry.queries.count("DesignMatrixPage") == 15
+    assert snapshot.records[1].values == {"Condition": "treated"}
+    assert snapshot.records[25].values == {"Condition": InvalidValue("")}
+    assert len(snapshot.records) == 26
+
+
+def test_falls_back_to_the_full_query(registry: RegistryStandIn):
+    registry.column_filter_supported = False
+    registry.paging_supported = False
+    snapshot = fetcher(registry).fetch("42", ["Notes"])
+
+    assert registry.queries[-1] == "DesignMatrixAll"
+    assert snapshot.records[0].values == {"Notes": "x" * 100}
+    assert len(snapshot.records) == 26
@@ -0,0 +1,59 @@
+from wf.deseqreport import ReportReader, write_report
+from wf.report_gen import compress_contrasts, inline_widget_libraries
+
+
+def test_inlines_local_widget_libraries(tmp_path):
+    lib = tmp_path / "Plots/lib/htmlwidgets-1.5.4"
+    lib.mkdir(parents=True)
+    (lib / "htmlwidgets.js").write_text('document.write("</script>");')
+    (lib / "widget.css").write_text(".plotly { width: 100%; }")
+
+    widget = tmp_path / "Plots/QC/Counts Heatmap.html"
+    widget.parent.mkdir(parents=True)
+    widget.write_text(
+        "<head>"
+        '<script src="../lib/htmlwidgets-1.5.4/htmlwidgets.js"></script>'
+        '<link href="../lib/htmlwidgets-1.5.4/widget.css" rel="stylesheet" />'
+        '<script src="https://cdn.plot.ly/plotly-2.5.1.min.js"></script>'
+        "</head>"
+    )
+
+    out = inline_widget_libraries(widget, tmp_path / "inlined.html")
+
+    assert out.read_text() == (
+        "<head>"
+        '<script>document.write("<\\/script>");</script>'
+        "<style>.plotly { width: 100%; }</style>"
+        '<script src="https://cdn.plot.ly/plotly-2.5.1.min.js"></script>'
+        "</head>"
+    )
+
+
+def test_compresses_only_contrast_entries(tmp_path):
+    files = {
+        "sample_corr": tmp_path / "Sample Correlation.html",
+        "pca/Condition": tmp_path / "Condition.html",
+        "contrast/_genes": tmp_path / "genes.txt",
+        "contrast/Condition/a/b/table": tmp_path / "0.bin",
+        "contrast/Condition/a/b/ma": tmp_path / "MA.html",
+        "contrast/Condition/a/b/volcano": tmp_path / "Volcano.html",
+        "contrast/Condition/a/b/qc": tmp_path / "qc.png",
+    }
+    for k, p in files.items():
+        p.write_bytes(b"<div>" + k.encode() * 200 + b"</div>")
+
+    index = write_report(tmp_path / "r.deseqreport", {}, files, compress_contrasts)
+
+    assert {k: v.compression for k, v in index.items()} == {
+        "sample_corr": None,
+        "pca/Condition": None,
+        "contrast/_genes": "gzip",
+        "contrast/Condition/a/b/table": "gzip",
+        "contrast/Condition/a/b/ma": "gzip",
+        "contrast/Condition/a/b/volcano": "gzip",
+        "contrast/Condition/a/b/qc": None,
+    }
+
+    with ReportReader(tmp_path / "r.deseqreport") as r:
+        for k, p in files.items():
+            assert r.read(k) == p.read_bytes()
@@ -1,20 +1,8 @@
+import argparse
+import sys
 from pathlib import Path
-import json
 
-out_p = Path("Report.deseqreport.out")
-if out_p.exists():
-    raise RuntimeError("Refusing to override output")
-
-blob = Path("./Report.deseqreport").read_bytes()
-cur = 0
-
-l = int.from_bytes(blob[cur : cur + 4], byteorder="little", signed=False)
-cur += 4
-
-json_blob = blob[cur : cur + l]
-cur += l
-
-data = json.loads(json_blob.decode())
+from wf.deseqreport import ReportReader
 
 rename_map = {
     "_dds": "dds.rds",
@@ -23,18 +11,45 @@ rename_map = {
     "size_factor_qc": "Size Factor QC.html",
 }
 
-for edata in data["embedded_data_order"]:
-    assert isinstance(edata, str)
-
-    size = data["embedded_data_sizes"][edata]
-    print(f"{edata}: {size}")
-
-    out_name = rename_map.get(edata, edata)
-
-    cur_p = out_p / out_name
-    if cur_p.parent.name == "pca":
-        cur_p = cur_p.with_suffix(".html")
-
-    cur_p.parent.mkdir(parents=True, exist_ok=True)
-    cur_p.write_bytes(blob[cur : cur + size])
-    cur += size
+parser = argparse.ArgumentParser(
+    description="List or extract the entries embedded in a .deseqreport"
+)
+parser.add_argument("report", nargs="?", default="./Report.deseqreport", type=Path)
+parser.add_argument(
+    "entries", nargs="*", help="Entries to extract (default: all of them)"
+)
+parser.add_argument("-l", "--list", action="store_true", help="Only list entries")
+parser.add_argument("-o", "--output", default=Path("Report.deseqreport.out"), type=Path)
+parser.add_argument(
+    "--no-verify", action="store_true", help="Skip checksum verification"
+)
+args = parser.parse_args()
+
+with ReportReader(args.report) as report:
+    if args.list:
+        print(f"version: {report.version}")
+        print(f"report name: {report.header.get('report_name')}")
+        for k, e in report.index.items():
+            compression = e.compression if e.compression is not None else "none"
+            print(f"{k}: {e.size} bytes ({e.length} stored, {compression})")
+        sys.exit(0)
+
+    keys = args.entries if len(args.entries) > 0 else report.keys()
+    unknown = [k for k in keys if k not in report]
+    if len(unknown) > 0:
+        raise RuntimeError(f"Unknown entries: {', '.join(unknown)}")
+
+    out_p: Path = args.output
+    if out_p.exists() and len(args.entries) == 0:
+        raise RuntimeError("Refusing to override output")
+
+    for k in keys:
+        e = report.index[k]
+        print(f"{k}: {e.size}")
+
+        cur_p = out_p / rename_map.get(k, k)
+        if cur_p.parent.name == "pca":
+            cur_p = cur_p.with_suffix(".html")
+
+        cur_p.parent.mkdir(parents=True, exist_ok=True)
+        report.extract(k, cur_p, verify=not args.no_verify)
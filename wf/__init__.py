@@ -2,16 +2,16 @@ import csv
 from dataclasses import dataclass
 import functools
 import json
-import subprocess
 import sys
+import tempfile
+import traceback
 from textwrap import dedent
-import typing
-import zipfile
-from io import SEEK_SET
 import re
+import shutil
 from pathlib import Path
-from typing import Annotated, Any, Dict, List, Optional, TextIO, Tuple
+from typing import Annotated, Any, Dict, List, Optional, Union
 
+from dataclasses_json import dataclass_json
 from flytekit.core.annotation import FlyteAnnotation
 from latch import medium_task, workflow
 from latch.resources.launch_plan import LaunchPlan
@@ -30,12 +30,30 @@ from latch.types import (
     Params,
 )
 from latch.types.metadata import FlowBase
-from openpyxl import load_workbook
-from openpyxl.cell import Cell
-from openpyxl.utils.exceptions import InvalidFileException
 
-from wf.report_gen import generate_report
-from wf.util import error, message, warn, warning
+from wf.deseqreport import write_report
+from wf.fit_cache import FitCache, LatchFitCache, fit_cache_key
+from wf.ingest import LowCountFilter, ingest_counts
+from wf.merge import CountTableMerge
+from wf.r_worker import RWorker, run_deseq2, shared_worker
+from wf.registry import registry_fetcher
+from wf.report_gen import (
+    compress_contrasts,
+    generate_report,
+    inline_widget_libraries,
+    pack_contrasts,
+)
+from wf.tabular import is_xlsx, open_table, write_csv
+from wf.timings import RssSampler, Timings
+from wf.util import (
+    available_cpu_count,
+    error,
+    flush_messages,
+    message,
+    warn,
+    warning,
+)
+from wf.validate import validate_counts
 
 sys.stdout.reconfigure(line_buffering=True)
 
@@ -43,48 +61,68 @@ sys.stdout.reconfigure(line_buffering=True)
 # exported from excel
 functools.partial(open, encoding="utf-8-sig")
 
-csv.field_size_limit(sys.maxsize)
-
-
-def csv_tsv_reader(f: TextIO, use_dict_reader: bool = False):
-    sniff = csv.Sniffer()
-    dialect = sniff.sniff(f.readline())
-    f.seek(0, SEEK_SET)
 
-    if use_dict_reader:
-        return csv.DictReader(f, dialect=dialect)
-    else:
-        return csv.reader(f, dialect=dialect)
+registry_table_re = re.compile(r"^latch://(\d+)\.table\.registry$")
 
 
-def pull_gene_from_header(csv: Path) -> Optional[str]:
-    with open(csv) as f:
-        r = csv_tsv_reader(f)
-        return next(r)[0]
+def _cpu_cores(requested: Optional[int]) -> int:
+    available_cores = available_cpu_count()
+    if requested is None:
+        return available_cores
+    if requested > available_cores:
+        warn(
+            f"Requested {requested} CPU cores but only {available_cores}"
+            " are available"
+        )
+        return available_cores
+    return max(1, requested)
 
 
-registry_table_re = re.compile(r"^latch://(\d+)\.table\.registry$")
+def _r_env(number_of_cpu_cores: int) -> Dict[str, str]:
+    # the R script narrows these per phase so that worker pools and BLAS do not
+    # oversubscribe the cores
+    return {
+        "OMP_NUM_THREADS": str(number_of_cpu_cores),
+        "OPENBLAS_NUM_THREADS": str(number_of_cpu_cores),
+    }
 
 
-@medium_task
-def deseq2(
+def deseq2_report(
     report_name: str,
+    output_loc: str,
+    work_dir: Path,
+    *,
+    number_of_cpu_cores: int,
     count_table_source: str = "single",
     raw_count_table: Optional[LatchFile] = None,
     raw_count_tables: List[LatchFile] = [],
+    count_table_missing_genes: str = "fill",
     count_table_gene_id_column: Optional[str] = None,
-    output_location_type: str = "default",
-    output_location: Optional[LatchDir] = None,
     conditions_source: str = "manual",
     manual_conditions: List[List[str]] = [],
     conditions_table: Optional[LatchFile] = None,
     design_matrix_sample_id_column: Optional[str] = None,
     design_formula: List[List[str]] = [["condition", "explanatory"]],
+    prefilter_min_count: int = 0,
+    prefilter_min_cpm: float = 0.0,
+    prefilter_min_samples: int = 1,
     number_of_genes_to_plot: int = 30,
-) -> LatchDir:
-    # Hack until proper string conditionals exist on bulk
-    if conditions_source == "none":
-        return LatchDir("/root/wf")
+    number_of_contrast_workers: int = 4,
+    contrast_mode: str = "symmetric",
+    fit_engine: str = "auto",
+    plot_output_format: str = "both",
+    plot_max_points: int = 20000,
+    plot_widget_libraries: str = "cdn",
+    r_worker: Optional[RWorker] = None,
+    previous_output: Optional[LatchDir] = None,
+    fit_cache_location: Optional[LatchDir] = None,
+) -> Path:
+    """Build one report in `work_dir` and return its local output directory.
+
+    Intermediate files and the outputs (`work_dir/res`) of different calls do
+    not overlap as long as their `work_dir`s differ.
+    """
+    timings = Timings()
 
     if count_table_gene_id_column is None:
         count_table_gene_id_column = "gene_id"
@@ -114,47 +152,79 @@ def deseq2(
             raise ValueError("Expected the single count table source to be set")
         count_table_remote = raw_count_table.remote_source
         raw_count_table_p = Path(raw_count_table)
-        count_table_gene_id_column = pull_gene_from_header(raw_count_table_p)
     else:
-        raw_count_table_p = Path("combined_counts.csv")
-        with raw_count_table_p.open("w") as f:
-            w = csv.writer(f)
-
-            input_fds = [Path(x).open("r") for x in raw_count_tables]
-            try:
-                readers = [csv_tsv_reader(f) for f in input_fds]
-
-                for line_idx, line in enumerate(readers[0]):
-                    if line_idx == 0:
-                        count_table_gene_id_column = line[0]
+        if count_table_missing_genes not in {"fill", "drop"}:
+            error(
+                {
+                    "title": "Invalid missing gene policy",
+                    "body": (
+                        f"Expected 'fill' or 'drop', got '{count_table_missing_genes}'"
+                    ),
+                }
+            )
+            raise RuntimeError("Invalid missing gene policy")
 
-                    for r in readers[1:]:
-                        other_line = next(r)
+        raw_count_table_p = None
+        count_table_remote = "combined"
 
-                        if other_line[0] != line[0]:
-                            raise ValueError(
-                                "Counts tables being combined are not sorted in the"
-                                f" same order: {other_line[0]} != {line[0]} on line"
-                                f" {line_idx}"
-                            )
+    if contrast_mode not in {"symmetric", "full"}:
+        error(
+            {
+                "title": "Invalid contrast mode",
+                "body": f"Expected 'symmetric' or 'full', got '{contrast_mode}'",
+            }
+        )
+        raise RuntimeError("Invalid contrast mode")
 
-                        line.extend(other_line[1:])
+    if fit_engine not in {"auto", "standard", "glmGamPoi"}:
+        error(
+            {
+                "title": "Invalid fit engine",
+                "body": (
+                    f"Expected 'auto', 'standard', or 'glmGamPoi', got '{fit_engine}'"
+                ),
+            }
+        )
+        raise RuntimeError("Invalid fit engine")
 
-                    w.writerow(line)
-            finally:
-                for f in input_fds:
-                    f.close()
+    if plot_output_format not in {"png", "html", "both", "none"}:
+        error(
+            {
+                "title": "Invalid plot output format",
+                "body": (
+                    "Expected 'png', 'html', 'both', or 'none', got"
+                    f" '{plot_output_format}'"
+                ),
+            }
+        )
+        raise RuntimeError("Invalid plot output format")
 
-        count_table_remote = "combined"
+    if plot_widget_libraries not in {"cdn", "offline"}:
+        error(
+            {
+                "title": "Invalid interactive plot library mode",
+                "body": f"Expected 'cdn' or 'offline', got '{plot_widget_libraries}'",
+            }
+        )
+        raise RuntimeError("Invalid interactive plot library mode")
 
-    if output_location_type == "custom" and output_location is None:
+    prefilter = LowCountFilter(
+        min_count=prefilter_min_count,
+        min_cpm=prefilter_min_cpm,
+        min_samples=prefilter_min_samples,
+    )
+    if prefilter.min_count < 0 or prefilter.min_cpm < 0 or prefilter.min_samples < 1:
         error(
             {
-                "title": "Invariant violation",
-                "body": "Expected a custom output location but it is null",
+                "title": "Invalid low count filter",
+                "body": (
+                    "Expected a non-negative minimum count and CPM and at least one"
+                    f" sample, got count {prefilter.min_count}, CPM"
+                    f" {prefilter.min_cpm} and {prefilter.min_samples} samples"
+                ),
             }
         )
-        raise RuntimeError("custom output location requested but not specified")
+        raise RuntimeError("Invalid low count filter")
 
     if conditions_source == "table" and conditions_table is None:
         error(
@@ -171,19 +241,23 @@ def deseq2(
         ">>> Parameters",
         f"Count table: '{count_table_remote}'",
         f"Report name: '{report_name}'",
+        f"Low Count Filter: '{prefilter.describe()}'",
         f"Number of Genes: '{str(number_of_genes_to_plot)}'",
+        f"Contrast Workers: '{str(number_of_contrast_workers)}'",
+        f"Contrast Mode: '{contrast_mode}'",
+        f"Fit Engine: '{fit_engine}'",
+        f"Plot Output Format: '{plot_output_format}'",
+        f"Max Points per Interactive Plot: '{plot_max_points}'",
+        f"Interactive Plot Libraries: '{plot_widget_libraries}'",
+        f"CPU Cores: '{number_of_cpu_cores}' (available: {available_cpu_count()})",
+        f"Persistent R Worker: '{r_worker is not None}'",
         sep="\n",
     )
 
-    output_loc = f"latch:///DESeq2 Results/{report_name.replace('/', '_')}"
-    if output_location_type == "custom":
-        assert output_location is not None
-        output_loc = output_location.remote_path
-
-    print(f"Output location: '{output_loc}' [{output_location_type}]")
+    print(f"Output location: '{output_loc}'")
 
     conditions_table_registry_id = None
-    if conditions_table is not None:
+    if conditions_table is not None and conditions_table.remote_source is not None:
         match = registry_table_re.match(conditions_table.remote_source)
         if match is not None:
             conditions_table_registry_id = match.group(1)
@@ -192,34 +266,39 @@ def deseq2(
     if conditions_table_registry_id is not None:
         print(f"Design matrix registry table: '{conditions_table_registry_id}'")
 
-        from latch.registry.table import Table
-
         columns = (
             design_formula_explanatory
             + design_formula_confounding
             + design_formula_cluster
         )
 
-        conditions_table_p = Path("conditions.csv")
+        fetched_columns = list(columns)
+        if design_matrix_sample_id_column != "name":
+            fetched_columns.append(design_matrix_sample_id_column)
+
+        snapshot = registry_fetcher().fetch(
+            conditions_table_registry_id, fetched_columns
+        )
+        print(f"  {len(snapshot.records)} records")
+
+        conditions_table_p = work_dir / "conditions.csv"
         with conditions_table_p.open("w") as f:
             w = csv.DictWriter(f, fieldnames=[design_matrix_sample_id_column, *columns])
             w.writeheader()
 
-            reg = Table(conditions_table_registry_id)
-            for page in reg.list_records():
-                for rec in page.values():
-                    sample_id = rec.get_name()
-                    vals = rec.get_values()
+            for rec in snapshot.records:
+                sample_id = rec.name
+                vals = rec.values
 
-                    if design_matrix_sample_id_column != "name":
-                        sample_id = vals[design_matrix_sample_id_column]
+                if design_matrix_sample_id_column != "name":
+                    sample_id = vals[design_matrix_sample_id_column]
 
-                    w.writerow(
-                        {
-                            design_matrix_sample_id_column: sample_id,
-                        }
-                        | {k: vals[k] for k in columns if k in vals}
-                    )
+                w.writerow(
+                    {
+                        design_matrix_sample_id_column: sample_id,
+                    }
+                    | {k: vals[k] for k in columns if k in vals}
+                )
     elif conditions_source == "table":
         assert conditions_table is not None
         conditions_table_p = Path(conditions_table)
@@ -235,7 +314,7 @@ def deseq2(
             )
             raise RuntimeError("Design matrix is empty")
 
-        conditions_table_p = Path("conditions.csv")
+        conditions_table_p = work_dir / "conditions.csv"
         with conditions_table_p.open("w") as f:
             w = csv.DictWriter(
                 f, fieldnames=[design_matrix_sample_id_column, "condition"]
@@ -249,132 +328,109 @@ def deseq2(
                 for cond in manual_conditions
             )
 
-    print()
-    excel_okay = False
-    genes = set()
-    try:
-        workbook = load_workbook(str(raw_count_table_p))
-        sheet = workbook.worksheets[0]
-
-        headers = None
-        gene_id_column_idx = None
-        for row_ in sheet.iter_rows():
-            row = typing.cast(Tuple[Cell], row_)
-            if headers is None:
-                headers = row
-
-                for idx, h in enumerate(headers):
-                    if h.value != count_table_gene_id_column:
-                        continue
-                    gene_id_column_idx = idx
-                    break
-
-                if gene_id_column_idx is None:
-                    error(
-                        {
-                            "title": "Invalid gene ID column selected",
-                            "body": [
-                                (
-                                    f"Gene ID column '{count_table_gene_id_column}'"
-                                    " could not be found"
-                                ),
-                                {
-                                    "section": "Available Columns:",
-                                    "body": {"list": [str(h.value) for h in headers]},
-                                },
-                            ],
-                        }
-                    )
-                    raise RuntimeError("Invalid sample ID column")
-
-                continue
-
-            assert gene_id_column_idx is not None
-
-            genes.add(row[gene_id_column_idx].value)
-
-        excel_okay = True
-    except InvalidFileException:
-        pass
-    except zipfile.BadZipFile:
-        pass
-
-    if not excel_okay:
-        with raw_count_table_p.open("r") as f:
-            r = csv_tsv_reader(f, use_dict_reader=True)
-            for row in r:
-                items = row.items()
-                genes.add(row[count_table_gene_id_column])
-
     print()
     print(
         "Design matrix:"
         f" [{'table file' if conditions_source == 'table' else 'manual input'}]"
     )
-    excel_okay = False
-    try:
-        workbook = load_workbook(str(conditions_table_p))
-        sheet = workbook.worksheets[0]
-
-        headers = None
-        sample_id_column_idx = None
-        for row_ in sheet.iter_rows():
-            row = typing.cast(Tuple[Cell], row_)
-            if headers is None:
-                headers = row
-
-                for idx, h in enumerate(headers):
-                    if h.value != design_matrix_sample_id_column:
-                        continue
-                    sample_id_column_idx = idx
-                    break
-
-                if sample_id_column_idx is None:
-                    error(
+    design_samples: List[str] = []
+    with open_table(conditions_table_p) as (headers, rows):
+        if design_matrix_sample_id_column not in headers:
+            error(
+                {
+                    "title": "Invalid sample ID column selected",
+                    "body": [
+                        (
+                            "Sample ID column"
+                            f" '{design_matrix_sample_id_column}' could not be"
+                            " found"
+                        ),
                         {
-                            "title": "Invalid sample ID column selected",
-                            "body": [
-                                (
-                                    "Sample ID column"
-                                    f" '{design_matrix_sample_id_column}' could not be"
-                                    " found"
-                                ),
-                                {
-                                    "section": "Available Columns:",
-                                    "body": {"list": [str(h.value) for h in headers]},
-                                },
-                            ],
-                        }
-                    )
-                    raise RuntimeError("Invalid sample ID column")
+                            "section": "Available Columns:",
+                            "body": {"list": headers},
+                        },
+                    ],
+                }
+            )
+            raise RuntimeError("Invalid sample ID column")
+        sample_id_column_idx = headers.index(design_matrix_sample_id_column)
 
+        design_rows = []
+        for row in rows:
+            if sample_id_column_idx >= len(row):
+                continue
+            sample_id = row[sample_id_column_idx]
+            if sample_id is None or sample_id == "":
                 continue
 
-            assert sample_id_column_idx is not None
-
+            design_samples.append(str(sample_id))
+            design_rows.append(row)
             print(
-                f"{row[sample_id_column_idx].value}: "
-                f"{', '.join(str(x.value) for idx, x in enumerate(row) if idx != sample_id_column_idx)}"
+                f"{sample_id}: "
+                f"{', '.join(str(x) for idx, x in enumerate(row) if idx != sample_id_column_idx)}"
             )
 
-        excel_okay = True
-    except InvalidFileException:
-        pass
-    except zipfile.BadZipFile:
-        pass
-
-    if not excel_okay:
-        with conditions_table_p.open("r") as f:
-            r = csv_tsv_reader(f, use_dict_reader=True)
-            for row in r:
-                items = row.items()
-                print(
-                    f"{row[design_matrix_sample_id_column]}: "
-                    f"{', '.join(str(x[1]) for x in items if x[0] != design_matrix_sample_id_column)}"
+    if is_xlsx(conditions_table_p):
+        # the R script reads this copy instead of parsing the workbook again
+        conditions_table_p = work_dir / "design_matrix.csv"
+        write_csv(conditions_table_p, headers, design_rows)
+    print()
+
+    merge_report = None
+    print("Ingesting the counts table")
+    with timings.phase("ingestion"):
+        if raw_count_table_p is not None:
+            with open_table(raw_count_table_p) as (header, rows):
+                ingested = ingest_counts(
+                    header,
+                    rows,
+                    count_table_gene_id_column,
+                    design_samples,
+                    work_dir / "counts.ingested",
+                    prefilter,
                 )
+        else:
+            with CountTableMerge(
+                [Path(x) for x in raw_count_tables],
+                missing_genes=count_table_missing_genes,
+            ) as merge:
+                ingested = ingest_counts(
+                    merge.header,
+                    merge.rows(),
+                    count_table_gene_id_column,
+                    design_samples,
+                    work_dir / "counts.ingested",
+                    prefilter,
+                )
+
+            merge.print_summary()
+            merge_report = merge.report
+
+    count_table_gene_id_column = ingested.gene_id_column
+    genes = ingested.genes
+
+    print(
+        f"  Gene ID column: '{ingested.gene_id_column}'",
+        f"  {ingested.num_genes} genes x {len(ingested.samples)} samples",
+        sep="\n",
+    )
+    if ingested.num_prefiltered > 0:
+        print(
+            f"  {ingested.num_prefiltered} genes removed by the low count filter"
+            f" ({prefilter.describe()})"
+        )
+    if len(ingested.ignored_columns) > 0:
+        print(
+            "  Columns not in the design matrix:"
+            f" {', '.join(ingested.ignored_columns)}"
+        )
+
+    # fail here in seconds instead of minutes later inside the R script
+    with timings.phase("validation"):
+        validate_counts(ingested)
     print()
 
-    local_output_loc = Path("./res").resolve()
+    local_output_loc = (work_dir / "res").resolve()
     dirs = [
         local_output_loc / x
         for x in [
@@ -391,38 +447,107 @@ def deseq2(
     for x in dirs:
         x.mkdir(exist_ok=True, parents=True)
 
+    incremental = previous_output is not None
+    if incremental:
+        assert previous_output is not None
+        print(f"Copying previous results from '{previous_output.remote_path}'")
+        shutil.copytree(Path(previous_output), local_output_loc, dirs_exist_ok=True)
+
+    # written after the previous results so that they describe this run
+    merge_report_p = local_output_loc / "Data/QC/Merge Report.json"
+    if merge_report is not None:
+        with merge_report_p.open("w") as f:
+            json.dump(merge_report.dict(), f, indent=2)
+    else:
+        # left over from a previous run with several count tables
+        merge_report_p.unlink(missing_ok=True)
+
+    prefiltered_p = local_output_loc / "Data/QC/Prefiltered Genes.csv"
+    if (ingested.path / "prefiltered.csv").exists():
+        shutil.copyfile(ingested.path / "prefiltered.csv", prefiltered_p)
+    else:
+        # left over from a previous run with a different filter
+        prefiltered_p.unlink(missing_ok=True)
+
+    fit_cache: Union[FitCache, LatchFitCache] = FitCache()
+    if fit_cache_location is not None:
+        fit_cache = LatchFitCache(fit_cache_location)
+    fit_key = fit_cache_key(
+        ingested,
+        conditions_table_p,
+        {
+            "sample_id_column": design_matrix_sample_id_column,
+            "explanatory": design_formula_explanatory,
+            "confounding": design_formula_confounding,
+            "cluster": design_formula_cluster,
+            "fit_engine": fit_engine,
+        },
+    )
+    with timings.phase("fit cache restore"):
+        cache_hit = fit_cache.restore(fit_key, local_output_loc / "Data")
+    if fit_cache.enabled:
+        print(
+            f"Fit cache: {'hit' if cache_hit else 'miss'} for {fit_key[:16]}"
+            f" in '{fit_cache.root}'"
+        )
+
+    # the R script checks that a previous fit matches the current inputs and
+    # refits if it does not
+    reuse_fit = cache_hit or (
+        incremental and (local_output_loc / "Data/dds.rds").exists()
+    )
+
     print("\n" * 4)
-    res = subprocess.Popen(
+    res = run_deseq2(
         [
-            "Rscript",
-            "deseq2.r",
-            conditions_table_p.resolve(),
+            str(conditions_table_p.resolve()),
             design_matrix_sample_id_column,
             ",".join(design_formula_explanatory),
             ",".join(design_formula_confounding),
             ",".join(design_formula_cluster),
-            raw_count_table_p.resolve(),
+            str(ingested.path.resolve()),
             count_table_gene_id_column,
             ",".join([]),
             str(number_of_genes_to_plot),
             str(local_output_loc),
+            str(number_of_contrast_workers),
+            contrast_mode,
+            str(number_of_cpu_cores),
+            "true" if reuse_fit else "false",
+            "true" if incremental else "false",
+            plot_output_format,
+            str(plot_max_points),
+            plot_widget_libraries,
+            fit_engine,
         ],
-        cwd="./r_scripts",
-        stdout=subprocess.PIPE,
+        _r_env(number_of_cpu_cores),
+        r_worker,
     )
-    assert res.stdout is not None
-    for l_b in res.stdout:
-        l = l_b.decode("utf-8")
-        if l.startswith("__LATCH_MESSAGE_DATA"):
-            space1 = l.find(" ")
-            space2 = l.find(" ", space1 + 1)
-            typ = l[space1 + 1 : space2]
-            msg = l[space2 + 1 :]
-            message(typ, json.loads(msg))
-            continue
-        sys.stdout.write(l)
+    with timings.phase("r script"), RssSampler(res.pid, timings):
+        try:
+            for l_b in res:
+                l = l_b.decode("utf-8")
+                if l.startswith("__LATCH_MESSAGE_DATA"):
+                    space1 = l.find(" ")
+                    space2 = l.find(" ", space1 + 1)
+                    typ = l[space1 + 1 : space2]
+                    try:
+                        msg = json.loads(l[space2 + 1 :])
+                    except ValueError:
+                        warn(f"Could not parse a message from the R script: {l!r}")
+                        continue
 
-    ret_code = res.wait()
+                    if typ == "stage":
+                        timings.r_event(msg)
+                        continue
+                    message(typ, msg)
+                    continue
+                sys.stdout.write(l)
+
+            ret_code = res.wait()
+        finally:
+            # a job left running would block the next report of a batch
+            res.close()
     if ret_code != 0:
         warn(f"R script failed with return code {ret_code}")
         warning(
@@ -433,12 +558,13 @@ def deseq2(
         )
         raise RuntimeError("R script failed")
 
-    if not res.stdout.closed:
-        res.stdout.close()
+    if not cache_hit:
+        with timings.phase("fit cache store"):
+            fit_cache.store(fit_key, local_output_loc / "Data")
 
     print("\n")
 
-    res_p = Path("./res")
+    res_p = local_output_loc
     if len(list(res_p.iterdir())) == 0:
         error(
             {
@@ -448,49 +574,305 @@ def deseq2(
         )
         raise RuntimeError("No outputs produced")
 
-    level_options = generate_report()
-
-    with (res_p / "Report.deseqreport").open("wb") as f:
-        data_p = res_p / "Data"
-        plots_p = res_p / "Plots"
-        qc_plots_p = plots_p / "QC"
-
-        embedded_data = {
-            "_dds": data_p / "dds.rds",
-            "sample_corr": plots_p / "Sample Correlation.html",
-            "counts_heatmap": qc_plots_p / "Counts Heatmap.html",
-            "size_factor_qc": qc_plots_p / "Size Factor QC.html",
-            **{
-                "pca/" + x.with_suffix("").name: x
-                for x in (qc_plots_p / "PCA").iterdir()
-                if x.suffix == ".html"
-            },
-        }
-        embedded_data_order = sorted([k for k in embedded_data])
-
-        json_blob = json.dumps(
-            {
-                "report_name": report_name,
-                "genes": sorted(list(genes)),
-                "level_options": level_options,
-                "embedded_data_sizes": {
-                    k: v.stat().st_size for k, v in embedded_data.items()
+    with timings.phase("report generation"):
+        level_options, contrasts = generate_report(res_p)
+
+    data_p = res_p / "Data"
+    plots_p = res_p / "Plots"
+    qc_plots_p = plots_p / "QC"
+
+    embedded_data = {
+        "_dds": data_p / "dds.rds",
+        "sample_corr": plots_p / "Sample Correlation.html",
+        "counts_heatmap": qc_plots_p / "Counts Heatmap.html",
+        "size_factor_qc": qc_plots_p / "Size Factor QC.html",
+        **{
+            "pca/" + x.with_suffix("").name: x
+            for x in (qc_plots_p / "PCA").iterdir()
+            if x.suffix == ".html"
+        },
+    }
+
+    with timings.phase("report packaging"):
+        with tempfile.TemporaryDirectory(prefix="contrasts_") as tmp:
+            contrast_data, contrast_index = pack_contrasts(contrasts, Path(tmp))
+
+            entries = {**embedded_data, **contrast_data}
+            if plot_widget_libraries == "offline":
+                # embedded widgets are opened without Plots/lib next to them
+                widgets_p = Path(tmp) / "widgets"
+                widgets_p.mkdir()
+                for idx, (k, v) in enumerate(sorted(entries.items())):
+                    if v.suffix == ".html" and v.exists():
+                        entries[k] = inline_widget_libraries(
+                            v, widgets_p / f"{idx}.html"
+                        )
+
+            write_report(
+                res_p / "Report.deseqreport",
+                {
+                    "report_name": report_name,
+                    "genes": sorted(list(genes)),
+                    "level_options": level_options,
+                    "contrasts": contrast_index,
+                    "timings": timings.dict(),
                 },
-                "embedded_data_order": embedded_data_order,
+                entries,
+                compress=compress_contrasts,
+            )
+
+    timings.write(data_p / "QC" / "timings.json")
+    print(
+        "Timings:",
+        *(
+            f"  {k}: {v['total_seconds']:.1f}s ({v['count']}x)"
+            for k, v in timings.summary().items()
+        ),
+        f"  R peak memory: {timings.r_peak_rss_bytes / 1024**3:.2f} GiB",
+        sep="\n",
+    )
+
+    return res_p
+
+
+@dataclass_json
+@dataclass
+class DESeq2BatchJob:
+    report_name: str
+    raw_count_table: LatchFile
+    conditions_table: LatchFile
+    design_formula: List[List[str]]
+    count_table_gene_id_column: Optional[str] = None
+    design_matrix_sample_id_column: Optional[str] = None
+
+
+def deseq2_batch(
+    jobs: List[DESeq2BatchJob],
+    output_location: Optional[LatchDir],
+    *,
+    number_of_cpu_cores: int,
+    prefilter_min_count: int,
+    prefilter_min_cpm: float,
+    prefilter_min_samples: int,
+    number_of_genes_to_plot: int,
+    number_of_contrast_workers: int,
+    contrast_mode: str,
+    fit_engine: str,
+    plot_output_format: str,
+    plot_max_points: int,
+    plot_widget_libraries: str,
+    fit_cache_location: Optional[LatchDir],
+) -> LatchDir:
+    """Build several reports in the `deseq2` task.
+
+    The jobs run one after another in a single R worker, so container start,
+    imports and R package loading are paid once. Every job gets its own output
+    directory with its own `Report.deseqreport`, named after the report under
+    `output_location` or the default results directory. A failing job is
+    reported and skipped; the task only fails if every job does.
+    """
+    if len(jobs) == 0:
+        error(
+            {
+                "title": "No reports in the batch",
+                "body": "Add at least one report to the batch",
+            }
+        )
+        raise RuntimeError("Empty batch")
+
+    names = [x.report_name.replace("/", "_") for x in jobs]
+    duplicates = sorted({x for x in names if names.count(x) > 1})
+    if len(duplicates) > 0:
+        error(
+            {
+                "title": "Duplicate report names",
+                "body": [
+                    "Every job in a batch needs its own report name",
+                    {"section": "Duplicates:", "body": {"list": duplicates}},
+                ],
             }
         )
-        f.write(len(json_blob).to_bytes(4, "little", signed=False))
-        f.write(json_blob.encode("utf-8"))
+        raise RuntimeError("Duplicate report names")
+
+    r_worker = shared_worker(_r_env(number_of_cpu_cores))
+
+    output_root = "latch:///DESeq2 Results"
+    if output_location is not None:
+        output_root = output_location.remote_path.rstrip("/")
+
+    # the reports are moved here and uploaded together
+    reports_p = Path("batch/reports")
+    reports_p.mkdir(parents=True, exist_ok=True)
+
+    succeeded = 0
+    failed: List[str] = []
+    for idx, (job, name) in enumerate(zip(jobs, names)):
+        output_loc = f"{output_root}/{name}"
+
+        print(f">>> Batch job {idx + 1}/{len(jobs)}: '{job.report_name}'")
+        work_dir = Path("batch") / str(idx)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            res_p = deseq2_report(
+                job.report_name,
+                output_loc,
+                work_dir,
+                number_of_cpu_cores=number_of_cpu_cores,
+                raw_count_table=job.raw_count_table,
+                count_table_gene_id_column=job.count_table_gene_id_column,
+                conditions_source="table",
+                conditions_table=job.conditions_table,
+                design_matrix_sample_id_column=job.design_matrix_sample_id_column,
+                design_formula=job.design_formula,
+                prefilter_min_count=prefilter_min_count,
+                prefilter_min_cpm=prefilter_min_cpm,
+                prefilter_min_samples=prefilter_min_samples,
+                number_of_genes_to_plot=number_of_genes_to_plot,
+                number_of_contrast_workers=number_of_contrast_workers,
+                contrast_mode=contrast_mode,
+                fit_engine=fit_engine,
+                plot_output_format=plot_output_format,
+                plot_max_points=plot_max_points,
+                plot_widget_libraries=plot_widget_libraries,
+                r_worker=r_worker,
+                fit_cache_location=fit_cache_location,
+            )
+        except Exception as e:
+            traceback.print_exc()
+            warn(f"Batch job '{job.report_name}' failed: {e}")
+            failed.append(job.report_name)
+            continue
+
+        res_p.rename(reports_p / name)
+        succeeded += 1
+        print()
+
+    if len(failed) > 0:
+        warning(
+            {
+                "title": "Some reports failed",
+                "body": [
+                    f"{len(failed)} of {len(jobs)} reports failed",
+                    {"section": "Failed Reports:", "body": {"list": failed}},
+                ],
+            }
+        )
+
+    flush_messages()
+
+    if succeeded == 0:
+        raise RuntimeError("Every batch job failed")
+
+    return LatchDir(str(reports_p), remote_path=output_root)
+
 
-        for k in embedded_data_order:
-            x = embedded_data[k]
-            with x.open("rb") as fr:
-                data = fr.read1()
-                while len(data) > 0:
-                    f.write(data)
-                    data = fr.read1()
+@medium_task
+def deseq2(
+    report_name: str,
+    count_table_source: str = "single",
+    raw_count_table: Optional[LatchFile] = None,
+    raw_count_tables: List[LatchFile] = [],
+    count_table_missing_genes: str = "fill",
+    count_table_gene_id_column: Optional[str] = None,
+    output_location_type: str = "default",
+    output_location: Optional[LatchDir] = None,
+    conditions_source: str = "manual",
+    manual_conditions: List[List[str]] = [],
+    conditions_table: Optional[LatchFile] = None,
+    design_matrix_sample_id_column: Optional[str] = None,
+    design_formula: List[List[str]] = [["condition", "explanatory"]],
+    prefilter_min_count: int = 0,
+    prefilter_min_cpm: float = 0.0,
+    prefilter_min_samples: int = 1,
+    number_of_genes_to_plot: int = 30,
+    number_of_contrast_workers: int = 4,
+    contrast_mode: str = "symmetric",
+    fit_engine: str = "auto",
+    plot_output_format: str = "both",
+    plot_max_points: int = 20000,
+    plot_widget_libraries: str = "cdn",
+    number_of_cpu_cores: Optional[int] = None,
+    persistent_r_worker: bool = False,
+    previous_output: Optional[LatchDir] = None,
+    fit_cache_location: Optional[LatchDir] = None,
+    batch_jobs: List[DESeq2BatchJob] = [],
+) -> LatchDir:
+    # Hack until proper string conditionals exist on bulk
+    if conditions_source == "none":
+        return LatchDir("/root/wf")
 
-    return LatchDir(str(res_p.resolve()), remote_path=output_loc)
+    if conditions_source == "batch":
+        return deseq2_batch(
+            batch_jobs,
+            output_location,
+            number_of_cpu_cores=_cpu_cores(number_of_cpu_cores),
+            prefilter_min_count=prefilter_min_count,
+            prefilter_min_cpm=prefilter_min_cpm,
+            prefilter_min_samples=prefilter_min_samples,
+            number_of_genes_to_plot=number_of_genes_to_plot,
+            number_of_contrast_workers=number_of_contrast_workers,
+            contrast_mode=contrast_mode,
+            fit_engine=fit_engine,
+            plot_output_format=plot_output_format,
+            plot_max_points=plot_max_points,
+            plot_widget_libraries=plot_widget_libraries,
+            fit_cache_location=fit_cache_location,
+        )
+
+    if output_location_type == "custom" and output_location is None:
+        error(
+            {
+                "title": "Invariant violation",
+                "body": "Expected a custom output location but it is null",
+            }
+        )
+        raise RuntimeError("custom output location requested but not specified")
+
+    output_loc = f"latch:///DESeq2 Results/{report_name.replace('/', '_')}"
+    if output_location_type == "custom":
+        assert output_location is not None
+        output_loc = output_location.remote_path
+
+    number_of_cpu_cores = _cpu_cores(number_of_cpu_cores)
+
+    r_worker: Optional[RWorker] = None
+    if persistent_r_worker:
+        # loads the R packages while the inputs are ingested
+        r_worker = shared_worker(_r_env(number_of_cpu_cores))
+
+    res_p = deseq2_report(
+        report_name,
+        output_loc,
+        Path("."),
+        number_of_cpu_cores=number_of_cpu_cores,
+        count_table_source=count_table_source,
+        raw_count_table=raw_count_table,
+        raw_count_tables=raw_count_tables,
+        count_table_missing_genes=count_table_missing_genes,
+        count_table_gene_id_column=count_table_gene_id_column,
+        conditions_source=conditions_source,
+        manual_conditions=manual_conditions,
+        conditions_table=conditions_table,
+        design_matrix_sample_id_column=design_matrix_sample_id_column,
+        design_formula=design_formula,
+        prefilter_min_count=prefilter_min_count,
+        prefilter_min_cpm=prefilter_min_cpm,
+        prefilter_min_samples=prefilter_min_samples,
+        number_of_genes_to_plot=number_of_genes_to_plot,
+        number_of_contrast_workers=number_of_contrast_workers,
+        contrast_mode=contrast_mode,
+        fit_engine=fit_engine,
+        plot_output_format=plot_output_format,
+        plot_max_points=plot_max_points,
+        plot_widget_libraries=plot_widget_libraries,
+        r_worker=r_worker,
+        previous_output=previous_output,
+        fit_cache_location=fit_cache_location,
+    )
+
+    flush_messages()
+
+    return LatchDir(str(res_p), remote_path=output_loc)
 
 
 @dataclass(frozen=True)
@@ -569,11 +951,124 @@ class LatchParameterDeseq2(LatchParameter):
                 display_name="Sample ID Column"
             ),
             "design_formula": LatchParameter(display_name="Design Formula"),
+            "batch_jobs": LatchParameterDeseq2(
+                display_name="Reports",
+                description=(
+                    "Each report has its own counts table, design matrix and"
+                    " design formula. All of them are built in one task and"
+                    " saved under the report's name"
+                ),
+                add_button_title="Add Report",
+            ),
             "number_of_genes_to_plot": LatchParameterDeseq2(
                 display_name="Number of Top Genes to Plot",
                 add_button_title="Number of Top Genes to Plot",
             ),
+            "number_of_contrast_workers": LatchParameter(
+                display_name="Contrast Workers",
+                description=(
+                    "Number of contrasts to compute and plot in parallel. Each"
+                    " worker is a forked R process"
+                ),
+            ),
+            "contrast_mode": LatchParameter(
+                display_name="Contrast Mode",
+                description=(
+                    "'symmetric' fits each pair of levels once and derives the"
+                    " mirrored contrast by negating the fold change. 'full' fits"
+                    " both directions independently"
+                ),
+            ),
+            "fit_engine": LatchParameter(
+                display_name="Fit Engine",
+                description=(
+                    "'glmGamPoi' fits large cohorts much faster than the standard"
+                    " DESeq2 fit. 'auto' uses it from 100 samples up"
+                ),
+            ),
+            "plot_output_format": LatchParameter(
+                display_name="Plot Output Format",
+                description=(
+                    "'png' for static images, 'html' for interactive plots, 'both',"
+                    " or 'none' to only compute the result tables"
+                ),
+            ),
+            "plot_max_points": LatchParameter(
+                display_name="Max Points per Interactive Plot",
+                description=(
+                    "Non-significant genes in the interactive MA and volcano plots"
+                    " are thinned out past this many points. Significant genes"
+                    " are always shown. 0 shows every gene"
+                ),
+            ),
+            "plot_widget_libraries": LatchParameter(
+                display_name="Interactive Plot Libraries",
+                description=(
+                    "'cdn' loads the plotting libraries from a CDN, 'offline'"
+                    " stores a single copy of them in Plots/lib so the plots open"
+                    " without network access. The plots in the report carry their"
+                    " own copy"
+                ),
+            ),
+            "number_of_cpu_cores": LatchParameter(
+                display_name="CPU Cores",
+                description=(
+                    "Cores used for fitting and contrasts. Defaults to the task's"
+                    " CPU allocation"
+                ),
+            ),
+            "persistent_r_worker": LatchParameter(
+                display_name="Persistent R Worker",
+                description=(
+                    "Run the R stage in a long-lived R session that is started"
+                    " with the task, so loading the R packages overlaps reading"
+                    " the inputs and later runs in the same task skip it"
+                ),
+            ),
+            "previous_output": LatchParameter(
+                display_name="Previous Results",
+                description=(
+                    "Output directory of an earlier run on the same data. Its fit"
+                    " is reused and only missing contrasts and plots are computed"
+                ),
+            ),
+            "fit_cache_location": LatchParameter(
+                display_name="Fit Cache",
+                description=(
+                    "Directory where fitted models are kept between runs. A run"
+                    " with the same counts, design matrix and formula as an"
+                    " earlier one reuses its fit. Off when empty"
+                ),
+            ),
+            "prefilter_min_count": LatchParameter(
+                display_name="Minimum Count",
+                description=(
+                    "Genes need at least this many reads in enough samples to be"
+                    " fit. 0 turns the count rule off"
+                ),
+            ),
+            "prefilter_min_cpm": LatchParameter(
+                display_name="Minimum CPM",
+                description=(
+                    "Genes need at least this many counts per million in enough"
+                    " samples to be fit. 0 turns the CPM rule off"
+                ),
+            ),
+            "prefilter_min_samples": LatchParameter(
+                display_name="Minimum Samples",
+                description=(
+                    "Number of samples that must pass the count and CPM rules for a"
+                    " gene to be kept"
+                ),
+            ),
             "count_table_source": LatchParameter(),
+            "count_table_missing_genes": LatchParameter(
+                display_name="Genes Missing From Some Tables",
+                description=(
+                    "'fill' keeps genes missing from some tables with zero counts,"
+                    " 'drop' only keeps genes present in every table"
+                ),
+            ),
         },
         flow=[
             Section(
@@ -599,12 +1094,26 @@ class LatchParameterDeseq2(LatchParameter):
                                 - A subset or all of the remaining columns can be used as samples for analysis, depending on the design matrix
                                 - Tables will be merged row-wise (new samples will be added for each gene)
                                 - The first column of each table must be the gene identifier
-                                - The order of genes in each table must be exactly the same
+                                - Tables are joined on the gene identifier, in any order
+                                - Genes missing from some of the tables are filled with zero counts or dropped
                                 """)),
-                        Params("raw_count_tables"),
+                        Params("raw_count_tables", "count_table_missing_genes"),
                     ),
                 ),
             ),
+            Section(
+                "Low Count Filter",
+                Text(dedent("""
+                        Genes with too few reads are removed before fitting, which
+                        speeds up every later step. Removed genes are listed in
+                        `Data/QC/Prefiltered Genes.csv`. Off by default
+                        """)),
+                Params(
+                    "prefilter_min_count",
+                    "prefilter_min_cpm",
+                    "prefilter_min_samples",
+                ),
+            ),
             Section(
                 "Sample Conditions (Control vs Treatment, etc.)",
                 Fork(
@@ -627,6 +1136,15 @@ class LatchParameterDeseq2(LatchParameter):
                             "design_formula",
                         ),
                     ),
+                    batch=ForkBranch(
+                        "Batch of Reports",
+                        Text(dedent("""
+                                Several reports, each with its own counts table and
+                                design matrix, built one after another in a single
+                                task. The counts table above is not used
+                                """)),
+                        Params("batch_jobs"),
+                    ),
                 ),
             ),
             Section(
@@ -646,6 +1164,21 @@ class LatchParameterDeseq2(LatchParameter):
                         "Custom", ["output_location"], Params("output_location")
                     ),
                 ),
+                Params("previous_output"),
+            ),
+            Section(
+                "Performance Settings",
+                Params(
+                    "number_of_cpu_cores",
+                    "number_of_contrast_workers",
+                    "contrast_mode",
+                    "fit_engine",
+                    "plot_output_format",
+                    "plot_max_points",
+                    "plot_widget_libraries",
+                    "persistent_r_worker",
+                    "fit_cache_location",
+                ),
             ),
         ],
     )
@@ -670,6 +1203,7 @@ def deseq2_wf(
         ]
     ] = None,
     raw_count_tables: List[LatchFile] = [],
+    count_table_missing_genes: str = "fill",
     count_table_gene_id_column: str = "gene_id",
     output_location_type: str = "default",
     output_location: Optional[LatchOutputDir] = None,
@@ -706,7 +1240,21 @@ def deseq2_wf(
             }
         ),
     ] = [],
+    prefilter_min_count: int = 0,
+    prefilter_min_cpm: float = 0.0,
+    prefilter_min_samples: int = 1,
     number_of_genes_to_plot: int = 30,
+    number_of_contrast_workers: int = 4,
+    contrast_mode: str = "symmetric",
+    fit_engine: str = "auto",
+    plot_output_format: str = "both",
+    plot_max_points: int = 20000,
+    plot_widget_libraries: str = "cdn",
+    number_of_cpu_cores: Optional[int] = None,
+    persistent_r_worker: bool = False,
+    previous_output: Optional[LatchDir] = None,
+    fit_cache_location: Optional[LatchDir] = None,
+    batch_jobs: List[DESeq2BatchJob] = [],
 ) -> LatchDir:
     r"""Estimate variance-mean dependence in count data from high-throughput sequencing assays and test for differential expression based on a model using the negative binomial distribution.
 
@@ -733,6 +1281,7 @@ def deseq2_wf(
         count_table_source=count_table_source,
         raw_count_table=raw_count_table,
         raw_count_tables=raw_count_tables,
+        count_table_missing_genes=count_table_missing_genes,
         count_table_gene_id_column=count_table_gene_id_column,
         report_name=report_name,
         output_location_type=output_location_type,
@@ -742,7 +1291,21 @@ def deseq2_wf(
         conditions_table=conditions_table,
         design_matrix_sample_id_column=design_matrix_sample_id_column,
         design_formula=design_formula,
+        prefilter_min_count=prefilter_min_count,
+        prefilter_min_cpm=prefilter_min_cpm,
+        prefilter_min_samples=prefilter_min_samples,
         number_of_genes_to_plot=number_of_genes_to_plot,
+        number_of_contrast_workers=number_of_contrast_workers,
+        contrast_mode=contrast_mode,
+        fit_engine=fit_engine,
+        plot_output_format=plot_output_format,
+        plot_max_points=plot_max_points,
+        plot_widget_libraries=plot_widget_libraries,
+        number_of_cpu_cores=number_of_cpu_cores,
+        persistent_r_worker=persistent_r_worker,
+        previous_output=previous_output,
+        fit_cache_location=fit_cache_location,
+        batch_jobs=batch_jobs,
     )
 
 
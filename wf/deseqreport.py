@@ -0,0 +1,390 @@
+"""Reading and writing `.deseqreport` files.
+
+A report is a little-endian u32 header length, a UTF-8 JSON header, and the
+embedded blobs concatenated in `embedded_data_order`.
+
+Version 1 headers only have `embedded_data_order` and `embedded_data_sizes`,
+so locating an entry means summing the sizes of every entry before it.
+
+Version 2 headers (`"version": 2`) keep both keys, with the sizes of the stored
+bytes, so the blobs can still be framed the version 1 way. They add an index
+in `embedded_data` mapping every key to:
+- `offset`: where the stored bytes start, relative to the end of the header
+- `length`: number of stored bytes
+- `size`: number of bytes after decompression
+- `crc32`: CRC-32 of the stored bytes
+- `compression`: `"gzip"` or `null`
+
+Compressed entries cannot be read the version 1 way, so compression is opt-in
+and reports are written uncompressed by default.
+"""
+
+import gzip
+import io
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import typing
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional
+
+from wf.util import warn
+
+current_version = 2
+
+# Widgets and tables compress well, `.rds` files are gzip streams already
+compressible_suffixes = {".html", ".csv", ".json", ".tsv", ".txt", ".bin"}
+
+_chunk_size = 1024 * 1024
+
+
+def no_compression(key: str, p: Path) -> bool:
+    return False
+
+
+def compress_text(key: str, p: Path) -> bool:
+    """Compress widgets and tables, which version 1 readers cannot read."""
+    return p.suffix in compressible_suffixes
+
+
+@dataclass(frozen=True)
+class IndexEntry:
+    offset: int
+    length: int
+    size: int
+    crc32: int
+    compression: Optional[str] = None
+
+    def dict(self) -> Dict[str, Any]:
+        return {
+            "offset": self.offset,
+            "length": self.length,
+            "size": self.size,
+            "crc32": self.crc32,
+            "compression": self.compression,
+        }
+
+
+def _file_crc32(p: Path) -> int:
+    if p.stat().st_size == 0:
+        return 0
+
+    with p.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        return zlib.crc32(m)
+
+
+def _gzip_file(src: Path, dst: Path) -> int:
+    crc = 0
+    c = zlib.compressobj(6, zlib.DEFLATED, 31)
+    with src.open("rb") as fr, dst.open("wb") as fw:
+        while True:
+            data = fr.read(_chunk_size)
+            if len(data) == 0:
+                break
+
+            out = c.compress(data)
+            crc = zlib.crc32(out, crc)
+            fw.write(out)
+
+        out = c.flush()
+        crc = zlib.crc32(out, crc)
+        fw.write(out)
+
+    return crc
+
+
+def _copy_into(dst: BinaryIO, src: Path, length: int) -> None:
+    with src.open("rb") as fr:
+        offset = 0
+        try:
+            # zero-copy: the kernel moves the bytes from file to file
+            while offset < length:
+                sent = os.sendfile(dst.fileno(), fr.fileno(), offset, length - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError:
+            # e.g. file systems without sendfile support
+            pass
+
+        if offset < length:
+            fr.seek(offset)
+            shutil.copyfileobj(fr, dst, _chunk_size)
+            dst.flush()
+
+
+def write_report(
+    out: Path,
+    header: Dict[str, Any],
+    embedded_data: Dict[str, Path],
+    compress: Callable[[str, Path], bool] = no_compression,
+) -> Dict[str, IndexEntry]:
+    """Write a version 2 report with `header` and the files in `embedded_data`.
+
+    Files that do not exist are left out of the report with a warning.
+    """
+    missing = sorted(k for k, v in embedded_data.items() if not v.exists())
+    if len(missing) > 0:
+        warn(
+            "Leaving missing files out of the report:",
+            *(f"  {k}: {embedded_data[k]}" for k in missing),
+            sep="\n",
+        )
+
+    embedded_data_order = sorted(k for k in embedded_data if k not in missing)
+
+    with tempfile.TemporaryDirectory(prefix="deseqreport_") as tmp:
+        tmp_p = Path(tmp)
+
+        stored: Dict[str, Path] = {}
+        index: Dict[str, IndexEntry] = {}
+        offset = 0
+        for idx, k in enumerate(embedded_data_order):
+            src = embedded_data[k]
+            size = src.stat().st_size
+
+            compression = None
+            blob = src
+            if size > 0 and compress(k, src):
+                gz = tmp_p / f"{idx}.gz"
+                crc = _gzip_file(src, gz)
+                if gz.stat().st_size < size:
+                    compression = "gzip"
+                    blob = gz
+
+            if compression is None:
+                crc = _file_crc32(src)
+
+            length = blob.stat().st_size
+            stored[k] = blob
+            index[k] = IndexEntry(
+                offset=offset,
+                length=length,
+                size=size,
+                crc32=crc,
+                compression=compression,
+            )
+            offset += length
+
+        json_blob = json.dumps(
+            {
+                **header,
+                "version": current_version,
+                "embedded_data_sizes": {k: v.length for k, v in index.items()},
+                "embedded_data_order": embedded_data_order,
+                "embedded_data": {k: v.dict() for k, v in index.items()},
+            }
+        ).encode("utf-8")
+
+        with out.open("wb") as f:
+            f.write(len(json_blob).to_bytes(4, "little", signed=False))
+            f.write(json_blob)
+            f.flush()
+
+            for k in embedded_data_order:
+                _copy_into(f, stored[k], index[k].length)
+
+    return index
+
+
+class ReportFormatError(ValueError):
+    pass
+
+
+class _MemoryviewReader(io.RawIOBase):
+    def __init__(self, data: memoryview):
+        self._data = data
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._data)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def readinto(self, b) -> int:
+        chunk = self._data[self._pos : self._pos + len(b)]
+        n = len(chunk)
+        b[:n] = chunk
+        self._pos += n
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self._data.release()
+        super().close()
+
+
+class ReportReader:
+    """Random access to the entries of a version 1 or version 2 report.
+
+    The report is memory-mapped, so only the pages of the entries that are
+    actually read get loaded. Views returned by `raw` point into the mapping
+    and have to be released before the reader is closed.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+        self._f = path.open("rb")
+        try:
+            self._mmap = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as e:
+            self._f.close()
+            raise ReportFormatError(f"Empty report: {path}") from e
+
+        try:
+            self._load_header()
+        except Exception:
+            self.close()
+            raise
+
+    def _load_header(self) -> None:
+        if len(self._mmap) < 4:
+            raise ReportFormatError("Report is too short for a header")
+
+        header_len = int.from_bytes(self._mmap[:4], "little", signed=False)
+        data_start = 4 + header_len
+        if data_start > len(self._mmap):
+            raise ReportFormatError("Report header is truncated")
+
+        self.header: Dict[str, Any] = json.loads(
+            self._mmap[4:data_start].decode("utf-8")
+        )
+        self.version: int = self.header.get("version", 1)
+        self._data_start = data_start
+
+        self.index: Dict[str, IndexEntry] = {}
+        if self.version >= 2:
+            for k, v in self.header["embedded_data"].items():
+                self.index[k] = IndexEntry(
+                    offset=v["offset"],
+                    length=v["length"],
+                    size=v["size"],
+                    crc32=v["crc32"],
+                    compression=v.get("compression"),
+                )
+        else:
+            offset = 0
+            sizes = self.header["embedded_data_sizes"]
+            for k in self.header["embedded_data_order"]:
+                self.index[k] = IndexEntry(
+                    offset=offset, length=sizes[k], size=sizes[k], crc32=-1
+                )
+                offset += sizes[k]
+
+        for k, v in self.index.items():
+            if data_start + v.offset + v.length > len(self._mmap):
+                raise ReportFormatError(f"Entry '{k}' extends past the end of the file")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        if not self._mmap.closed:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # a stream from `open` is still alive, the mapping goes away
+                # together with it
+                pass
+        self._f.close()
+
+    def keys(self) -> List[str]:
+        return list(self.index.keys())
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def raw(self, key: str) -> memoryview:
+        """Stored bytes of an entry, without copying or decompressing them."""
+        e = self.index[key]
+        start = self._data_start + e.offset
+        return memoryview(self._mmap)[start : start + e.length]
+
+    def verify(self, key: str) -> bool:
+        e = self.index[key]
+        if e.crc32 < 0:
+            # version 1 reports have no checksums
+            return True
+
+        with self.raw(key) as data:
+            return zlib.crc32(data) == e.crc32
+
+    def open(self, key: str) -> BinaryIO:
+        """File-like stream over the decompressed contents of an entry."""
+        e = self.index[key]
+        stream = io.BufferedReader(_MemoryviewReader(self.raw(key)), _chunk_size)
+        if e.compression is None:
+            return stream
+        if e.compression == "gzip":
+            return typing.cast(BinaryIO, gzip.GzipFile(fileobj=stream, mode="rb"))
+        raise ReportFormatError(f"Unsupported compression: '{e.compression}'")
+
+    def iter_chunks(self, key: str) -> Iterator[bytes]:
+        e = self.index[key]
+        with self.raw(key) as data:
+            d = zlib.decompressobj(31) if e.compression == "gzip" else None
+            for start in range(0, len(data), _chunk_size):
+                chunk = data[start : start + _chunk_size]
+                if d is None:
+                    yield bytes(chunk)
+                else:
+                    yield d.decompress(chunk)
+                chunk.release()
+            if d is not None:
+                yield d.flush()
+
+    def read(self, key: str) -> bytes:
+        return b"".join(self.iter_chunks(key))
+
+    def extract(self, key: str, dst: Path, verify: bool = True) -> None:
+        """Write the decompressed contents of an entry to `dst` in constant memory."""
+        if verify and not self.verify(key):
+            raise ReportFormatError(f"Checksum mismatch for entry '{key}'")
+
+        e = self.index[key]
+        with dst.open("wb") as f:
+            if e.compression is None:
+                # zero-copy straight out of the report
+                start = self._data_start + e.offset
+                offset = 0
+                try:
+                    while offset < e.length:
+                        sent = os.sendfile(
+                            f.fileno(),
+                            self._f.fileno(),
+                            start + offset,
+                            e.length - offset,
+                        )
+                        if sent == 0:
+                            break
+                        offset += sent
+                except OSError:
+                    pass
+
+                if offset == e.length:
+                    return
+                f.seek(0)
+                f.truncate()
+
+            for chunk in self.iter_chunks(key):
+                f.write(chunk)
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from flytekit.core.context_manager import FlyteContextManager
+from latch.types import LatchDir
+
+from wf.ingest import IngestedCounts
+from wf.util import warn
+
+# Bump when the R fit changes in a way that makes old cache entries invalid
+fit_cache_version = 1
+
+cached_files = ["dds.rds", "vsd.rds"]
+
+# A directory on a persistent mount. There is no default: a directory in the
+# task container is gone by the next task and only fills its disk
+default_cache_dir: Optional[Path] = None
+if "DESEQ2_FIT_CACHE_DIR" in os.environ:
+    default_cache_dir = Path(os.environ["DESEQ2_FIT_CACHE_DIR"])
+# A size of 0 disables the cache
+default_max_bytes = int(os.environ.get("DESEQ2_FIT_CACHE_MAX_BYTES", 20 * 1024**3))
+
+_chunk_size = 1024 * 1024
+
+
+def _hash_file(h: "hashlib._Hash", p: Path) -> None:
+    h.update(p.stat().st_size.to_bytes(8, "little"))
+    with p.open("rb") as f:
+        while True:
+            data = f.read(_chunk_size)
+            if len(data) == 0:
+                break
+            h.update(data)
+
+
+def fit_cache_key(
+    ingested: IngestedCounts, design_matrix: Path, design: Dict[str, Any]
+) -> str:
+    """Hash of everything the fitted `dds`/`vsd` objects depend on.
+
+    `design` holds the design formula columns and any other fit settings.
+    """
+    h = hashlib.sha256()
+    h.update(f"wf-deseq2 fit {fit_cache_version}\0".encode())
+
+    for x in ["header.json", "genes.txt", "counts.bin"]:
+        _hash_file(h, ingested.path / x)
+    _hash_file(h, design_matrix)
+
+    h.update(json.dumps(design, sort_keys=True).encode())
+
+    return h.hexdigest()
+
+
+def _copy(src: Path, dst: Path) -> None:
+    # Never a hard link: the R script rewrites `dds.rds` when it refits, which
+    # would write through to the cache entry
+    tmp = dst.with_name(f".{dst.name}.{os.getpid()}.tmp")
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def _entry_size(p: Path) -> int:
+    return sum(x.stat().st_size for x in p.iterdir() if x.is_file())
+
+
+class FitCache:
+    """Directory of fitted DESeq2 objects keyed by `fit_cache_key`.
+
+    Every entry is a directory with `cached_files`. The least recently used
+    entries are evicted once the cache grows over `max_bytes`. Without a `root`
+    the cache is disabled.
+    """
+
+    def __init__(
+        self,
+        root: Optional[Path] = default_cache_dir,
+        max_bytes: int = default_max_bytes,
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    @property
+    def enabled(self) -> bool:
+        return self.root is not None and self.max_bytes > 0
+
+    def restore(self, key: str, dst: Path) -> bool:
+        if not self.enabled:
+            return False
+        assert self.root is not None
+
+        entry = self.root / key
+        if not all((entry / x).exists() for x in cached_files):
+            return False
+
+        try:
+            for x in cached_files:
+                _copy(entry / x, dst / x)
+        except OSError as e:
+            warn(f"Could not restore cached fit {key}: {e}")
+            for x in cached_files:
+                (dst / x).unlink(missing_ok=True)
+            return False
+
+        # mark as recently used for eviction
+        now = time.time()
+        os.utime(entry, (now, now))
+        return True
+
+    def store(self, key: str, src: Path) -> None:
+        if not self.enabled:
+            return
+        assert self.root is not None
+
+        if not all((src / x).exists() for x in cached_files):
+            return
+
+        entry = self.root / key
+        tmp = self.root / f".{key}.{os.getpid()}.tmp"
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            tmp.mkdir()
+            for x in cached_files:
+                shutil.copyfile(src / x, tmp / x)
+
+            if entry.exists():
+                shutil.rmtree(tmp)
+            else:
+                os.replace(tmp, entry)
+        except OSError as e:
+            warn(f"Could not store fit {key} in the cache: {e}")
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        self.evict(keep=key)
+
+    def evict(self, keep: Optional[str] = None) -> List[str]:
+        if self.root is None or not self.root.exists():
+            return []
+
+        entries = [
+            x for x in self.root.iterdir() if x.is_dir() and not x.name.startswith(".")
+        ]
+        sizes = {x.name: _entry_size(x) for x in entries}
+        total = sum(sizes.values())
+
+        evicted = []
+        for x in sorted(entries, key=lambda x: x.stat().st_mtime):
+            if total <= self.max_bytes:
+                break
+            if x.name == keep:
+                continue
+
+            shutil.rmtree(x, ignore_errors=True)
+            total -= sizes[x.name]
+            evicted.append(x.name)
+
+        return evicted
+
+
+class LatchFitCache:
+    """`FitCache` in a Latch Data directory, which outlives the task.
+
+    Entries are never evicted, the directory is the user's to clean up.
+    """
+
+    enabled = True
+
+    def __init__(self, location: LatchDir):
+        assert location.remote_path is not None
+        self.root = location.remote_path.rstrip("/")
+
+    def restore(self, key: str, dst: Path) -> bool:
+        try:
+            names = {
+                x.remote_path.rsplit("/", 1)[-1]
+                for x in LatchDir(f"{self.root}/{key}").iterdir()
+                if x.remote_path is not None
+            }
+        except ValueError:
+            # no such entry
+            return False
+
+        if not all(x in names for x in cached_files):
+            return False
+
+        ctx = FlyteContextManager.current_context()
+        try:
+            for x in cached_files:
+                ctx.file_access.get_data(f"{self.root}/{key}/{x}", str(dst / x))
+        except Exception as e:
+            warn(f"Could not restore cached fit {key}: {e}")
+            for x in cached_files:
+                (dst / x).unlink(missing_ok=True)
+            return False
+
+        return True
+
+    def store(self, key: str, src: Path) -> None:
+        if not all((src / x).exists() for x in cached_files):
+            return
+
+        ctx = FlyteContextManager.current_context()
+        try:
+            for x in cached_files:
+                ctx.file_access.put_data(str(src / x), f"{self.root}/{key}/{x}")
+        except Exception as e:
+            warn(f"Could not store fit {key} in the cache: {e}")
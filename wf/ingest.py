@@ -0,0 +1,314 @@
+import csv
+import json
+import math
+from array import array
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, List, Optional, Set
+
+import numpy as np
+
+from wf.util import error
+
+# R's NA_integer_ is INT_MIN, so `readBin` turns these cells into NA for free
+na_count = -(2**31)
+
+ingested_format = "int32-column-major"
+
+_r_reserved_words = {
+    "if",
+    "else",
+    "repeat",
+    "while",
+    "function",
+    "for",
+    "next",
+    "break",
+    "in",
+    "TRUE",
+    "FALSE",
+    "NULL",
+    "Inf",
+    "NaN",
+    "NA",
+    "NA_integer_",
+    "NA_real_",
+    "NA_character_",
+    "NA_complex_",
+}
+
+
+def r_make_name(x: str) -> str:
+    """Python port of R's `make.names` for a single name."""
+    res = "".join(c if c.isalnum() or c in "._" else "." for c in x)
+
+    if (
+        res == ""
+        or not (res[0].isalpha() or res[0] == ".")
+        or (res[0] == "." and len(res) > 1 and res[1].isdigit())
+    ):
+        res = "X" + res
+
+    if res in _r_reserved_words:
+        res += "."
+
+    return res
+
+
+def r_make_names(xs: Iterable[str], unique: bool = False) -> List[str]:
+    """Python port of R's `make.names`, including `unique = TRUE`."""
+    res = [r_make_name(x) for x in xs]
+    if not unique:
+        return res
+
+    # `make.unique` appends .1, .2, ... to later duplicates, skipping suffixes
+    # that would collide with an existing name
+    seen = set(res)
+    counts = {}
+    out = []
+    used = set()
+    for x in res:
+        if x not in used:
+            used.add(x)
+            out.append(x)
+            continue
+
+        idx = counts.get(x, 0)
+        while True:
+            idx += 1
+            candidate = f"{x}.{idx}"
+            if candidate not in seen and candidate not in used:
+                break
+        counts[x] = idx
+        used.add(candidate)
+        out.append(candidate)
+
+    return out
+
+
+@dataclass
+class LowCountFilter:
+    """Drops genes with too few reads to be worth fitting.
+
+    A gene is kept if at least `min_samples` samples have a count of at least
+    `min_count` and a CPM of at least `min_cpm`. NA counts never pass.
+    """
+
+    min_count: int = 0
+    min_cpm: float = 0.0
+    min_samples: int = 1
+
+    @property
+    def enabled(self) -> bool:
+        return self.min_count > 0 or self.min_cpm > 0
+
+    def describe(self) -> str:
+        if not self.enabled:
+            return "off"
+
+        rules = []
+        if self.min_count > 0:
+            rules.append(f"count >= {self.min_count}")
+        if self.min_cpm > 0:
+            rules.append(f"CPM >= {self.min_cpm:g}")
+        return f"{' and '.join(rules)} in at least {self.min_samples} samples"
+
+
+@dataclass
+class IngestedCounts:
+    """A counts table reduced to the design matrix samples.
+
+    `path` is a directory holding:
+    - `counts.bin`: little-endian int32 counts, one sample column after the other
+    - `genes.txt`: gene IDs, one per row of the matrix
+    - `header.json`: shape, sample names, and the NA sentinel
+    - `prefiltered.csv`: genes dropped by the low count filter, if it ran
+
+    `genes` holds every gene of the counts table, including prefiltered ones.
+    """
+
+    path: Path
+    gene_id_column: str
+    samples: List[str]
+    num_genes: int
+    genes: Set[str] = field(default_factory=set)
+    num_prefiltered: int = 0
+    missing_samples: List[str] = field(default_factory=list)
+    ignored_columns: List[str] = field(default_factory=list)
+    non_numeric_cells: int = 0
+    non_numeric_examples: List[str] = field(default_factory=list)
+
+
+def _parse_count(x) -> Optional[int]:
+    if isinstance(x, (int, float)):
+        val = x
+    else:
+        try:
+            val = float(x)
+        except (TypeError, ValueError):
+            return None
+
+    try:
+        return math.floor(val)
+    except (ValueError, OverflowError):
+        return None
+
+
+def ingest_counts(
+    header: List[str],
+    rows: Iterable[List],
+    gene_id_column: str,
+    design_samples: Iterable[str],
+    out: Path,
+    prefilter: Optional[LowCountFilter] = None,
+) -> IngestedCounts:
+    """Stream a counts table once into a compact integer matrix.
+
+    Only the gene ID column and the samples named in the design matrix are
+    kept. Sample names are matched the way the R script matches them, after
+    `make.names`. Counts are floored and cells that are not numbers become NA.
+    Genes failing `prefilter` are left out of the matrix.
+    """
+    header = [str(x) if x is not None else "" for x in header]
+
+    if gene_id_column in header:
+        gene_idx = header.index(gene_id_column)
+    else:
+        gene_idx = 0
+        gene_id_column = header[0]
+
+    r_header = r_make_names(header, unique=True)
+
+    wanted: List[str] = []
+    for s in r_make_names(str(x) for x in design_samples):
+        if s not in wanted:
+            wanted.append(s)
+
+    column_idxs = {}
+    ignored_columns = []
+    for idx, name in enumerate(r_header):
+        if idx == gene_idx:
+            continue
+        if name in wanted and name not in column_idxs:
+            column_idxs[name] = idx
+        else:
+            ignored_columns.append(header[idx])
+
+    samples = [s for s in wanted if s in column_idxs]
+    missing_samples = [s for s in wanted if s not in column_idxs]
+    idxs = [column_idxs[s] for s in samples]
+
+    res = IngestedCounts(
+        path=out,
+        gene_id_column=gene_id_column,
+        samples=samples,
+        num_genes=0,
+        missing_samples=missing_samples,
+        ignored_columns=ignored_columns,
+    )
+
+    columns = [array("i") for _ in samples]
+    gene_ids: List[str] = []
+    for row in rows:
+        if gene_idx >= len(row) or row[gene_idx] is None:
+            continue
+        gene = str(row[gene_idx])
+
+        gene_ids.append(gene)
+        res.genes.add(gene)
+
+        for col, idx in zip(columns, idxs):
+            x = row[idx] if idx < len(row) else None
+            val = _parse_count(x)
+
+            if val is None:
+                res.non_numeric_cells += 1
+                if len(res.non_numeric_examples) < 5:
+                    res.non_numeric_examples.append(
+                        f"{gene} / {header[idx]}: {repr(x)}"
+                    )
+                val = na_count
+            elif not (na_count < val < 2**31):
+                error(
+                    {
+                        "title": "Count out of range",
+                        "body": (
+                            f"Count {val} for gene '{gene}' in sample"
+                            f" '{header[idx]}' does not fit in a 32-bit integer"
+                        ),
+                    }
+                )
+                raise RuntimeError("Count out of range")
+
+            col.append(val)
+
+    out.mkdir(parents=True, exist_ok=True)
+    (out / "prefiltered.csv").unlink(missing_ok=True)
+
+    keep: Optional[np.ndarray] = None
+    if prefilter is not None and prefilter.enabled:
+        keep = _apply_prefilter(prefilter, columns, gene_ids, out / "prefiltered.csv")
+        res.num_prefiltered = len(gene_ids) - int(keep.sum())
+        gene_ids = [x for x, k in zip(gene_ids, keep) if k]
+
+    res.num_genes = len(gene_ids)
+
+    with (out / "counts.bin").open("wb") as f:
+        for col in columns:
+            x = np.frombuffer(col, dtype=np.int32)
+            if keep is not None:
+                x = x[keep]
+            x.astype("<i4", copy=False).tofile(f)
+
+    with (out / "genes.txt").open("w", encoding="utf-8") as f:
+        for x in gene_ids:
+            f.write(x)
+            f.write("\n")
+
+    with (out / "header.json").open("w") as f:
+        json.dump(
+            {
+                "format": ingested_format,
+                "rows": res.num_genes,
+                "columns": len(samples),
+                "samples": samples,
+                "na": na_count,
+            },
+            f,
+        )
+
+    return res
+
+
+def _apply_prefilter(
+    prefilter: LowCountFilter,
+    columns: List[array],
+    gene_ids: List[str],
+    table: Path,
+) -> np.ndarray:
+    """Mask of the genes passing `prefilter`, writing the others to `table`."""
+    passing = np.zeros(len(gene_ids), dtype=np.int32)
+    totals = np.zeros(len(gene_ids), dtype=np.int64)
+
+    # one sample at a time, so only a few gene-length vectors are alive at once
+    for col in columns:
+        x = np.frombuffer(col, dtype=np.int32)
+        valid = x != na_count
+        counts = np.where(valid, x, 0)
+        totals += counts
+
+        ok = valid & (x >= prefilter.min_count)
+        if prefilter.min_cpm > 0:
+            library_size = int(counts.sum(dtype=np.int64))
+            ok &= x >= prefilter.min_cpm * library_size / 1e6
+        passing += ok
+
+    keep = passing >= prefilter.min_samples
+
+    with table.open("w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["gene_id", "total_count", "samples_passing"])
+        for idx in np.flatnonzero(~keep):
+            w.writerow([gene_ids[idx], int(totals[idx]), int(passing[idx])])
+
+    return keep
@@ -0,0 +1,215 @@
+import csv
+import heapq
+import itertools
+import tempfile
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from wf.tabular import csv_tsv_reader
+from wf.util import error, warn
+
+# Rows held in memory at once while producing sorted runs of a single table.
+# 60k-gene tables fit in one run, anything larger spills to several
+default_run_rows = 100_000
+
+missing_gene_policies = {"fill", "drop"}
+
+
+@dataclass
+class TableMergeStats:
+    path: str
+    samples: int
+    genes: int = 0
+    duplicate_genes: int = 0
+    missing_genes: int = 0
+    runs: int = 0
+
+
+@dataclass
+class MergeReport:
+    missing_genes: str
+    tables: List[TableMergeStats] = field(default_factory=list)
+    genes_total: int = 0
+    genes_in_all_tables: int = 0
+    genes_written: int = 0
+
+    def dict(self):
+        return asdict(self)
+
+
+class CountTableMerge:
+    """Join counts tables on their first (gene ID) column.
+
+    Every table is split into sorted runs on disk, so memory use is bounded by
+    `run_rows` regardless of table size. The runs of each table are then
+    k-way merged into a single sorted stream and all tables are joined in one
+    more k-way merge, holding a single row per table at a time.
+
+    Genes missing from some tables are either filled with zero counts or
+    dropped, depending on `missing_genes`.
+    """
+
+    def __init__(
+        self,
+        paths: List[Path],
+        missing_genes: str = "fill",
+        run_rows: int = default_run_rows,
+    ):
+        if missing_genes not in missing_gene_policies:
+            raise ValueError(f"Unknown missing gene policy: '{missing_genes}'")
+
+        self.paths = paths
+        self.run_rows = run_rows
+        self.report = MergeReport(missing_genes=missing_genes)
+
+        self.header: List[str] = []
+        self._widths: List[int] = []
+        self._runs: List[List[Path]] = []
+        self._tmp: Optional[tempfile.TemporaryDirectory] = None
+
+    def __enter__(self):
+        self._tmp = tempfile.TemporaryDirectory(prefix="counts_merge_")
+        tmp_p = Path(self._tmp.name)
+
+        seen_samples = {}
+        for table_idx, p in enumerate(self.paths):
+            with p.open("r", encoding="utf-8-sig", newline="") as f:
+                r = csv_tsv_reader(f)
+
+                header = next(r)
+                if table_idx == 0:
+                    self.header.append(header[0])
+
+                for s in header[1:]:
+                    if s in seen_samples:
+                        error(
+                            {
+                                "title": "Duplicate sample in combined tables",
+                                "body": (
+                                    f"Sample '{s}' is present in both"
+                                    f" '{self.paths[seen_samples[s]].name}' and"
+                                    f" '{p.name}'"
+                                ),
+                            }
+                        )
+                        raise RuntimeError(f"Duplicate sample column '{s}'")
+                    seen_samples[s] = table_idx
+                self.header.extend(header[1:])
+                self._widths.append(len(header) - 1)
+
+                self.report.tables.append(
+                    TableMergeStats(path=p.name, samples=len(header) - 1)
+                )
+
+                runs = []
+                while True:
+                    chunk = list(itertools.islice(r, self.run_rows))
+                    if len(chunk) == 0:
+                        break
+
+                    chunk.sort(key=lambda row: row[0])
+
+                    run_p = tmp_p / f"{table_idx}_{len(runs)}.csv"
+                    with run_p.open("w", newline="") as fw:
+                        csv.writer(fw).writerows(chunk)
+                    runs.append(run_p)
+
+                self._runs.append(runs)
+                self.report.tables[-1].runs = len(runs)
+
+        return self
+
+    def __exit__(self, *args):
+        if self._tmp is not None:
+            self._tmp.cleanup()
+            self._tmp = None
+
+    def _table_rows(self, table_idx: int) -> Iterator[List[str]]:
+        stats = self.report.tables[table_idx]
+        width = self._widths[table_idx]
+
+        fds = [x.open("r", newline="") for x in self._runs[table_idx]]
+        try:
+            # heapq.merge is stable, so the first occurrence of a duplicated
+            # gene still comes first
+            merged = heapq.merge(*[csv.reader(f) for f in fds], key=lambda x: x[0])
+
+            last_gene = None
+            for row in merged:
+                if row[0] == last_gene:
+                    stats.duplicate_genes += 1
+                    continue
+                last_gene = row[0]
+                stats.genes += 1
+
+                vals = row[1 : width + 1]
+                if len(vals) < width:
+                    vals.extend([""] * (width - len(vals)))
+                yield [row[0], *vals]
+        finally:
+            for f in fds:
+                f.close()
+
+    def _keyed_rows(self, table_idx: int) -> Iterator[Tuple[str, int, List[str]]]:
+        for row in self._table_rows(table_idx):
+            yield row[0], table_idx, row
+
+    def rows(self) -> Iterator[List[str]]:
+        """Yield joined rows (without the header) sorted by gene ID."""
+        assert self._tmp is not None, "merge must be used as a context manager"
+
+        num_tables = len(self.paths)
+        fill = self.report.missing_genes == "fill"
+
+        merged = heapq.merge(
+            *[self._keyed_rows(table_idx) for table_idx in range(num_tables)]
+        )
+        for gene, group in itertools.groupby(merged, key=lambda x: x[0]):
+            by_table = {table_idx: row for _, table_idx, row in group}
+            self.report.genes_total += 1
+
+            if len(by_table) == num_tables:
+                self.report.genes_in_all_tables += 1
+            else:
+                for table_idx in range(num_tables):
+                    if table_idx not in by_table:
+                        self.report.tables[table_idx].missing_genes += 1
+
+                if not fill:
+                    continue
+
+            line = [gene]
+            for table_idx in range(num_tables):
+                row = by_table.get(table_idx)
+                if row is None:
+                    line.extend(["0"] * self._widths[table_idx])
+                else:
+                    line.extend(row[1:])
+
+            self.report.genes_written += 1
+            yield line
+
+    def print_summary(self):
+        print(
+            "Combined counts tables:",
+            *(
+                f"  {t.path}: {t.samples} samples, {t.genes} genes"
+                f" ({t.missing_genes} missing, {t.duplicate_genes} duplicated)"
+                for t in self.report.tables
+            ),
+            f"  Genes: {self.report.genes_total} total,"
+            f" {self.report.genes_in_all_tables} in all tables,"
+            f" {self.report.genes_written} written"
+            f" [missing genes: {self.report.missing_genes}]",
+            sep="\n",
+        )
+
+        duplicated = [t for t in self.report.tables if t.duplicate_genes > 0]
+        if len(duplicated) > 0:
+            warn(
+                "Duplicate gene IDs were found while combining tables, only the"
+                " first occurrence was kept:",
+                *(f"  {t.path}: {t.duplicate_genes}" for t in duplicated),
+                sep="\n",
+            )
@@ -0,0 +1,255 @@
+import atexit
+import json
+import os
+import subprocess
+import threading
+import uuid
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+worker_done_prefix = b"__LATCH_WORKER_DONE "
+
+r_scripts_dir = Path(__file__).resolve().parent.parent / "r_scripts"
+
+
+class RScript:
+    """A standalone `Rscript deseq2.r` run."""
+
+    def __init__(self, args: List[str], env: Optional[Dict[str, str]] = None):
+        self._proc = subprocess.Popen(
+            ["Rscript", "deseq2.r", *args],
+            cwd=r_scripts_dir,
+            env={**os.environ, **(env or {})},
+            stdout=subprocess.PIPE,
+        )
+        assert self._proc.stdout is not None
+        self._stdout = self._proc.stdout
+
+    @property
+    def pid(self) -> int:
+        return self._proc.pid
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self._stdout)
+
+    def wait(self) -> int:
+        for _ in self._stdout:
+            pass
+        self._stdout.close()
+        return self._proc.wait()
+
+    def close(self) -> None:
+        """Kill the script if its output was not consumed to the end."""
+        if self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        self._stdout.close()
+
+
+class RWorkerJob:
+    """A `deseq2.r` run inside a `RWorker`.
+
+    Iterating yields the job's output lines, the same as the standard output of
+    a standalone run, and stops at the job's end. A job whose output is not
+    consumed to the end, e.g. because the caller raised while streaming it, is
+    killed with its worker, which restarts for the next job.
+    """
+
+    def __init__(self, worker: "RWorker", id: str):
+        self.worker = worker
+        self.id = id
+        self.status: Optional[int] = None
+
+    @property
+    def pid(self) -> int:
+        return self.worker.pid
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            while self.status is None:
+                l = self.worker._readline()
+                if l == b"":
+                    # the worker died with the job
+                    self.status = self.worker._died()
+                    return
+
+                if l.startswith(worker_done_prefix):
+                    done = json.loads(l[len(worker_done_prefix) :])
+                    if done["id"] == self.id:
+                        self.status = int(done["status"])
+                        self.worker._job_done(self)
+                        return
+                    continue
+
+                yield l
+        finally:
+            self.close()
+
+    def wait(self) -> int:
+        for _ in self:
+            pass
+        assert self.status is not None
+        return self.status
+
+    def close(self) -> None:
+        """Kill the worker if the job is still running."""
+        if self.status is None:
+            self.status = self.worker._abandon(self)
+
+
+class RWorker:
+    """A long-lived R session (`r_scripts/worker.r`) that runs `deseq2.r` jobs.
+
+    The R packages are loaded once when the worker starts, so starting it early
+    overlaps package loading with whatever the task does before the R stage,
+    and every later job skips it. Jobs take the same arguments as
+    `Rscript deseq2.r` and run one at a time. A worker that died is restarted
+    by the next job.
+    """
+
+    def __init__(self, env: Optional[Dict[str, str]] = None):
+        self.env = env or {}
+
+        self._proc: Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+        self._job: Optional[RWorkerJob] = None
+
+    @property
+    def pid(self) -> int:
+        assert self._proc is not None
+        return self._proc.pid
+
+    @property
+    def alive(self) -> bool:
+        return self._proc is not None and self._proc.poll() is None
+
+    def start(self) -> None:
+        with self._lock:
+            if self.alive:
+                return
+
+            print("Starting R worker")
+            self._proc = subprocess.Popen(
+                ["Rscript", "worker.r"],
+                cwd=r_scripts_dir,
+                env={**os.environ, **self.env},
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+
+    def run(self, args: List[str], env: Optional[Dict[str, str]] = None) -> RWorkerJob:
+        """Submit a job. Its output must be consumed, or the job closed, before the
+        next `run`."""
+        self.start()
+        assert self._proc is not None and self._proc.stdin is not None
+
+        with self._lock:
+            if self._job is not None:
+                raise RuntimeError("R worker is already running a job")
+
+            job = RWorkerJob(self, uuid.uuid4().hex)
+            self._job = job
+
+        self._proc.stdin.write(
+            json.dumps({"id": job.id, "args": args, "env": env or {}}).encode("utf-8")
+            + b"\n"
+        )
+        self._proc.stdin.flush()
+        return job
+
+    def close(self, timeout: float = 30) -> None:
+        with self._lock:
+            proc = self._proc
+            self._proc = None
+        if proc is None:
+            return
+
+        assert proc.stdin is not None and proc.stdout is not None
+        proc.stdin.close()
+        try:
+            # drain so that the worker cannot block on a full pipe
+            for _ in proc.stdout:
+                pass
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    def _readline(self) -> bytes:
+        assert self._proc is not None and self._proc.stdout is not None
+        return self._proc.stdout.readline()
+
+    def _job_done(self, job: RWorkerJob) -> None:
+        with self._lock:
+            if self._job is job:
+                self._job = None
+
+    def _abandon(self, job: RWorkerJob) -> int:
+        # the rest of the job's output is still in the pipe and would be read
+        # by the next job, so the worker goes with it
+        with self._lock:
+            if self._job is not job:
+                return 1
+            proc = self._proc
+            self._proc = None
+            self._job = None
+
+        if proc is None:
+            return 1
+        print("Killing the R worker with an unfinished job")
+        proc.kill()
+        ret = proc.wait()
+        assert proc.stdin is not None and proc.stdout is not None
+        proc.stdin.close()
+        proc.stdout.close()
+        return ret if ret != 0 else 1
+
+    def _died(self) -> int:
+        with self._lock:
+            proc = self._proc
+            self._proc = None
+            self._job = None
+
+        if proc is None:
+            return 1
+        ret = proc.wait()
+        print(f"R worker exited with return code {ret}")
+        return ret if ret != 0 else 1
+
+
+RProcess = Union[RScript, RWorkerJob]
+
+_worker: Optional[RWorker] = None
+_worker_lock = threading.Lock()
+
+
+def shared_worker(env: Optional[Dict[str, str]] = None) -> RWorker:
+    """The process-wide R worker, started on first use."""
+    global _worker
+
+    with _worker_lock:
+        if _worker is None:
+            _worker = RWorker(env)
+        worker = _worker
+
+    worker.start()
+    return worker
+
+
+def run_deseq2(
+    args: List[str],
+    env: Optional[Dict[str, str]] = None,
+    worker: Optional[RWorker] = None,
+) -> RProcess:
+    """Run `deseq2.r` in `worker`, or as a standalone `Rscript` without one."""
+    if worker is None:
+        return RScript(args, env)
+    return worker.run(args, env)
+
+
+@atexit.register
+def _close_shared_worker() -> None:
+    with _worker_lock:
+        worker = _worker
+    if worker is not None:
+        worker.close()
@@ -0,0 +1,317 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import gql
+from gql.transport.requests import RequestsHTTPTransport
+from latch.registry.types import Column, InvalidValue
+from latch.registry.utils import to_python_literal
+
+# (query, variables) -> the `data` of the GraphQL response
+GqlExecutor = Callable[[str, Dict[str, Any]], Dict[str, Any]]
+# table ID -> the table's columns
+ColumnLoader = Callable[[str], Dict[str, Column]]
+
+# PostGraphile names the ordering of a connection after its columns. Sorting by
+# record and key keeps the offsets of concurrent pages consistent
+node_order = "[SAMPLE_ID_ASC, SAMPLE_DATA_KEY_ASC]"
+
+# the records of the table, one row per cell like the other queries
+names_query = f"""
+query DesignMatrixNames($id: BigInt!, $first: Int!, $offset: Int!) {{
+    catalogExperiment(id: $id) {{
+        allSamples(first: $first, offset: $offset, orderBy: {node_order}) {{
+            totalCount
+            nodes {{
+                sampleId
+                sampleName
+            }}
+        }}
+    }}
+}}
+"""
+
+# the cells of one column, using the `condition` argument `latch.registry` uses
+# to filter other connections
+column_query = f"""
+query DesignMatrixColumn(
+    $id: BigInt!, $key: String!, $first: Int!, $offset: Int!
+) {{
+    catalogExperiment(id: $id) {{
+        allSamples(
+            first: $first
+            offset: $offset
+            orderBy: {node_order}
+            condition: {{sampleDataKey: $key}}
+        ) {{
+            totalCount
+            nodes {{
+                sampleId
+                sampleName
+                sampleDataKey
+                sampleDataValue
+            }}
+        }}
+    }}
+}}
+"""
+
+page_query = f"""
+query DesignMatrixPage($id: BigInt!, $first: Int!, $offset: Int!) {{
+    catalogExperiment(id: $id) {{
+        allSamples(first: $first, offset: $offset, orderBy: {node_order}) {{
+            totalCount
+            nodes {{
+                sampleId
+                sampleName
+                sampleDataKey
+                sampleDataValue
+            }}
+        }}
+    }}
+}}
+"""
+
+# what `latch.registry.table.Table.list_records` asks for
+all_samples_query = """
+query DesignMatrixAll($id: BigInt!) {
+    catalogExperiment(id: $id) {
+        allSamples {
+            nodes {
+                sampleId
+                sampleName
+                sampleDataKey
+                sampleDataValue
+            }
+        }
+    }
+}
+"""
+
+
+def gql_executor(url: str, headers: Dict[str, str]) -> GqlExecutor:
+    """Executor with one GraphQL client per thread.
+
+    A `gql.Client` keeps its transport connected for the duration of a request
+    and refuses to be used by two requests at once, so concurrent page requests
+    each need their own.
+    """
+    local = threading.local()
+
+    def execute(query: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+        client = getattr(local, "client", None)
+        if client is None:
+            client = gql.Client(
+                transport=RequestsHTTPTransport(url=url, headers=headers)
+            )
+            local.client = client
+        return client.execute(gql.gql(query), variable_values=variables)
+
+    return execute
+
+
+def latch_executor() -> GqlExecutor:
+    """Executor for the Latch GraphQL API, authenticated like `latch.registry`."""
+    from latch_sdk_config.latch import config
+    from latch_sdk_config.user import user_config
+
+    token = os.environ.get("FLYTE_INTERNAL_EXECUTION_ID", "")
+    if token != "":
+        auth = f"Latch-Execution-Token {token}"
+    else:
+        auth = f"Latch-SDK-Token {user_config.token}"
+
+    return gql_executor(config.gql, {"Authorization": auth})
+
+
+def latch_columns(table_id: str) -> Dict[str, Column]:
+    from latch.registry.table import Table
+
+    return Table(table_id).get_columns()
+
+
+@dataclass
+class RegistryRecord:
+    id: str
+    name: str
+    values: Dict[str, Any]
+
+
+@dataclass
+class RegistrySnapshot:
+    """Every record of a registry table with the values of `columns`."""
+
+    table_id: str
+    columns: List[str]
+    records: List[RegistryRecord]
+
+    @classmethod
+    def from_nodes(
+        cls,
+        table_id: str,
+        table_columns: Dict[str, Column],
+        nodes: List[Dict[str, Any]],
+        columns: List[str],
+    ) -> "RegistrySnapshot":
+        """Records as `Table.list_records` builds them, with only `columns`."""
+        wanted = {k: v for k, v in table_columns.items() if k in columns}
+
+        records: Dict[str, RegistryRecord] = {}
+        for node in nodes:
+            id = node["sampleId"]
+            rec = records.get(id)
+            if rec is None:
+                rec = RegistryRecord(id=id, name=node["sampleName"], values={})
+                records[id] = rec
+
+            col = wanted.get(node.get("sampleDataKey"))
+            if col is None:
+                continue
+
+            rec.values[col.key] = to_python_literal(
+                node["sampleDataValue"], col.upstream_type["type"]
+            )
+
+        for rec in records.values():
+            for col in wanted.values():
+                if col.key not in rec.values and not col.upstream_type["allowEmpty"]:
+                    rec.values[col.key] = InvalidValue("")
+
+        return cls(table_id=table_id, columns=columns, records=list(records.values()))
+
+
+@dataclass
+class _TableCells:
+    columns: Dict[str, Column]
+    # one node per record, `None` until fetched
+    names: Optional[List[Dict[str, Any]]] = None
+    # column key -> the cells of that column
+    cells: Optional[Dict[str, List[Dict[str, Any]]]] = None
+    # every cell of the table, if the server could not filter by column
+    nodes: Optional[List[Dict[str, Any]]] = None
+
+
+class RegistryFetcher:
+    """Fetches the records of registry tables for design matrices.
+
+    The record names and the cells of each requested column are requested
+    separately, in pages of `page_size` rows sorted by record and key,
+    `max_workers` at a time, so the values of unused columns are never
+    transferred. If the server rejects the column filter the whole table is
+    paged instead, and if it rejects paging it is requested at once like
+    `Table.list_records` does.
+
+    Tables are kept for the life of the fetcher, so the reports of a batch that
+    use the same table fetch it once and only fetch columns not seen before.
+    Nothing is kept across tasks: the registry API exposes no table version to
+    tell a stale copy from a current one.
+    """
+
+    def __init__(
+        self,
+        executor: Optional[GqlExecutor] = None,
+        *,
+        columns: ColumnLoader = latch_columns,
+        page_size: int = 2000,
+        max_workers: int = 8,
+    ):
+        self._executor = executor
+        self._columns = columns
+        self.page_size = page_size
+        self.max_workers = max_workers
+
+        self.requests = 0
+        self._tables: Dict[str, _TableCells] = {}
+        self._lock = threading.Lock()
+
+    def _execute(self, query: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            if self._executor is None:
+                self._executor = latch_executor()
+            executor = self._executor
+            self.requests += 1
+        return executor(query, variables)
+
+    def _pages(self, query: str, variables: Dict[str, Any]) -> List[Dict[str, Any]]:
+        def page(offset: int) -> Dict[str, Any]:
+            data = self._execute(
+                query, {**variables, "first": self.page_size, "offset": offset}
+            )
+            return data["catalogExperiment"]["allSamples"]
+
+        first = page(0)
+        nodes: List[Dict[str, Any]] = list(first["nodes"])
+        offsets = list(range(self.page_size, first["totalCount"], self.page_size))
+        if len(offsets) > 0:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                for x in pool.map(page, offsets):
+                    nodes.extend(x["nodes"])
+
+        return nodes
+
+    def _fetch_nodes(self, table_id: str) -> List[Dict[str, Any]]:
+        try:
+            return self._pages(page_query, {"id": table_id})
+        except Exception as e:
+            # the server may not support paging this connection, fall back to
+            # the query `latch.registry` itself uses
+            print(f"  Paged fetch failed, fetching the table at once: {e}")
+            data = self._execute(all_samples_query, {"id": table_id})
+            return data["catalogExperiment"]["allSamples"]["nodes"]
+
+    def _fetch_columns(self, table_id: str, table: _TableCells, columns: List[str]):
+        if table.nodes is not None:
+            return
+
+        try:
+            if table.names is None:
+                names: Dict[str, Dict[str, Any]] = {}
+                for x in self._pages(names_query, {"id": table_id}):
+                    names.setdefault(x["sampleId"], x)
+                table.names = list(names.values())
+                table.cells = {}
+
+            assert table.cells is not None
+            for key in columns:
+                if key in table.cells or key not in table.columns:
+                    continue
+                table.cells[key] = self._pages(
+                    column_query, {"id": table_id, "key": key}
+                )
+        except Exception as e:
+            print(f"  Column fetch failed, fetching every column: {e}")
+            table.nodes = self._fetch_nodes(table_id)
+
+    def fetch(self, table_id: str, columns: List[str]) -> RegistrySnapshot:
+        table = self._tables.get(table_id)
+        if table is None:
+            table = _TableCells(columns=self._columns(table_id))
+            self._tables[table_id] = table
+        else:
+            print("  Using the table fetched earlier in this task")
+
+        self._fetch_columns(table_id, table, columns)
+
+        if table.nodes is not None:
+            nodes = table.nodes
+        else:
+            assert table.names is not None and table.cells is not None
+            nodes = list(table.names)
+            for key in columns:
+                nodes.extend(table.cells.get(key, []))
+
+        return RegistrySnapshot.from_nodes(table_id, table.columns, nodes, columns)
+
+
+_fetcher: Optional[RegistryFetcher] = None
+
+
+def registry_fetcher() -> RegistryFetcher:
+    """The process-wide fetcher, shared by every report of a batch."""
+    global _fetcher
+
+    if _fetcher is None:
+        _fetcher = RegistryFetcher()
+    return _fetcher
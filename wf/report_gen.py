@@ -1,31 +1,48 @@
+import csv
+import html
+import json
+import math
 import re
+import sys
 import traceback
+from array import array
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Set
+from typing import Any, Dict, List, Optional, Set, Tuple
+from urllib.parse import unquote
 
+from wf.deseqreport import compress_text
 from wf.util import warn, warning
 
 
 @dataclass
 class ExperimentResult:
     id: str
+    col: str
+    l1: str
+    l2: str
     csv_path: Path
-    qc_path: str
-    ma_path: str
-    volcano_path: str
+    qc_path: Path
+    ma_path: Path
+    volcano_path: Path
 
 
 full_name_regex = re.compile(r"^(?P<l1>.+) vs (?P<l2>.+) \((?P<col>.+)\)")
 
+contrast_prefix = "contrast/"
+contrast_genes_key = contrast_prefix + "_genes"
+contrast_table_format = "float64-column-major"
 
-def generate_report():
+
+def generate_report(
+    res_p: Path = Path("./res"),
+) -> Tuple[Dict[str, Dict[str, List[str]]], List[ExperimentResult]]:
     print("Generating the report")
     options: List[ExperimentResult] = []
 
     level_options: Dict[str, Dict[str, Set[str]]] = {}
 
-    for path in Path("./res/Data/Contrast").iterdir():
+    for path in (res_p / "Data/Contrast").iterdir():
         try:
             full = str(path.with_suffix("").name)
 
@@ -46,11 +63,14 @@ def generate_report():
             options += [
                 ExperimentResult(
                     id=id,
+                    col=col,
+                    l1=l1,
+                    l2=l2,
                     csv_path=path,
                     # todo(maximsmol): make interactive
-                    qc_path=f"./Plots/QC/Variance P-Value/{full}.png",
-                    ma_path=f"./res/Plots/Contrast/{full}/MA.html",
-                    volcano_path=f"./res/Plots/Contrast/{full}/Volcano.html",
+                    qc_path=res_p / f"Plots/QC/Variance P-Value/{full}.png",
+                    ma_path=res_p / f"Plots/Contrast/{full}/MA.html",
+                    volcano_path=res_p / f"Plots/Contrast/{full}/Volcano.html",
                 )
             ]
         except:
@@ -70,4 +90,152 @@ def generate_report():
     return {
         col: {l1: sorted(level_options[col][l1]) for l1 in level_options[col]}
         for col in level_options
+    }, options
+
+
+def _parse_float(x: str) -> float:
+    try:
+        return float(x)
+    except ValueError:
+        # R writes missing values as NA
+        return math.nan
+
+
+def write_contrast_table(
+    csv_path: Path, out: Path, shared_genes: Optional[List[str]]
+) -> List[str]:
+    """Convert a contrast CSV written by the R script to packed float64 columns.
+
+    The blob is a little-endian u32 header length, a JSON header with the
+    column names and row count, then every column as `rows` float64 values
+    with NaN for NA. Row names are only stored in the header when they differ
+    from `shared_genes`, otherwise the header points at `contrast_genes_key`.
+    """
+    with csv_path.open("r", newline="") as f:
+        r = csv.reader(f)
+        header = next(r)
+        columns = header[1:]
+
+        genes: List[str] = []
+        data = [array("d") for _ in columns]
+        for row in r:
+            genes.append(row[0])
+            for col, x in zip(data, row[1:]):
+                col.append(_parse_float(x))
+
+    json_header: Dict[str, Any] = {
+        "format": contrast_table_format,
+        "rows": len(genes),
+        "columns": columns,
     }
+    if shared_genes is not None and genes == shared_genes:
+        json_header["genes_key"] = contrast_genes_key
+    else:
+        json_header["genes"] = genes
+
+    json_blob = json.dumps(json_header).encode("utf-8")
+    with out.open("wb") as f:
+        f.write(len(json_blob).to_bytes(4, "little", signed=False))
+        f.write(json_blob)
+        for col in data:
+            if sys.byteorder != "little":
+                col.byteswap()
+            col.tofile(f)
+
+    return genes
+
+
+def pack_contrasts(
+    options: List[ExperimentResult], tmp: Path
+) -> Tuple[Dict[str, Path], Dict[str, Any]]:
+    """Files to embed for every contrast and an index shaped like `level_options`.
+
+    The index maps column -> level 1 -> level 2 -> kind -> report entry key so
+    that a viewer only has to load the entries of the contrast that is opened.
+    """
+    embedded_data: Dict[str, Path] = {}
+    index: Dict[str, Any] = {}
+
+    shared_genes: Optional[List[str]] = None
+    for idx, x in enumerate(sorted(options, key=lambda x: x.id)):
+        prefix = f"{contrast_prefix}{x.col}/{x.l1}/{x.l2}"
+
+        try:
+            table_p = tmp / f"{idx}.bin"
+            genes = write_contrast_table(x.csv_path, table_p, shared_genes)
+        except:
+            traceback.print_exc()
+            warn(f"Failed to pack contrast data for {x.csv_path.name}")
+            continue
+
+        if shared_genes is None:
+            shared_genes = genes
+            genes_p = tmp / "genes.txt"
+            genes_p.write_text("\n".join(genes), encoding="utf-8")
+            embedded_data[contrast_genes_key] = genes_p
+
+        entries = {
+            "table": table_p,
+            "qc": x.qc_path,
+            "ma": x.ma_path,
+            "volcano": x.volcano_path,
+        }
+        keys = index.setdefault(x.col, {}).setdefault(x.l1, {}).setdefault(x.l2, {})
+        for kind, p in entries.items():
+            if not p.exists():
+                continue
+
+            keys[kind] = f"{prefix}/{kind}"
+            embedded_data[keys[kind]] = p
+
+    return embedded_data, index
+
+
+def compress_contrasts(key: str, p: Path) -> bool:
+    """Compress the contrast entries, which only version 2 readers know about.
+
+    The entries a version 1 reader frames stay uncompressed.
+    """
+    return key.startswith(contrast_prefix) and compress_text(key, p)
+
+
+_script_src_re = re.compile(r'<script\s+src="([^"]+)"\s*></script>')
+_stylesheet_re = re.compile(r'<link\s+href="([^"]+)"\s+rel="stylesheet"\s*/?>')
+
+
+def _local_library(html_p: Path, href: str) -> Optional[Path]:
+    if re.match(r"^[a-z][a-z0-9+.-]*:|^//", href, re.IGNORECASE):
+        return None
+
+    p = html_p.parent / unquote(html.unescape(href))
+    if not p.is_file():
+        return None
+    return p
+
+
+def inline_widget_libraries(html_p: Path, out: Path) -> Path:
+    """Copy of a widget with its local script and stylesheet files inlined.
+
+    Widgets saved with "offline" libraries link them from `Plots/lib`, which
+    does not exist next to the copy embedded in the report.
+    """
+    text = html_p.read_text(encoding="utf-8")
+
+    def script(m: re.Match) -> str:
+        lib = _local_library(html_p, m.group(1))
+        if lib is None:
+            return m.group(0)
+        js = lib.read_text(encoding="utf-8").replace("</script", "<\\/script")
+        return f"<script>{js}</script>"
+
+    def stylesheet(m: re.Match) -> str:
+        lib = _local_library(html_p, m.group(1))
+        if lib is None:
+            return m.group(0)
+        return f"<style>{lib.read_text(encoding='utf-8')}</style>"
+
+    text = _script_src_re.sub(script, text)
+    text = _stylesheet_re.sub(stylesheet, text)
+
+    out.write_text(text, encoding="utf-8")
+    return out
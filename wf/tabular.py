@@ -0,0 +1,65 @@
+import csv
+import sys
+import zipfile
+from contextlib import contextmanager
+from io import SEEK_SET
+from pathlib import Path
+from typing import Any, Iterable, Iterator, List, TextIO, Tuple
+
+from openpyxl import load_workbook
+
+csv.field_size_limit(sys.maxsize)
+
+
+def csv_tsv_reader(f: TextIO, use_dict_reader: bool = False):
+    sniff = csv.Sniffer()
+    dialect = sniff.sniff(f.readline())
+    f.seek(0, SEEK_SET)
+
+    if use_dict_reader:
+        return csv.DictReader(f, dialect=dialect)
+    else:
+        return csv.reader(f, dialect=dialect)
+
+
+def is_xlsx(p: Path) -> bool:
+    # XLSX files are zip archives, CSV/TSV files never are
+    return zipfile.is_zipfile(p)
+
+
+@contextmanager
+def open_table(p: Path) -> Iterator[Tuple[List[str], Iterator[List[Any]]]]:
+    """Open a CSV, TSV, or XLSX file as its header and an iterator over the other rows.
+
+    XLSX rows hold cell values as openpyxl reads them (numbers stay numbers,
+    empty cells are None). The workbook is opened in read-only mode so rows are
+    streamed from the archive instead of being materialized as cell objects.
+    """
+    if is_xlsx(p):
+        workbook = load_workbook(str(p), read_only=True, data_only=True)
+        try:
+            sheet = workbook.worksheets[0]
+            # some writers store a wrong sheet size, read until the data ends
+            sheet.reset_dimensions()
+
+            rows = sheet.iter_rows(values_only=True)
+            header = ["" if x is None else str(x) for x in next(rows, ())]
+            yield header, (list(x) for x in rows)
+        finally:
+            workbook.close()
+        return
+
+    # utf-8-sig strips byte order marks sometimes present at the beginning of
+    # tabular files exported from excel
+    with p.open("r", encoding="utf-8-sig", newline="") as f:
+        r = csv_tsv_reader(f)
+        header = next(r, [])
+        yield header, r
+
+
+def write_csv(p: Path, header: List[str], rows: Iterable[List[Any]]) -> None:
+    with p.open("w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(header)
+        for row in rows:
+            w.writerow(["" if x is None else x for x in row])
@@ -0,0 +1,208 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+timings_version = 2
+
+_page_size = os.sysconf("SC_PAGE_SIZE")
+
+
+@dataclass
+class Stage:
+    name: str
+    source: str
+    start: float
+    end: Optional[float] = None
+    id: Optional[str] = None
+    # only sampled for R stages, see `RssSampler`
+    peak_rss_bytes: Optional[int] = None
+
+    @property
+    def seconds(self) -> Optional[float]:
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def dict(self) -> Dict[str, Any]:
+        res: Dict[str, Any] = {
+            "name": self.name,
+            "source": self.source,
+            "start": self.start,
+            "end": self.end,
+            "seconds": self.seconds,
+            "peak_rss_bytes": self.peak_rss_bytes,
+        }
+        if self.id is not None:
+            res["id"] = self.id
+        return res
+
+
+def _self_peak_rss() -> int:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _pss(pid: int) -> int:
+    # kilobytes, summed over every mapping
+    for l in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines():
+        if l.startswith("Pss:"):
+            return int(l.split()[1]) * 1024
+    raise ValueError(f"No Pss in smaps_rollup of {pid}")
+
+
+def _rss(pid: int) -> int:
+    return int(Path(f"/proc/{pid}/statm").read_text().split()[1]) * _page_size
+
+
+def process_tree_pss(pid: int) -> int:
+    """Proportional memory of `pid` and all of its descendants, in bytes.
+
+    Forked R workers (BiocParallel) are separate processes, so the parent's
+    memory alone would miss most of the memory used by the contrasts. They
+    share their parent's pages copy-on-write, which RSS would count once per
+    worker. PSS splits every shared page between the processes mapping it, so
+    the sum counts it once. Without `smaps_rollup` (Linux before 4.14) this
+    falls back to RSS, which makes the sum an upper bound.
+    """
+    children: Dict[int, List[int]] = {}
+    for x in os.listdir("/proc"):
+        if not x.isdigit():
+            continue
+        try:
+            stat = Path(f"/proc/{x}/stat").read_text()
+        except OSError:
+            continue
+        # the command name is parenthesized and may contain spaces
+        fields = stat[stat.rfind(")") + 2 :].split()
+        children.setdefault(int(fields[1]), []).append(int(x))
+
+    total = 0
+    todo = [pid]
+    while len(todo) > 0:
+        cur = todo.pop()
+        try:
+            try:
+                total += _pss(cur)
+            except FileNotFoundError:
+                if not Path(f"/proc/{cur}").exists():
+                    raise
+                total += _rss(cur)
+        except (OSError, IndexError, ValueError):
+            pass
+        todo.extend(children.get(cur, []))
+
+    return total
+
+
+class Timings:
+    """Stage timings and peak memory of a task run.
+
+    Python phases are timed with `phase`. The R script reports its stages as
+    `stage` messages on the `__LATCH_MESSAGE_DATA` channel, which are passed to
+    `r_event`. A `RssSampler` attributes the R process tree's memory (PSS, see
+    `process_tree_pss`) to the R stages open at the time of each sample.
+
+    Python phases have no memory of their own: the task's peak resident memory
+    only grows, so it is reported once for the whole run.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages: List[Stage] = []
+        self.r_peak_rss_bytes = 0
+
+        self._open_r: Dict[Tuple[str, Optional[str]], Stage] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        x = Stage(name=name, source="python", start=time.time())
+        self.stages.append(x)
+        try:
+            yield
+        finally:
+            x.end = time.time()
+
+    def r_event(self, data: Dict[str, Any]) -> None:
+        name = str(data["stage"])
+        id = data.get("id")
+        key = (name, id)
+        t = float(data.get("time", time.time()))
+
+        with self._lock:
+            if data["event"] == "start":
+                x = Stage(name=name, source="r", start=t, id=id, peak_rss_bytes=0)
+                self._open_r[key] = x
+                self.stages.append(x)
+            elif data["event"] == "end":
+                x = self._open_r.pop(key, None)
+                if x is not None:
+                    x.end = t
+
+    def r_rss_sample(self, rss: int) -> None:
+        with self._lock:
+            self.r_peak_rss_bytes = max(self.r_peak_rss_bytes, rss)
+            for x in self._open_r.values():
+                x.peak_rss_bytes = max(x.peak_rss_bytes or 0, rss)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        res: Dict[str, Dict[str, Any]] = {}
+        for x in self.stages:
+            if x.seconds is None:
+                continue
+
+            s = res.setdefault(
+                f"{x.source}/{x.name}",
+                {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0},
+            )
+            s["count"] += 1
+            s["total_seconds"] += x.seconds
+            s["max_seconds"] = max(s["max_seconds"], x.seconds)
+        return res
+
+    def dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "version": timings_version,
+                "start": self.start,
+                "total_seconds": time.time() - self.start,
+                "task_peak_rss_bytes": _self_peak_rss(),
+                "r_peak_rss_bytes": self.r_peak_rss_bytes,
+                "summary": self.summary(),
+                "stages": [x.dict() for x in self.stages],
+            }
+
+    def write(self, p: Path) -> None:
+        with p.open("w") as f:
+            json.dump(self.dict(), f, indent=2)
+
+
+class RssSampler:
+    """Samples the memory of a process tree in the background."""
+
+    def __init__(self, pid: int, timings: Timings, interval: float = 0.5):
+        self.pid = pid
+        self.timings = timings
+        self.interval = interval
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.timings.r_rss_sample(process_tree_pss(self.pid))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
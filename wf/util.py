@@ -1,11 +1,198 @@
+import atexit
 import os
-from typing import Any, Dict
+import queue
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
 
 import requests
 
+nucleus_message_url = "https://nucleus.latch.bio/sdk/add-task-execution-message"
+
+
+class MessageSender:
+    """Delivers task execution messages to Latch from a background thread.
+
+    `send` only enqueues, so streaming the R script's output is never held up
+    by the network. The sender thread drains up to `batch_size` queued messages
+    per wake-up and posts them over one pooled session. Failed posts are
+    retried with exponential backoff; a message that still cannot be delivered
+    is logged and dropped rather than failing the task.
+    """
+
+    def __init__(
+        self,
+        url: str = nucleus_message_url,
+        *,
+        session: Optional[requests.Session] = None,
+        batch_size: int = 32,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+        max_backoff: float = 8,
+        timeout: float = 10,
+    ):
+        self.url = url
+        self.session = session if session is not None else requests.Session()
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.delivered = 0
+        self.dropped = 0
+
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def send(self, payload: Dict[str, Any]) -> None:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Message sender is closed")
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="latch-messages", daemon=True
+                )
+                self._thread.start()
+        self._queue.put(payload)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every queued message was delivered or dropped.
+
+        Returns `False` if `timeout` seconds passed first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks > 0:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout: Optional[float] = None) -> bool:
+        """Deliver the queued messages and stop the sender thread."""
+        with self._lock:
+            if self._closed:
+                return True
+            self._closed = True
+            thread = self._thread
+
+        if thread is None:
+            self.session.close()
+            return True
+
+        self._queue.put(None)
+        thread.join(timeout)
+        if thread.is_alive():
+            return False
+
+        self.session.close()
+        return True
+
+    def _run(self) -> None:
+        while True:
+            batch: List[Optional[Dict[str, Any]]] = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            for payload in batch:
+                try:
+                    if payload is None:
+                        stop = True
+                    else:
+                        self._deliver(payload)
+                finally:
+                    self._queue.task_done()
+
+            if stop:
+                return
+
+    def _deliver(self, payload: Dict[str, Any]) -> None:
+        attempt = 0
+        while True:
+            problem: str
+            retryable = True
+            try:
+                response = self.session.post(
+                    self.url, json=payload, timeout=self.timeout
+                )
+                if response.status_code == 200:
+                    self.delivered += 1
+                    return
+
+                problem = f"status {response.status_code}"
+                retryable = response.status_code >= 500 or response.status_code == 429
+            except requests.RequestException as e:
+                problem = str(e)
+
+            attempt += 1
+            if not retryable or attempt > self.max_retries:
+                self.dropped += 1
+                print(
+                    "Could not add task execution message to Latch"
+                    f" ({problem}): [{payload.get('type')}]: {payload.get('data')}"
+                )
+                return
+
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            time.sleep(delay * random.uniform(0.5, 1))
+
+
+_sender: Optional[MessageSender] = None
+_sender_lock = threading.Lock()
+
+
+def message_sender() -> MessageSender:
+    global _sender
+
+    with _sender_lock:
+        if _sender is None:
+            _sender = MessageSender(
+                os.environ.get("LATCH_MESSAGE_URL", nucleus_message_url)
+            )
+        return _sender
+
+
+def set_message_sender(sender: Optional[MessageSender]) -> Optional[MessageSender]:
+    """Replace the sender used by `message`, returning the previous one."""
+    global _sender
+
+    with _sender_lock:
+        res = _sender
+        _sender = sender
+        return res
+
+
+def flush_messages(timeout: Optional[float] = 30) -> None:
+    with _sender_lock:
+        sender = _sender
+    if sender is None:
+        return
+
+    if not sender.flush(timeout):
+        print("Timed out delivering task execution messages to Latch")
+
+
+@atexit.register
+def _close_message_sender() -> None:
+    with _sender_lock:
+        sender = _sender
+    if sender is not None:
+        sender.close(timeout=30)
+
 
 def message(typ: str, data: Dict[str, Any]) -> None:
-    return
     try:
         task_project = os.environ["FLYTE_INTERNAL_TASK_PROJECT"]
         task_domain = os.environ["FLYTE_INTERNAL_TASK_DOMAIN"]
@@ -17,9 +204,8 @@ def message(typ: str, data: Dict[str, Any]) -> None:
         print(f"Local execution message:\n[{typ}]: {data}")
         return
 
-    response = requests.post(
-        url="https://nucleus.latch.bio/sdk/add-task-execution-message",
-        json={
+    message_sender().send(
+        {
             "execution_token": execution_token,
             "task": {
                 "project": task_project,
@@ -30,12 +216,9 @@ def message(typ: str, data: Dict[str, Any]) -> None:
             "task_attempt_number": task_attempt_number,
             "type": typ,
             "data": data,
-        },
+        }
     )
 
-    if response.status_code != 200:
-        raise RuntimeError("Could not add task execution message to Latch.")
-
 
 def info(data: Dict[str, Any]):
     message("info", data)
@@ -47,9 +230,37 @@ def warning(data: Dict[str, Any]):
 
 def error(data: Dict[str, Any]):
     message("error", data)
+    # errors are almost always followed by failing the task
+    flush_messages()
 
 
 def warn(*args, **kwargs):
     print("", "!>>> Warning", sep="\n")
     print(*args, **kwargs)
     print("!>>>", "", sep="\n")
+
+
+def available_cpu_count() -> int:
+    """CPUs this process may use, honoring affinity and cgroup CPU quotas."""
+    res = len(os.sched_getaffinity(0))
+
+    quota: Optional[float] = None
+    try:
+        # cgroup v2
+        q, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if q != "max":
+            quota = int(q) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            q = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+            period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+            if q > 0:
+                quota = q / period
+        except (OSError, ValueError):
+            pass
+
+    if quota is not None:
+        res = min(res, int(quota))
+
+    return max(1, res)
@@ -0,0 +1,220 @@
+from typing import Any, Dict, List
+
+import numpy as np
+
+from wf.ingest import IngestedCounts, na_count
+from wf.util import error, warn, warning
+
+# How many offending genes/cells to list in a single message
+max_examples = 10
+
+
+def _examples(xs: List[str], total: int) -> Dict[str, Any]:
+    res = list(xs[:max_examples])
+    if total > len(res):
+        res.append(f"... and {total - len(res)} more")
+    return {"list": res}
+
+
+def load_counts_matrix(ingested: IngestedCounts) -> np.ndarray:
+    """Memory-map the ingested counts as a (genes x samples) matrix."""
+    if ingested.num_genes == 0 or len(ingested.samples) == 0:
+        return np.zeros((ingested.num_genes, len(ingested.samples)), dtype="<i4")
+
+    # stored column after column, so the transpose of a C-ordered
+    # (samples x genes) array is the matrix R sees
+    return np.memmap(
+        ingested.path / "counts.bin",
+        dtype="<i4",
+        mode="r",
+        shape=(len(ingested.samples), ingested.num_genes),
+    ).T
+
+
+def validate_counts(ingested: IngestedCounts) -> None:
+    """Check the ingested counts for problems DESeq2 would otherwise fail on.
+
+    Every problem found is reported as its own execution message. Raises
+    `RuntimeError` if any of them would make the R script fail.
+    """
+    problems: List[Dict[str, Any]] = []
+
+    if len(ingested.missing_samples) > 0:
+        warn(
+            "Samples from the design matrix missing in the counts table:",
+            *(f"  {x}" for x in ingested.missing_samples),
+            sep="\n",
+        )
+        warning(
+            {
+                "title": "Samples missing from the counts table",
+                "body": [
+                    (
+                        "These design matrix samples have no column in the counts"
+                        " table and will not be used"
+                    ),
+                    {
+                        "section": "Missing Samples:",
+                        "body": _examples(
+                            ingested.missing_samples, len(ingested.missing_samples)
+                        ),
+                    },
+                ],
+            }
+        )
+
+    if len(ingested.samples) < 2:
+        problems.append(
+            {
+                "title": "Not enough samples in the counts table",
+                "body": [
+                    (
+                        f"Only {len(ingested.samples)} of the design matrix samples"
+                        " were found in the counts table, at least 2 are needed"
+                    ),
+                    {
+                        "section": "Unused Counts Table Columns:",
+                        "body": _examples(
+                            ingested.ignored_columns, len(ingested.ignored_columns)
+                        ),
+                    },
+                ],
+            }
+        )
+
+    if ingested.num_genes == 0:
+        problems.append(
+            {
+                "title": "Counts table is empty",
+                "body": "No gene rows were found in the counts table",
+            }
+        )
+
+    genes = np.array(
+        (ingested.path / "genes.txt").read_text(encoding="utf-8").splitlines(),
+        dtype=object,
+    )
+    unique, counts = np.unique(genes, return_counts=True)
+    duplicated = unique[counts > 1]
+    if len(duplicated) > 0:
+        problems.append(
+            {
+                "title": "Duplicate gene IDs",
+                "body": [
+                    (
+                        f"{len(duplicated)} gene IDs appear more than once in column"
+                        f" '{ingested.gene_id_column}'"
+                    ),
+                    {
+                        "section": "Duplicated Gene IDs:",
+                        "body": _examples(
+                            [
+                                f"{g} ({c} rows)"
+                                for g, c in zip(duplicated, counts[counts > 1])
+                            ],
+                            len(duplicated),
+                        ),
+                    },
+                ],
+            }
+        )
+
+    m = load_counts_matrix(ingested)
+    if m.size > 0:
+        na = m == na_count
+
+        na_rows = na.all(axis=1)
+        num_na_rows = int(na_rows.sum())
+        if num_na_rows > 0:
+            problems.append(
+                {
+                    "title": "Genes without any counts",
+                    "body": [
+                        f"{num_na_rows} genes have no numeric counts in any sample",
+                        {
+                            "section": "Genes:",
+                            "body": _examples(
+                                list(genes[na_rows][:max_examples]), num_na_rows
+                            ),
+                        },
+                    ],
+                }
+            )
+
+        na_per_sample = na.sum(axis=0)
+        num_na = int(na_per_sample.sum())
+        if num_na > 0:
+            problems.append(
+                {
+                    "title": "Missing or non-numeric counts",
+                    "body": [
+                        f"{num_na} cells of the counts table are empty or not numbers",
+                        {
+                            "section": "Per Sample:",
+                            "body": {
+                                "list": [
+                                    f"{s}: {int(n)}"
+                                    for s, n in zip(ingested.samples, na_per_sample)
+                                    if n > 0
+                                ]
+                            },
+                        },
+                        {
+                            "section": "Examples:",
+                            "body": {"list": ingested.non_numeric_examples},
+                        },
+                    ],
+                }
+            )
+
+        negative = (m < 0) & ~na
+        num_negative = int(negative.sum())
+        if num_negative > 0:
+            gene_idxs, sample_idxs = np.nonzero(negative)
+            problems.append(
+                {
+                    "title": "Negative counts",
+                    "body": [
+                        f"{num_negative} cells of the counts table are negative",
+                        {
+                            "section": "Examples:",
+                            "body": _examples(
+                                [
+                                    f"{genes[g]} / {ingested.samples[s]}: {m[g, s]}"
+                                    for g, s in zip(
+                                        gene_idxs[:max_examples],
+                                        sample_idxs[:max_examples],
+                                    )
+                                ],
+                                num_negative,
+                            ),
+                        },
+                    ],
+                }
+            )
+
+        # size factors come from the geometric mean over samples, which needs
+        # at least one gene that is non-zero everywhere
+        if num_na == 0 and bool((m == 0).any(axis=1).all()):
+            problems.append(
+                {
+                    "title": "Every gene has a zero count",
+                    "body": (
+                        "Every gene contains at least one zero count, so DESeq2"
+                        " cannot estimate size factors"
+                    ),
+                }
+            )
+
+    if len(problems) == 0:
+        print("  Counts table passed validation")
+        return
+
+    warn(
+        "Counts table failed validation:",
+        *(f"  {x['title']}" for x in problems),
+        sep="\n",
+    )
+    for x in problems:
+        error(x)
+    raise RuntimeError("Counts table failed validation")